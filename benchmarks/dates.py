@@ -0,0 +1,65 @@
+"""
+Бенчмарк разбора дедлайна: сколько строк в секунду проходит через `parse_date_from_text`.
+
+Набор строк как у реальных задач: числовые даты трех форматов, относительные фразы
+("завтра", "в пятницу"), слова, похожие на дни недели, и строки вовсе без даты.
+
+    python benchmarks/dates.py [--lines 5000] [--runs 20]
+
+Результат - JSON в stdout.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from startup import FAKE_TOKEN, REPO_DIR
+
+SAMPLES = {
+    "numeric": ["Сдать домашку по матану 20.10", "Лаба 3 до 15.11.2026 обязательно", "Эссе 1.12.26", "Квиз 29.02"],
+    "relative": ["Сдать эссе завтра", "Лаба через 3 дня", "Тест в пятницу", "до понедельника проект"],
+    "weekday_words": ["настроить среду разработки", "Москва среда обитания", "Пятничный созвон"],
+    "no_date": ["Проект без даты вообще никакой", "Quiz 7", "Прочитать главу 3.2 учебника"],
+}
+
+
+def _lines_per_second(parse, lines: list[str], today: date, runs: int) -> int:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for line in lines:
+            parse(line, today)
+        timings.append(time.perf_counter() - started)
+    return round(len(lines) / statistics.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.update({"TOKEN": FAKE_TOKEN, "DATA_DIR": tempfile.mkdtemp(prefix="bench_dates_")})
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    import tg_part_laptop as bot_module
+    logging.getLogger().setLevel(logging.WARNING)
+
+    today = date(2026, 10, 17)
+    results = {"lines": args.lines, "runs": args.runs}
+    mixed = []
+    for kind, samples in SAMPLES.items():
+        lines = [samples[n % len(samples)] for n in range(args.lines)]
+        mixed.extend(lines[:args.lines // len(SAMPLES)])
+        results[f"{kind}_lines_per_second"] = _lines_per_second(bot_module.parse_date_from_text, lines, today, args.runs)
+    results["mixed_lines_per_second"] = _lines_per_second(bot_module.parse_date_from_text, mixed, today, args.runs)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""
+Офлайн бенчмарк всего пути: FastAPI `api` работает в этом процессе, а внешние сервисы
+подменены заглушками:
+
+- Bot API (sendMessage, editMessageText, getChat, ...) - HTTP-сервер с задержкой как у RTT;
+- Moodle - HTTP-сервер, который генерирует страницы курсов заданного размера;
+- Gemini - объект вместо модели SDK: первый токен через --gemini-ttft, дальше чанки.
+
+Заглушки Bot API и Moodle живут в отдельном процессе, чтобы их потоки не делили GIL с ботом.
+Сценарии: поток синтетических апдейтов в вебхук (добавить/удалить задачу, вопрос к AI)
+и тики крона /check_reminders (напоминания + парсинг KSE + слияние + перерисовка).
+
+    python benchmarks/harness.py [--updates 500] [--concurrency 32] [--courses 4] [--activities 200]
+
+Результат - JSON в stdout (или в --output): пропускная способность, p50/p99 задержек и память.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from startup import FAKE_TOKEN, REPO_DIR
+
+OWNER_CHAT_ID = 1000
+OWNER_MESSAGE_ID = 1
+REMINDER_SECRET = "bench-reminders"
+WEBHOOK_SECRET = "bench-webhook"
+MONTHS = ("January", "February", "March", "April", "May", "June", "July",
+          "August", "September", "October", "November", "December")
+
+
+# --- Заглушки Bot API и Moodle (дочерний процесс) ---
+
+def _course_html(course_id: int, activities: int, generation: int, churn: float) -> str:
+    """Страница курса в разметке Moodle, которую разбирает парсер. С каждым запросом часть дедлайнов сдвигается."""
+    today = date.today()
+    churn_every = max(1, round(1 / churn)) if churn > 0 else 0
+    parts = ['<html><head><title>Course</title></head><body><div id="page">',
+             f'<input type="hidden" name="sesskey" value="{random.random()}">',
+             '<ul class="weeks">']
+    per_section = 10
+    for section in range(0, activities, per_section):
+        parts.append(f'<li class="section main" id="section-{section // per_section}">'
+                     f'<h3 class="sectionname">Week {section // per_section + 1}</h3><ul class="section img-text">')
+        for module in range(section, min(section + per_section, activities)):
+            shift = 1 if churn_every and (module + generation) % churn_every == 0 else 0
+            deadline = today + timedelta(days=2 + module % 120 + shift)
+            parts.append(
+                f'<li class="activity quiz modtype_quiz" id="module-{course_id * 100000 + module}"><div class="activityinstance">'
+                f'<img src="/q.svg" alt="quiz icon"><span class="instancename">Quiz {module}'
+                f'<span class="accesshide"> Quiz</span></span></div>'
+                f'<div data-region="activity-dates"><div class="description-inner">'
+                f'<div><strong>Opened:</strong> 1 {MONTHS[today.month - 1]} {today.year}, 00:00</div>'
+                f'<div><strong>Closes:</strong> {deadline.day} {MONTHS[deadline.month - 1]} {deadline.year}, 23:59</div>'
+                f'</div></div></li>')
+        parts.append('</ul></li>')
+    parts.append('</ul></div></body></html>')
+    return "".join(parts)
+
+
+def _message(chat_id: int, message_id: int, text: str) -> dict:
+    return {"message_id": message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"}}
+
+
+def serve_fakes(port_queue, bot_latency: float, moodle_latency: float, activities: int, churn: float):
+    """Точка входа дочернего процесса: один сервер для Bot API, Moodle и /_stats."""
+    calls: dict[str, int] = {}
+    messages: dict[tuple, str] = {(OWNER_CHAT_ID, OWNER_MESSAGE_ID): "📋 *Список задач:*\n_Задач нет_"}
+    course_requests: dict[int, int] = {}
+    state = {"next_message_id": 10, "webhook_url": ""}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, как у настоящих серверов
+
+        def _reply(self, payload: bytes, content_type: str = "application/json"):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            try:
+                self.wfile.write(payload)
+            except BrokenPipeError:
+                pass
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == "/_stats":
+                return self._reply(json.dumps({"bot_api_calls": calls, "moodle_requests": course_requests}).encode())
+            if url.path == "/course/view.php":
+                course_id = int(urllib.parse.parse_qs(url.query)["id"][0])
+                generation = course_requests[course_id] = course_requests.get(course_id, 0) + 1
+                time.sleep(moodle_latency)
+                return self._reply(_course_html(course_id, activities, generation, churn).encode(), "text/html; charset=utf-8")
+            self.send_error(404)
+
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1]
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params = json.loads(body or b"{}")
+            else:
+                params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+            time.sleep(bot_latency)
+            calls[method] = calls.get(method, 0) + 1
+            chat_id = int(params.get("chat_id") or 0)
+            if method == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif method == "getWebhookInfo":
+                result = {"url": state["webhook_url"], "has_custom_certificate": False, "pending_update_count": 0}
+            elif method == "setWebhook":
+                state["webhook_url"] = params.get("url", "")
+                result = True
+            elif method == "sendMessage":
+                state["next_message_id"] += 1
+                messages[(chat_id, state["next_message_id"])] = params.get("text", "")
+                result = _message(chat_id, state["next_message_id"], params.get("text", ""))
+            elif method == "editMessageText":
+                message_id = int(params.get("message_id") or 0)
+                messages[(chat_id, message_id)] = params.get("text", "")
+                result = _message(chat_id, message_id, params.get("text", ""))
+            elif method == "getChat":
+                result = {"id": chat_id, "type": "private", "accent_color_id": 0, "max_reaction_count": 11}
+                if chat_id == OWNER_CHAT_ID:
+                    result["pinned_message"] = _message(chat_id, OWNER_MESSAGE_ID, messages[(chat_id, OWNER_MESSAGE_ID)])
+            else:
+                result = True # pinChatMessage, deleteMessage, sendChatAction...
+            self._reply(json.dumps({"ok": True, "result": result}).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fakes(args) -> tuple[multiprocessing.Process, str]:
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    process = context.Process(target=serve_fakes, daemon=True,
+                              args=(port_queue, args.bot_latency, args.moodle_latency, args.activities, args.moodle_churn))
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+
+def fetch_fake_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/_stats", timeout=5) as response:
+        return json.load(response)
+
+
+# --- Заглушка Gemini (в процессе бота, на месте модели SDK) ---
+
+class _Part:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Chunk:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.parts = [_Part(text)]
+        self.usage_metadata = type("Usage", (), {"prompt_token_count": prompt_tokens})()
+
+
+class _StreamedResponse:
+    prompt_feedback = None
+
+    def __init__(self, prompt: str, ttft: float, chunks: int, chunk_interval: float):
+        self.prompt, self.ttft, self.chunks, self.chunk_interval = prompt, ttft, chunks, chunk_interval
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.ttft)
+        prompt_tokens = len(self.prompt) // 4
+        for n in range(self.chunks):
+            if n:
+                await asyncio.sleep(self.chunk_interval)
+            yield _Chunk(f"Часть ответа {n + 1}: " + "текст " * 30, prompt_tokens)
+
+
+class FakeGeminiModel:
+    def __init__(self, ttft: float, chunks: int, chunk_interval: float):
+        self.ttft, self.chunks, self.chunk_interval = ttft, chunks, chunk_interval
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, stream=False, request_options=None):
+        self.calls += 1
+        return _StreamedResponse(prompt, self.ttft, self.chunks, self.chunk_interval)
+
+
+# --- Замеры ---
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p99/max в миллисекундах (nearest-rank)."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    rank = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"count": len(ordered), "p50_ms": round(rank(0.50) * 1000, 3), "p99_ms": round(rank(0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return 0.0
+
+
+class TimedApplication:
+    """Обертка Application для воркеров приема: время обработки каждого апдейта по видам."""
+
+    def __init__(self, application, kinds: dict[int, str], samples: dict[str, list]):
+        self._application = application
+        self.bot = application.bot
+        self._kinds = kinds
+        self._samples = samples
+
+    async def process_update(self, update):
+        started = time.perf_counter()
+        try:
+            await self._application.process_update(update)
+        finally:
+            self._samples[self._kinds.get(update.update_id, "other")].append(time.perf_counter() - started)
+
+
+class _ErrorCounter(logging.Handler):
+    """Ошибки в логах бота за прогон: ненулевое значение - результаты под вопросом."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def _update(update_id: int, chat_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+    }}
+
+
+def synthetic_updates(count: int, mix: dict[str, float], chats: int, seed: int) -> list[tuple[str, dict]]:
+    """Апдейты вебхука: задачи - в чат владельца, вопросы к AI - из `chats` разных чатов."""
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    today = date.today()
+    updates = []
+    for n in range(1, count + 1):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "add":
+            deadline = today + timedelta(days=rng.randint(3, 300))
+            payload = _update(n, OWNER_CHAT_ID, f"- Бенч задача {n} {deadline:%d.%m}")
+        elif kind == "remove":
+            payload = _update(n, OWNER_CHAT_ID, f"удали {rng.randint(1, 5)}")
+        else:
+            payload = _update(n, OWNER_CHAT_ID + 1 + n % chats, f"Вопрос номер {n}: что почитать к экзамену?")
+        updates.append((kind, payload))
+    return updates
+
+
+async def run_webhook(client, updates: list[tuple[str, dict]], concurrency: int, bot_module) -> dict:
+    """Шлет апдейты как Telegram: не больше `concurrency` соединений, 503 - повтор позже."""
+    ingress_latencies, rejected = [], 0
+    queue = list(reversed(updates))
+
+    async def sender():
+        nonlocal rejected
+        while queue:
+            _, payload = queue.pop()
+            while True:
+                started = time.perf_counter()
+                response = await client.post(f"/{WEBHOOK_SECRET}", content=json.dumps(payload, ensure_ascii=False).encode())
+                ingress_latencies.append(time.perf_counter() - started)
+                if response.status_code != 503:
+                    break
+                rejected += 1
+                await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    accepted_seconds = time.perf_counter() - started
+    await bot_module.update_ingress._queue.join() # Все апдейты обработаны воркерами
+    processed_seconds = time.perf_counter() - started
+    await bot_module.message_updates.flush_all()
+    return {
+        "updates": len(updates),
+        "accept_seconds": round(accepted_seconds, 3),
+        "process_seconds": round(processed_seconds, 3),
+        "throughput_updates_per_s": round(len(updates) / processed_seconds, 1),
+        "ingress_latency": percentiles(ingress_latencies),
+        "rejected_503": rejected,
+        "ingress_stats": dict(bot_module.update_ingress.stats),
+    }
+
+
+async def run_cron(client, ticks: int, bot_module) -> dict:
+    """Тики крона по очереди. Время тика включает фоновые задачи (напоминания, парсинг KSE, перерисовку)."""
+    latencies = []
+    for _ in range(ticks):
+        started = time.perf_counter()
+        response = await client.post(f"/check_reminders/{REMINDER_SECRET}")
+        await bot_module.message_updates.flush_all()
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"/check_reminders вернул {response.status_code}: {response.text}")
+    owner_store = bot_module.chat_registry.store(OWNER_CHAT_ID)
+    return {
+        "ticks": ticks,
+        "tick_latency": percentiles(latencies),
+        "owner_tasks_after": len(await owner_store.get_records(bot_module.application.bot)),
+        "kse_cache": dict(bot_module.homework_cache_stats),
+    }
+
+
+async def run(args, fakes_url: str, data_dir: str) -> dict:
+    os.environ.update({
+        "TOKEN": FAKE_TOKEN,
+        "DATA_DIR": data_dir,
+        "TELEGRAM_BASE_URL": f"{fakes_url}/bot",
+        "KSE_BASE_URL": fakes_url,
+        "KSE_COURSE_IDS": ",".join(str(3000 + n) for n in range(args.courses)),
+        "TARGET_CHAT_ID": str(OWNER_CHAT_ID),
+        "MESSAGE_ID_TO_EDIT": str(OWNER_MESSAGE_ID),
+        "REMINDER_SECRET": REMINDER_SECRET,
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "RENDER_EXTERNAL_URL": "https://bench.example",
+        "SCHEDULER_ENABLED": "0", # Крон дергаем сами
+    })
+    os.environ.pop("GEMINI_API_KEY", None)
+    os.environ.pop("MOODLE_SESSION_COOKIE", None)
+    sys.path.insert(0, REPO_DIR)
+
+    import httpx
+    import tg_part_laptop as bot_module
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+    error_counter = _ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+
+    bot_module.model = FakeGeminiModel(args.gemini_ttft, args.gemini_chunks, args.gemini_chunk_interval)
+    updates = synthetic_updates(args.updates, args.mix, args.chats, args.seed)
+    kinds = {payload["update_id"]: kind for kind, payload in updates}
+    samples: dict[str, list] = {kind: [] for kind in args.mix}
+    samples["other"] = []
+
+    results = {"memory": {"rss_after_import_mb": round(rss_mb(), 1)}}
+    transport = httpx.ASGITransport(app=bot_module.api)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        # Воркеры приема с оберткой-таймером; lifespan увидит, что они уже запущены
+        bot_module.update_ingress.start(TimedApplication(bot_module.application, kinds, samples))
+        async with bot_module.api.router.lifespan_context(bot_module.api):
+            if args.tracemalloc:
+                tracemalloc.start()
+            results["webhook"] = await run_webhook(client, updates, args.concurrency, bot_module)
+            results["webhook"]["processing"] = {kind: percentiles(values) for kind, values in samples.items() if values}
+            results["webhook"]["gemini_model_calls"] = bot_module.model.calls
+            results["cron"] = await run_cron(client, args.cron_ticks, bot_module)
+            results["memory"]["rss_end_mb"] = round(rss_mb(), 1)
+            if args.tracemalloc:
+                results["memory"]["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                tracemalloc.stop()
+    # ru_maxrss в Linux - в КБ
+    results["errors_logged"] = error_counter.count
+    results["memory"]["rss_max_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return results
+
+
+def _parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in ("add", "remove", "ask"):
+            raise argparse.ArgumentTypeError(f"неизвестный вид апдейта: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500, help="сколько апдейтов отправить в вебхук")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных запросов к вебхуку")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("add=0.6,remove=0.1,ask=0.3"),
+                        help="доли видов апдейтов, например add=0.6,remove=0.1,ask=0.3")
+    parser.add_argument("--chats", type=int, default=20, help="сколько разных чатов задают вопросы AI")
+    parser.add_argument("--cron-ticks", type=int, default=3)
+    parser.add_argument("--courses", type=int, default=4, help="курсов KSE на заглушке Moodle")
+    parser.add_argument("--activities", type=int, default=200, help="квизов на странице курса")
+    parser.add_argument("--moodle-churn", type=float, default=0.05, help="доля дедлайнов, сдвигающихся с каждым запросом")
+    parser.add_argument("--bot-latency", type=float, default=0.05, help="задержка заглушки Bot API, сек.")
+    parser.add_argument("--moodle-latency", type=float, default=0.3, help="задержка заглушки Moodle, сек.")
+    parser.add_argument("--gemini-ttft", type=float, default=0.8, help="время до первого токена Gemini, сек.")
+    parser.add_argument("--gemini-chunks", type=int, default=5)
+    parser.add_argument("--gemini-chunk-interval", type=float, default=0.2, help="между чанками Gemini, сек.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="пик аллокаций Python (замедляет прогон)")
+    parser.add_argument("--log-level", default="WARNING", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+    parser.add_argument("--output", help="файл для JSON вместо stdout")
+    args = parser.parse_args()
+
+    fakes, fakes_url = start_fakes(args)
+    try:
+        with tempfile.TemporaryDirectory() as data_dir:
+            started = time.perf_counter()
+            results = asyncio.run(run(args, fakes_url, data_dir))
+            results["wall_seconds"] = round(time.perf_counter() - started, 3)
+        results.update(fetch_fake_stats(fakes_url))
+    finally:
+        fakes.terminate()
+    results["config"] = {key: value for key, value in vars(args).items() if key != "output"}
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Микробенчмарк вебхука: запросов в секунду на POST /{WEBHOOK_SECRET} и p99 времени приема.
+
+Запросы идут напрямую в ASGI-приложение (httpx.ASGITransport), без сети и без Telegram;
+Application.process_update подменен пустышкой, так что меряется только путь приема:
+чтение тела, разбор JSON, отсев апдейтов без хэндлера и постановка в очередь.
+Два вида апдейтов: текстовое сообщение (идет в очередь) и стикер (отсекается до Update).
+
+    python benchmarks/ingress.py [--requests 3000]
+
+p99_request_us - время запроса целиком (со стороны клиента, вместе с ASGI-обвязкой),
+p99_ingress_us - то, что пишет сам обработчик (только для апдейтов, поставленных в очередь).
+
+Результат - JSON в stdout.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from startup import FAKE_TOKEN, REPO_DIR
+
+TEXT_UPDATE = {
+    "message": {
+        "message_id": 1, "date": 0,
+        "chat": {"id": 1, "type": "private", "first_name": "A"},
+        "from": {"id": 1, "is_bot": False, "first_name": "A"},
+        "text": "- Задача до 20.10 " + "x" * 200,
+    },
+}
+STICKER_UPDATE = {
+    "message": {
+        "message_id": 1, "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "sticker": {"file_id": "x" * 80, "file_unique_id": "y", "width": 512, "height": 512,
+                    "is_animated": False, "is_video": False, "type": "regular"},
+    },
+}
+
+
+async def _run(bot_module, payload: dict, requests: int, first_id: int) -> dict:
+    import httpx
+
+    bodies = [json.dumps(dict(payload, update_id=first_id + n)).encode() for n in range(requests)]
+    ingress = bot_module.update_ingress
+    ingress._latencies.clear()
+    statuses: dict[int, int] = {}
+    transport = httpx.ASGITransport(app=bot_module.api)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        timings = []
+        started = time.perf_counter()
+        for body in bodies:
+            sent = time.perf_counter()
+            response = await client.post(f"/{bot_module.URL_PATH}", content=body)
+            timings.append(time.perf_counter() - sent)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            await asyncio.sleep(0) # ASGITransport не отдает управление - даем воркерам разобрать очередь
+        elapsed = time.perf_counter() - started
+    timings.sort()
+    results = {
+        "requests_per_second": round(requests / elapsed),
+        "p99_request_us": round(timings[int(0.99 * (len(timings) - 1))] * 1e6, 1),
+        "statuses": statuses,
+    }
+    if ingress._latencies: # Отсеянные апдейты время приема не пишут
+        results["p99_ingress_us"] = round(ingress.latency_percentile(0.99) * 1e6, 1)
+    return results
+
+
+async def _bench(bot_module, requests: int) -> dict:
+    async def process_update(update):
+        pass
+
+    bot_module.application.process_update = process_update
+    bot_module.update_ingress.start(bot_module.application)
+    try:
+        results = {
+            "requests": requests,
+            "json_backend": "orjson" if bot_module.orjson is not None else "json",
+            "text": await _run(bot_module, TEXT_UPDATE, requests, 0),
+            "sticker": await _run(bot_module, STICKER_UPDATE, requests, requests),
+        }
+    finally:
+        await bot_module.update_ingress.stop()
+    results["ingress_stats"] = dict(bot_module.update_ingress.stats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=3000)
+    args = parser.parse_args()
+
+    os.environ.update({"TOKEN": FAKE_TOKEN, "DATA_DIR": tempfile.mkdtemp(prefix="bench_ingress_")})
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    import tg_part_laptop as bot_module
+    logging.getLogger().setLevel(logging.WARNING)
+    bot_module.logger.setLevel(logging.WARNING)
+
+    json.dump(asyncio.run(_bench(bot_module, args.requests)), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Бенчмарк парсера KSE: разбор страницы курса с --activities квизами (по умолчанию 500).
+
+Страница генерируется той же заглушкой Moodle, что и в harness.py; сеть не нужна.
+Меряются вырезание блока недель (он же ключ кэша), полный разбор `_extract_homework_tasks`
+и, для сравнения, прежний разбор на BeautifulSoup (если bs4 установлен).
+
+    python benchmarks/parser.py [--activities 500] [--runs 20]
+
+Результат - JSON в stdout.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from harness import _course_html
+from startup import FAKE_TOKEN, REPO_DIR
+
+
+def bs4_extract_homework_tasks(html: str) -> list[dict]:
+    """Прежний `_extract_homework_tasks` (BeautifulSoup, html.parser) - без изменений, кроме логирования ошибок."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    weeks_container = soup.find('ul', class_='weeks')
+    if not weeks_container:
+        return []
+
+    all_found_tasks = []
+    sections = weeks_container.find_all('li', class_='section', recursive=False)
+
+    for section in sections:
+        section_title_element = section.find('h3', class_='sectionname')
+        section_title = section_title_element.text.strip() if section_title_element else "Unknown Section"
+
+        tasks = section.find_all('li', class_='activity')
+        for task in tasks:
+            quiz_icon = task.find('img', alt='quiz icon')
+            if not quiz_icon: continue
+
+            task_name_element = task.find('span', class_='instancename')
+            if not task_name_element: continue
+
+            task_name_clone = BeautifulSoup(str(task_name_element), 'html.parser')
+            accesshide = task_name_clone.find('span', class_='accesshide')
+            if accesshide: accesshide.decompose()
+            task_name = task_name_clone.text.strip()
+
+            deadline_iso = None
+            dates_div = task.find('div', {'data-region': 'activity-dates'})
+            if dates_div:
+                date_lines = dates_div.find('div', class_='description-inner').find_all('div')
+                for line in date_lines:
+                    line_text = line.text.strip()
+                    if line_text.startswith(("Closed:", "Closes:", "Due:")):
+                        date_match = re.search(r'(\d{1,2}\s+\w+\s+\d{4})', line_text)
+                        if date_match:
+                            try:
+                                deadline_iso = datetime.strptime(date_match.group(1), '%d %B %Y').strftime('%Y-%m-%d')
+                            except ValueError:
+                                pass
+                        break
+
+            if deadline_iso:
+                all_found_tasks.append({"task": f"KSE: {task_name} ({section_title})", "deadline": deadline_iso})
+
+    return all_found_tasks
+
+
+def _timed(fn, runs: int) -> list[float]:
+    fn() # Прогрев
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--activities", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.update({"TOKEN": FAKE_TOKEN, "DATA_DIR": tempfile.mkdtemp(prefix="bench_parser_")})
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    import tg_part_laptop as bot_module
+    logging.getLogger().setLevel(logging.WARNING)
+
+    html = _course_html(3162, args.activities, generation=1, churn=0)
+    tasks = bot_module._extract_homework_tasks(html, "3162")
+    results = {"activities": args.activities, "runs": args.runs, "page_bytes": len(html.encode()), "tasks_found": len(tasks)}
+    benchmarks = [("weeks_fragment", lambda: bot_module._weeks_fragment(html)),
+                  ("extract_tasks", lambda: bot_module._extract_homework_tasks(html, "3162"))]
+    try:
+        import bs4 # noqa: F401
+    except ImportError:
+        results["extract_tasks_bs4"] = None # Прежний парсер не с чем запустить
+    else:
+        # Та же выдача, что у прежнего парсера (он не знал ID модулей)
+        results["same_as_bs4"] = bs4_extract_homework_tasks(html) == [
+            {"task": task["task"], "deadline": task["deadline"]} for task in tasks]
+        benchmarks.append(("extract_tasks_bs4", lambda: bs4_extract_homework_tasks(html)))
+    for name, fn in benchmarks:
+        timings = _timed(fn, args.runs)
+        results[name] = {"median_ms": round(statistics.median(timings) * 1000, 3), "min_ms": round(min(timings) * 1000, 3)}
+    if results.get("extract_tasks_bs4"):
+        results["speedup"] = round(results["extract_tasks_bs4"]["median_ms"] / results["extract_tasks"]["median_ms"], 1)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
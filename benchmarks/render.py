@@ -0,0 +1,85 @@
+"""
+Бенчмарк отрисовки списка задач: --tasks записей (по умолчанию 1000) с дедлайнами и без.
+
+Меряются: первая отрисовка (все строки с нуля), повторная (строки из кэша записей),
+вставка одной задачи в отсортированное хранилище + перерисовка, и разбиение на страницы.
+
+    python benchmarks/render.py [--tasks 1000] [--runs 50]
+
+Результат - JSON в stdout.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from startup import FAKE_TOKEN, REPO_DIR
+
+
+def _median_ms(fn, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench_render_")
+    os.environ.update({"TOKEN": FAKE_TOKEN, "DATA_DIR": data_dir})
+    sys.path.insert(0, REPO_DIR)
+    import logging
+    import tg_part_laptop as bot_module
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rng = random.Random(1)
+    today = date.today()
+    tasks = [{"task": f"Задача {n}", "deadline": (today + timedelta(days=rng.randint(-5, 60))).isoformat() if rng.random() < 0.8 else None}
+             for n in range(args.tasks)]
+
+    def fresh_records():
+        return sorted((bot_module.TaskRecord.from_dict(task) for task in tasks), key=bot_module.TaskRecord.sort_key)
+
+    records = fresh_records()
+    cold = []
+    for _ in range(args.runs):
+        records = fresh_records() # Без кэша строк
+        started = time.perf_counter()
+        bot_module.render_tasks_text(records)
+        cold.append(time.perf_counter() - started)
+
+    store = bot_module.TaskStore(7, 1, os.path.join(data_dir, "tasks", "7.json"))
+    store._replace(tasks)
+    counter = iter(range(10**9))
+
+    def insert_and_render():
+        store._insert([bot_module.TaskRecord(f"Новая {next(counter)}", today + timedelta(days=rng.randint(0, 60)))])
+        bot_module.render_tasks_text(store._records)
+
+    bot_module.render_tasks_text(store._records)
+    results = {
+        "tasks": args.tasks,
+        "runs": args.runs,
+        "render_cold_ms": round(statistics.median(cold) * 1000, 3),
+        "render_cached_ms": _median_ms(lambda: bot_module.render_tasks_text(records), args.runs),
+        "insert_and_render_ms": _median_ms(insert_and_render, args.runs),
+        "render_pages_ms": _median_ms(lambda: bot_module.render_task_pages(records), args.runs),
+        "pages": len(bot_module.render_task_pages(records)),
+    }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
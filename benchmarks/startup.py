@@ -0,0 +1,163 @@
+"""
+Бенчмарк холодного старта: время импорта модуля и время до первого 200 на /health.
+
+Bot API подменяется локальной заглушкой (с задержкой как у настоящего RTT), поэтому
+бенчмарк работает без сети и без настоящего токена. Два прогона на одном DATA_DIR:
+"cold" - без снимков, "warm" - со снимком вебхука и задач, оставшимся от первого прогона.
+
+    python benchmarks/startup.py [--api-latency 0.15] [--runs 3]
+
+Результат - JSON в stdout.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_TOKEN = "123456:benchmark"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotApi:
+    """Минимальный Bot API: getMe, getWebhookInfo, setWebhook. Считает вызовы по методам."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.webhook_url = ""
+        self.calls: dict[str, int] = {}
+        self.port = _free_port()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                time.sleep(api.latency)
+                api.calls[method] = api.calls.get(method, 0) + 1 # Считаем завершенные вызовы
+                if method == "getMe":
+                    result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+                elif method == "getWebhookInfo":
+                    result = {"url": api.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+                elif method == "setWebhook":
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        params = json.loads(body or b"{}")
+                    else:
+                        params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+                    api.webhook_url = params.get("url", api.webhook_url)
+                    result = True
+                else:
+                    result = True
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                try:
+                    self.wfile.write(payload)
+                except BrokenPipeError:
+                    pass # Сервер бота уже остановлен
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+
+def _env(data_dir: str, api: FakeBotApi) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TOKEN": FAKE_TOKEN,
+        "DATA_DIR": data_dir,
+        "TELEGRAM_BASE_URL": api.base_url,
+        "RENDER_EXTERNAL_URL": "https://bench.example",
+        "SCHEDULER_ENABLED": "0",
+        "PYTHONDONTWRITEBYTECODE": "1",
+    })
+    env.pop("GEMINI_API_KEY", None)
+    return env
+
+
+def measure_import(env: dict) -> float:
+    code = "import time; t = time.perf_counter(); import tg_part_laptop; print(time.perf_counter() - t)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def measure_first_200(env: dict, api: FakeBotApi, timeout: float = 30.0) -> tuple[float, dict]:
+    """Время от запуска uvicorn до первого 200 на /health и вызовы Bot API, сделанные до него."""
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "tg_part_laptop:api", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started, dict(api.calls)
+            except OSError:
+                pass
+            time.sleep(0.005)
+        raise TimeoutError(f"/health не ответил 200 за {timeout} сек.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-latency", type=float, default=0.15, help="задержка ответа заглушки Bot API, сек.")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.api_latency)
+    results = {"api_latency": args.api_latency, "runs": args.runs}
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = _env(data_dir, api)
+        results["import_seconds"] = statistics.median(measure_import(env) for _ in range(args.runs))
+        for mode in ("cold", "warm"):
+            timings = []
+            calls = {}
+            for _ in range(args.runs):
+                if mode == "cold":
+                    for name in os.listdir(data_dir):
+                        path = os.path.join(data_dir, name)
+                        if os.path.isfile(path):
+                            os.remove(path)
+                    api.webhook_url = ""
+                api.calls.clear()
+                first_200, calls = measure_first_200(env, api)
+                timings.append(first_200)
+            results[mode] = {
+                "first_200_seconds": statistics.median(timings),
+                "bot_api_calls_before_200": calls, # последнего прогона
+            }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Общая настройка тестов. Модуль бота читает окружение при импорте, поэтому
+переменные задаются здесь - до того, как тесты импортируют `tg_part_laptop`.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+os.environ.update({
+    "TOKEN": "123456:test",
+    "DATA_DIR": tempfile.mkdtemp(prefix="gods_slave_tests_"), # Не трогаем state.json в репозитории
+    "SCHEDULER_ENABLED": "0",
+    "MESSAGE_EDIT_DEBOUNCE": "0.05",
+})
+for name in ("TARGET_CHAT_ID", "MESSAGE_ID_TO_EDIT", "GEMINI_API_KEY", "RENDER_EXTERNAL_URL", "MOODLE_SESSION_COOKIE"):
+    os.environ.pop(name, None)
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """Заглушка модели Gemini и чистые шлюз, кэш и таблица запросов в полете (размеры - из настроек модуля)."""
+    import tg_part_laptop as bot_module
+    from fakes import FakeGeminiModel
+
+    stub = FakeGeminiModel()
+    monkeypatch.setattr(bot_module, "model", stub)
+    monkeypatch.setattr(bot_module, "gemini_gateway", bot_module.GeminiGateway(
+        bot_module.GEMINI_MAX_CONCURRENCY, bot_module.GEMINI_MAX_QUEUE,
+        bot_module.GEMINI_BREAKER_THRESHOLD, bot_module.GEMINI_BREAKER_COOLDOWN))
+    monkeypatch.setattr(bot_module, "gemini_cache", bot_module.GeminiResponseCache(
+        bot_module.GEMINI_CACHE_TTL, bot_module.GEMINI_CACHE_MAX_ENTRIES, bot_module.GEMINI_CACHE_MAX_BYTES))
+    monkeypatch.setattr(bot_module, "_gemini_in_flight", {})
+    monkeypatch.setattr(bot_module, "_gemini_call_tasks", set())
+    return stub
@@ -0,0 +1,129 @@
+"""Заглушки для тестов: Bot без сети, модель Gemini и генератор страниц курса Moodle."""
+import asyncio
+import itertools
+import types
+from datetime import date
+
+MONTHS = ("January", "February", "March", "April", "May", "June", "July",
+          "August", "September", "October", "November", "December")
+
+
+class FakeBot:
+    """Минимальный Bot: запоминает отправленные и отредактированные сообщения."""
+
+    def __init__(self, pinned_text: str | None = None, pinned_message_id: int = 1, delay: float = 0.0):
+        self.delay = delay
+        self.pinned_text = pinned_text
+        self.pinned_message_id = pinned_message_id
+        self.edits: list[tuple[int, int, str]] = []
+        self.sent: list[tuple[int, str]] = []
+        self.pins: list[tuple[int, int]] = []
+        self.messages: dict[tuple[int, int], str] = {}
+        self._message_ids = itertools.count(100)
+
+    async def get_chat(self, chat_id):
+        await asyncio.sleep(self.delay)
+        pinned = None
+        if self.pinned_text is not None:
+            pinned = types.SimpleNamespace(message_id=self.pinned_message_id, text=self.pinned_text)
+        return types.SimpleNamespace(id=chat_id, pinned_message=pinned)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        message_id = next(self._message_ids)
+        self.sent.append((chat_id, text))
+        self.messages[(chat_id, message_id)] = text
+        return FakeMessage(self, chat_id, message_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.edits.append((chat_id, message_id, text))
+        self.messages[(chat_id, message_id)] = text
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        self.pins.append((chat_id, message_id))
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, message_id: int, text: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.chat = types.SimpleNamespace(id=chat_id, type="private")
+        self.from_user = types.SimpleNamespace(id=chat_id)
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+        self.text = text
+
+    async def delete(self):
+        pass
+
+
+def make_update(bot: FakeBot, chat_id: int, text: str, message_id: int = 1):
+    """Update с текстовым сообщением - то, что читают хэндлеры бота."""
+    message = FakeMessage(bot, chat_id, message_id, text)
+    return types.SimpleNamespace(update_id=message_id, message=message, effective_message=message,
+                                 effective_chat=message.chat, effective_user=message.from_user)
+
+
+def make_context(bot: FakeBot):
+    return types.SimpleNamespace(bot=bot)
+
+
+def course_html(activities: int, deadline: date, course_id: int = 1) -> str:
+    """Страница курса Moodle с квизами в разметке, которую разбирает парсер KSE."""
+    parts = ['<html><body><ul class="weeks">']
+    for section in range(0, activities, 10):
+        parts.append(f'<li class="section main"><h3 class="sectionname">Week {section // 10 + 1}</h3><ul class="section">')
+        for module in range(section, min(section + 10, activities)):
+            parts.append(
+                f'<li class="activity quiz" id="module-{course_id * 100000 + module}">'
+                f'<img alt="quiz icon"><span class="instancename">Quiz {module}<span class="accesshide"> Quiz</span></span>'
+                f'<div data-region="activity-dates"><div class="description-inner">'
+                f'<div>Closes: {deadline.day} {MONTHS[deadline.month - 1]} {deadline.year}, 23:59</div>'
+                f'</div></div></li>')
+        parts.append('</ul></li>')
+    parts.append('</ul></body></html>')
+    return "".join(parts)
+
+
+class FakeGeminiModel:
+    """Потоковая модель с задержкой: считает вызовы по промптам и пиковую параллельность."""
+
+    def __init__(self, latency: float = 0.0, chunks: int = 2):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls: list[str] = []
+        self.active = 0
+        self.peak = 0
+
+    async def generate_content_async(self, prompt, stream=False, request_options=None):
+        self.calls.append(prompt)
+        return _FakeGeminiResponse(self, prompt)
+
+
+class _FakeGeminiResponse:
+    prompt_feedback = None
+
+    def __init__(self, model: FakeGeminiModel, prompt: str):
+        self.model = model
+        self.prompt = prompt
+
+    async def __aiter__(self):
+        self.model.active += 1
+        self.model.peak = max(self.model.peak, self.model.active)
+        try:
+            for n in range(self.model.chunks):
+                await asyncio.sleep(self.model.latency / self.model.chunks)
+                part = types.SimpleNamespace(text=f"Ответ на '{self.prompt}' ({n + 1}). ")
+                yield types.SimpleNamespace(parts=[part], usage_metadata=None)
+        finally:
+            self.model.active -= 1
@@ -0,0 +1,62 @@
+"""Реестр чатов: что побеждает - запись /setup или TARGET_CHAT_ID/MESSAGE_ID_TO_EDIT."""
+import asyncio
+import json
+
+import pytest
+
+import tg_part_laptop as bot_module
+from fakes import FakeBot, make_context, make_update
+
+OWNER = 7001
+OWNER_LIST = "📋 *Список задач:*\n1. из закрепленного\n"
+
+
+@pytest.fixture
+def owner_env(monkeypatch):
+    monkeypatch.setattr(bot_module, "OWNER_CHAT_ID", OWNER)
+    monkeypatch.setattr(bot_module, "TARGET_CHAT_ID", str(OWNER))
+    monkeypatch.setattr(bot_module, "MESSAGE_ID_TO_EDIT", "61")
+
+
+def _registry(tmp_path):
+    return bot_module.ChatRegistry(str(tmp_path / "state.json"), str(tmp_path / "tasks"))
+
+
+def test_env_owner_without_setup(tmp_path, owner_env):
+    assert _registry(tmp_path).get(OWNER).message_id == 61
+
+
+def test_setup_wins_over_env_after_restart(tmp_path, owner_env):
+    registry = _registry(tmp_path)
+    asyncio.run(registry.store(OWNER).load(FakeBot(OWNER_LIST, pinned_message_id=61)))
+    registry.register(OWNER, 500).add(bot_module.TaskRecord("после /setup"))
+
+    restarted = _registry(tmp_path)
+    assert restarted.get(OWNER).message_id == 500
+    # Файл задач привязан к новому сообщению и принимается без чтения сообщения
+    assert restarted.store(OWNER).load_snapshot()
+    assert [record.name for record in restarted.store(OWNER)._records] == ["из закрепленного", "после /setup"]
+
+
+def test_register_refuses_unloaded_list(tmp_path, owner_env):
+    with pytest.raises(RuntimeError):
+        _registry(tmp_path).register(OWNER, 500)
+
+
+def test_setup_keeps_env_owner_tasks_and_pages(tmp_path, owner_env, monkeypatch):
+    registry = _registry(tmp_path)
+    monkeypatch.setattr(bot_module, "chat_registry", registry)
+    registry.get(OWNER).page_message_ids.append(62)
+    bot = FakeBot(OWNER_LIST, pinned_message_id=61)
+
+    asyncio.run(bot_module.setup(make_update(bot, OWNER, "/setup"), make_context(bot)))
+
+    chat = registry.get(OWNER)
+    assert chat.message_id != 61 and bot.pins == [(OWNER, chat.message_id)]
+    assert chat.page_message_ids == [62]
+    assert "из закрепленного" in bot.messages[(OWNER, chat.message_id)]
+
+
+def test_env_wins_over_legacy_state_file(tmp_path, owner_env):
+    (tmp_path / "state.json").write_text(json.dumps({"chat_id": OWNER, "message_id": 5}))
+    assert _registry(tmp_path).get(OWNER).message_id == 61
@@ -0,0 +1,47 @@
+"""Разбор дедлайна из текста задачи: относительные фразы и слова, похожие на дни недели."""
+from datetime import date
+
+import pytest
+
+import tg_part_laptop as bot_module
+
+TODAY = date(2026, 10, 17) # Суббота
+
+
+@pytest.mark.parametrize("text", [
+    "настроить среду разработки",
+    "установить виртуальную среду venv",
+    "Москва среда обитания",
+    "Среднее значение",
+    "Пятничный созвон",
+    "Вторник-ресторан обзор",
+    # Предлог есть, но падеж не тот (или предлог не временной)
+    "Настроить окружение в среде разработки",
+    "Тесты в среде staging",
+    "Отчет о среде",
+    "Поговорить о пятнице",
+    "настроить среду", # В конце текста - только именительный падеж
+])
+def test_weekday_word_inside_text_is_not_a_date(text):
+    assert bot_module.parse_date_from_text(text, TODAY) == (text, None)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Квиз в субботу", ("Квиз", "2026-10-24")),
+    ("Тест в пятницу", ("Тест", "2026-10-23")),
+    ("во вторник семинар", ("семинар", "2026-10-20")),
+    ("до понедельника проект", ("проект", "2026-10-19")),
+    ("Лаба к среде", ("Лаба", "2026-10-21")),
+    ("Эссе к понедельнику", ("Эссе", "2026-10-19")),
+    ("Проект до среды", ("Проект", "2026-10-21")),
+    ("Квиз на воскресенье", ("Квиз", "2026-10-18")),
+    ("на среду отчет", ("отчет", "2026-10-21")),
+    ("Квиз пятница", ("Квиз", "2026-10-23")),
+    ("Сдать эссе завтра", ("Сдать эссе", "2026-10-18")),
+    ("на послезавтра квиз", ("квиз", "2026-10-19")),
+    ("Лаба через 3 дня", ("Лаба", "2026-10-20")),
+    ("Отчет через 2 недели", ("Отчет", "2026-10-31")),
+    ("Лаба в среду 20.10", ("Лаба в среду", "2026-10-20")), # Числовая дата важнее
+])
+def test_relative_phrases(text, expected):
+    assert bot_module.parse_date_from_text(text, TODAY) == expected
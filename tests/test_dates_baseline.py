@@ -0,0 +1,73 @@
+"""
+Сравнение с прежним `parse_date_from_text` (три re.search + strptime) на случайных текстах.
+Для числовых дат новый однопроходный разбор должен давать ровно тот же результат.
+"""
+import re
+from datetime import date, datetime
+
+import pytest
+
+import tg_part_laptop as bot_module
+
+hypothesis = pytest.importorskip("hypothesis")
+from hypothesis import given, settings, strategies as st
+
+# Прежняя реализация как есть, только "сегодня" передается явно вместо datetime.now()
+def baseline_parse_date_from_text(text: str, today: date) -> (str, str):
+    date_obj = None
+    task_text = text
+    match = re.search(r'(\d{1,2}\.\d{1,2}\.\d{4})', text)
+    if match:
+        date_str = match.group(1)
+        try:
+            date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
+            task_text = text.replace(date_str, "").strip()
+        except ValueError: pass
+    if not date_obj:
+        match = re.search(r'(\d{1,2}\.\d{1,2}\.\d{2})', text)
+        if match:
+            date_str = match.group(1)
+            try:
+                date_obj = datetime.strptime(date_str, "%d.%m.%y").date()
+                task_text = text.replace(date_str, "").strip()
+            except ValueError: pass
+    if not date_obj:
+        match = re.search(r'(\d{1,2}\.\d{1,2})', text)
+        if match:
+            date_str = match.group(1)
+            try:
+                current_year = today.year
+                date_obj = datetime.strptime(f"{date_str}.{current_year}", "%d.%m.%Y").date()
+                if date_obj < today:
+                    date_obj = datetime.strptime(f"{date_str}.{current_year + 1}", "%d.%m.%Y").date()
+                task_text = text.replace(date_str, "").strip()
+            except ValueError: pass
+    if date_obj:
+        return task_text.strip(), date_obj.strftime("%Y-%m-%d")
+    return text.strip(), None
+
+
+def _number(max_value: int):
+    return st.integers(0, max_value).flatmap(lambda n: st.sampled_from([str(n), str(n).zfill(2)]))
+
+
+# Слова без относительных фраз ("завтра", "в пятницу") - прежний разбор их не знал
+_words = st.sampled_from(["Сдать", "лабу", "Quiz", "(x)", "-", "эссе", "до", "1", "12.", "123.45.6789", "1.2.3", "..", " "])
+_dates = st.one_of(
+    st.tuples(_number(35), _number(14), st.integers(0, 2100)).map(lambda p: f"{p[0]}.{p[1]}.{p[2]:04d}"),
+    st.tuples(_number(35), _number(14), st.integers(0, 99)).map(lambda p: f"{p[0]}.{p[1]}.{p[2]:02d}"),
+    st.tuples(_number(35), _number(14)).map(lambda p: f"{p[0]}.{p[1]}"),
+    st.sampled_from(["29.02", "29.02.24", "31.1.20251", "1.123.2025", "29.0225.11"]),
+)
+_texts = st.one_of(
+    st.text(alphabet="0123456789. ab", max_size=24),
+    st.lists(st.one_of(_dates, _words), min_size=1, max_size=5).flatmap(
+        lambda parts: st.sampled_from([" ", ""]).map(lambda sep: sep.join(parts))),
+)
+_todays = st.sampled_from([date(2026, 10, 17), date(2028, 3, 5), date(2028, 2, 29), date(2027, 1, 1), date(2024, 12, 31)])
+
+
+@settings(max_examples=500, deadline=None)
+@given(text=_texts, today=_todays)
+def test_matches_baseline(text, today):
+    assert bot_module.parse_date_from_text(text, today) == baseline_parse_date_from_text(text, today)
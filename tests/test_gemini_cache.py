@@ -0,0 +1,54 @@
+"""Кэш ответов Gemini: TTL, вытеснение по числу записей и байтам, склейка одинаковых вопросов."""
+import asyncio
+import time
+
+import tg_part_laptop as bot_module
+
+
+def test_entries_expire_after_ttl():
+    cache = bot_module.GeminiResponseCache(ttl=0.05, max_entries=10, max_bytes=1024)
+    cache.put("вопрос", "ответ")
+    assert cache.get("вопрос") == "ответ"
+    time.sleep(0.06)
+    assert cache.get("вопрос") is None
+    assert len(cache) == 0 and cache.size_bytes == 0
+    assert cache.stats["expired"] == 1
+
+
+def test_least_recently_used_entry_is_evicted_by_count():
+    cache = bot_module.GeminiResponseCache(ttl=60, max_entries=2, max_bytes=1024)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1" # "a" теперь свежее "b"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("1", "3")
+    assert cache.stats["evictions"] == 1
+
+
+def test_entries_are_evicted_by_byte_cap():
+    cache = bot_module.GeminiResponseCache(ttl=60, max_entries=10, max_bytes=10)
+    cache.put("a", "ыы") # 4 байта в UTF-8
+    cache.put("b", "ыы")
+    cache.put("c", "ыы")
+    assert cache.get("a") is None and cache.size_bytes == 8
+    cache.put("big", "x" * 11) # Больше всего кэша - не хранится и никого не вытесняет
+    assert cache.get("big") is None and len(cache) == 2
+
+
+def test_identical_prompts_in_flight_share_one_model_call(fake_gemini):
+    fake_gemini.latency = 0.1
+
+    async def scenario():
+        first, _ = bot_module.get_gemini_call("Что такое  LRU?")
+        second, _ = bot_module.get_gemini_call("что такое lru?") # Регистр и пробелы не важны
+        await asyncio.gather(*bot_module._gemini_call_tasks)
+        third = bot_module.get_gemini_call("Что такое LRU?")
+        return first, second, third
+
+    first, second, (third_call, cached) = asyncio.run(scenario())
+
+    assert first is second
+    assert len(fake_gemini.calls) == 1
+    assert third_call is None and cached == first.answer # Готовый ответ - из кэша, без модели
+    assert bot_module.gemini_cache.stats["coalesced"] == 1
@@ -0,0 +1,93 @@
+"""Шлюз Gemini: предел параллельности под нагрузкой; предохранитель замыкает только пробный запрос."""
+import asyncio
+import time
+
+import pytest
+
+import tg_part_laptop as bot_module
+
+
+def _tripped_gateway():
+    gateway = bot_module.GeminiGateway(max_concurrency=4, max_queue=4, threshold=2, cooldown=60)
+    admissions = [gateway.admit() for _ in range(3)]
+    gateway.record_failure(admissions[0])
+    gateway.record_failure(admissions[1], timed_out=True)
+    assert gateway.state == "open"
+    return gateway, admissions[2]
+
+
+def test_late_success_does_not_close_open_breaker():
+    gateway, late = _tripped_gateway()
+
+    gateway.record_success(late)
+    gateway.release(late)
+
+    assert gateway.state == "open"
+    with pytest.raises(bot_module.GeminiUnavailable):
+        gateway.admit()
+
+
+def test_late_failure_does_not_extend_cooldown():
+    gateway, late = _tripped_gateway()
+    opened_until = gateway._opened_until
+
+    gateway.record_failure(late)
+
+    assert gateway._opened_until == opened_until
+    assert gateway.stats["trips"] == 1
+
+
+def test_probe_success_closes_breaker():
+    gateway, late = _tripped_gateway()
+    gateway._opened_until = 0
+
+    probe = gateway.admit()
+    assert probe.probe and gateway.state == "half_open"
+    with pytest.raises(bot_module.GeminiUnavailable):
+        gateway.admit() # Пока идет проба - остальные отклоняются
+    gateway.record_success(late) # Опоздавший ответ до пробы ничего не решает
+    assert gateway.state == "half_open"
+    gateway.record_success(probe)
+    gateway.release(probe)
+
+    assert gateway.state == "closed"
+    assert not gateway.admit().probe
+
+
+def test_probe_failure_reopens_breaker():
+    gateway, _ = _tripped_gateway()
+    gateway._opened_until = 0
+
+    probe = gateway.admit()
+    gateway.record_failure(probe)
+    gateway.release(probe)
+
+    assert gateway.state == "open"
+    assert gateway.stats["trips"] == 2
+
+
+def test_load_respects_concurrency_and_rejects_overflow_immediately(fake_gemini):
+    fake_gemini.latency = 0.3
+    capacity = bot_module.GEMINI_MAX_CONCURRENCY + bot_module.GEMINI_MAX_QUEUE
+    overflow = 10
+
+    async def scenario():
+        calls, rejections = [], []
+        for n in range(capacity + overflow):
+            started = time.perf_counter()
+            try:
+                call, cached = bot_module.get_gemini_call(f"вопрос {n}")
+                calls.append(call)
+            except bot_module.GeminiOverloaded:
+                rejections.append(time.perf_counter() - started)
+        await asyncio.gather(*bot_module._gemini_call_tasks)
+        return calls, rejections
+
+    calls, rejections = asyncio.run(scenario())
+
+    assert len(calls) == capacity and len(rejections) == overflow
+    assert max(rejections) < 0.01 # Отказ сразу, без ожидания слота
+    assert fake_gemini.peak == bot_module.GEMINI_MAX_CONCURRENCY
+    assert all(call.finished and call.error is None and call.answer for call in calls)
+    assert bot_module.gemini_gateway.pending == 0
+    assert bot_module.gemini_gateway.stats["rejected_overload"] == overflow
@@ -0,0 +1,54 @@
+"""Потоковый ответ Gemini: финальная правка выжидает лимит и не оставляет курсор."""
+import asyncio
+import time
+
+from telegram import error
+
+import tg_part_laptop as bot_module
+from fakes import FakeBot
+
+
+class ThrottlingBot(FakeBot):
+    """Первая правка после промежуточной получает 429, как у Telegram при частых правках."""
+
+    def __init__(self, throttle_edits: int):
+        super().__init__()
+        self.throttle_edits = throttle_edits
+        self.edit_times: list[float] = []
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edit_times.append(time.monotonic())
+        if len(self.edit_times) > 1 and self.throttle_edits:
+            self.throttle_edits -= 1
+            raise error.RetryAfter(0.2)
+        await super().edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+
+
+def _stream(bot: FakeBot, monkeypatch):
+    monkeypatch.setattr(bot_module, "GEMINI_STREAM_EDIT_INTERVAL", 0.3)
+
+    async def scenario():
+        waiting = await bot.send_message(5, "🤔 Думаю...")
+        reply = bot_module.StreamingReply(bot, 5, waiting)
+        await reply.update("Первая часть")
+        await reply.update("Первая часть и вторая", final=True)
+        return waiting.message_id
+
+    return asyncio.run(scenario())
+
+
+def test_final_edit_waits_for_edit_window(monkeypatch):
+    bot = ThrottlingBot(throttle_edits=0)
+    message_id = _stream(bot, monkeypatch)
+    assert bot.messages[(5, message_id)] == "Первая часть и вторая"
+    assert bot.edit_times[1] - bot.edit_times[0] >= 0.29
+
+
+def test_final_edit_retries_after_retry_after(monkeypatch):
+    bot = ThrottlingBot(throttle_edits=2)
+    message_id = _stream(bot, monkeypatch)
+    final_text = bot.messages[(5, message_id)]
+    assert final_text == "Первая часть и вторая"
+    assert not final_text.endswith(bot_module.STREAM_CURSOR)
+    assert len(bot.edit_times) == 4 # промежуточная, две с 429, финальная
+    assert all(later - earlier >= 0.19 for earlier, later in zip(bot.edit_times[1:], bot.edit_times[2:]))
@@ -0,0 +1,91 @@
+"""Парсинг KSE идет в фоне и не блокирует обработку вебхука (медленный локальный Moodle)."""
+import asyncio
+import json
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import tg_part_laptop as bot_module
+from fakes import course_html
+
+MOODLE_DELAY = 1.0 # сек. на ответ - как у медленного Moodle
+
+
+@pytest.fixture
+def slow_moodle():
+    page = course_html(500, date.today() + timedelta(days=10)).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(MOODLE_DELAY)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+class _NoopApplication:
+    bot = None
+
+    async def process_update(self, update):
+        pass
+
+
+def _text_update(update_id: int) -> bytes:
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "- задача 20.10",
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "T"},
+    }}).encode()
+
+
+def test_webhook_stays_responsive_during_slow_parse(slow_moodle, monkeypatch):
+    course_ids = ["901", "902"]
+    monkeypatch.setattr(bot_module, "KSE_COURSE_IDS", course_ids)
+    monkeypatch.setattr(bot_module, "HOMEWORK_URLS", [f"{slow_moodle}/course/view.php?id={c}" for c in course_ids])
+
+    async def scenario():
+        bot_module.update_ingress.start(_NoopApplication())
+        transport = httpx.ASGITransport(app=bot_module.api)
+        webhook_latencies, loop_lags = [], []
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                parse_started = time.perf_counter()
+                parse = asyncio.create_task(bot_module.parse_homework())
+                update_id = 0
+                while not parse.done():
+                    update_id += 1
+                    started = time.perf_counter()
+                    response = await client.post(f"/{bot_module.URL_PATH}", content=_text_update(update_id))
+                    webhook_latencies.append(time.perf_counter() - started)
+                    assert response.status_code == 200
+                    started = time.perf_counter()
+                    await asyncio.sleep(0.01)
+                    loop_lags.append(time.perf_counter() - started - 0.01)
+                snapshot = await parse
+                parse_seconds = time.perf_counter() - parse_started
+        finally:
+            await bot_module.update_ingress.stop()
+            await bot_module.close_http_client()
+        return snapshot, parse_seconds, webhook_latencies, loop_lags
+
+    snapshot, parse_seconds, webhook_latencies, loop_lags = asyncio.run(scenario())
+    assert len(snapshot.tasks) == 1000
+    assert snapshot.fetched_courses == set(course_ids)
+    # Курсы качаются параллельно: ~одна задержка Moodle, а не две
+    assert MOODLE_DELAY <= parse_seconds < 2 * MOODLE_DELAY
+    assert len(webhook_latencies) > 20
+    assert max(webhook_latencies) < 0.2
+    assert max(loop_lags) < 0.2
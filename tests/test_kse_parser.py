@@ -0,0 +1,34 @@
+"""
+Парсер KSE на lxml дает то же, что прежний парсер на BeautifulSoup.
+Ожидаемые course_N.json сохранены из прежнего `_extract_homework_tasks` на тех же страницах.
+"""
+import json
+import pathlib
+
+import pytest
+
+import tg_part_laptop as bot_module
+
+FIXTURES = pathlib.Path(__file__).parent / "fixtures" / "kse"
+PAGES = sorted(FIXTURES.glob("course_*.html"))
+
+
+@pytest.mark.parametrize("page", PAGES, ids=lambda path: path.stem)
+def test_matches_previous_parser(page):
+    expected = json.loads(page.with_suffix(".json").read_text(encoding="utf-8"))
+    tasks = bot_module._extract_homework_tasks(page.read_text(encoding="utf-8"), "42")
+    assert [{"task": task["task"], "deadline": task["deadline"]} for task in tasks] == expected
+
+
+def test_task_ids_come_from_module_ids():
+    html = PAGES[0].read_text(encoding="utf-8")
+    tasks = bot_module._extract_homework_tasks(html, "42")
+    assert tasks and all(task["id"].startswith("kse:42:1000") for task in tasks)
+    assert len({task["id"] for task in tasks}) == len(tasks)
+
+
+def test_weeks_hash_ignores_page_chrome():
+    html = PAGES[1].read_text(encoding="utf-8")
+    changed_header = html.replace("sesskey=", "sesskey=0")
+    assert bot_module._weeks_fragment(html) == bot_module._weeks_fragment(changed_header)
+    assert bot_module._weeks_fragment(html).count("<li class=\"section") == 8
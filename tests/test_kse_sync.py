@@ -0,0 +1,42 @@
+"""Слияние прохода парсера KSE со списком чата: задачи различаются по ID, а не по названию."""
+import os
+import tempfile
+
+import tg_part_laptop as bot_module
+
+SAME_NAME = "KSE: Quiz 1 (Week 1)"
+
+
+def _snapshot(*tasks: dict) -> bot_module.HomeworkSnapshot:
+    return bot_module.HomeworkSnapshot(tasks=list(tasks), seen_ids={task["id"] for task in tasks},
+                                       fetched_courses={"A", "B"})
+
+
+def _store(chat_id: int) -> bot_module.TaskStore:
+    store = bot_module.TaskStore(chat_id, 1, os.path.join(tempfile.mkdtemp(), f"{chat_id}.json"))
+    store.start_empty()
+    return store
+
+
+def test_same_name_from_different_courses_is_kept():
+    store = _store(21001)
+    snapshot = _snapshot({"task": SAME_NAME, "deadline": "2027-01-10", "id": "kse:A:1"},
+                         {"task": SAME_NAME, "deadline": "2027-01-10", "id": "kse:B:1"})
+
+    diff = bot_module.diff_kse_tasks(list(store._records), snapshot)
+    assert len(diff.added) == 2
+    store.apply_diff(diff)
+    assert sorted(record.task_id for record in store._records) == ["kse:A:1", "kse:B:1"]
+
+    revision = store.revision
+    repeat = bot_module.diff_kse_tasks(list(store._records), snapshot)
+    assert not repeat # Второй проход ничего не меняет и не пишет на диск
+    assert not store.apply_diff(repeat)
+    assert store.revision == revision
+
+
+def test_manual_tasks_are_still_deduplicated_by_name():
+    store = _store(21002)
+    assert store.add(bot_module.TaskRecord("Лаба")) == 1
+    assert store.add(bot_module.TaskRecord("Лаба")) == 0
+    assert store.add(bot_module.TaskRecord("Лаба", task_id="api:1")) == 1 # Задача с ID - своя идентичность
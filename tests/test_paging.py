@@ -0,0 +1,58 @@
+"""Длинный список задач: страницы по лимиту Telegram, правка только изменившихся, разбор обратно."""
+import asyncio
+from datetime import date, timedelta
+
+import tg_part_laptop as bot_module
+from fakes import FakeBot
+
+TASKS = 5000
+
+
+def _records(count: int, first: int = 0) -> list:
+    today = date.today()
+    return [bot_module.TaskRecord(f"Задача номер {n} с довольно длинным названием", today + timedelta(days=10 + n))
+            for n in range(first, first + count)]
+
+
+def test_5000_tasks_are_split_into_pages():
+    chat_id = 23001
+    bot = FakeBot()
+
+    async def scenario():
+        store = bot_module.chat_registry.register(chat_id, 1)
+        store.start_empty()
+        store.add(*_records(TASKS))
+        chat = bot_module.chat_registry.get(chat_id)
+        await bot_module.update_tasks_message(bot, chat, await store.get_records(bot))
+        pages = [bot.messages[(chat_id, message_id)] for message_id in chat.all_message_ids]
+        initial = (len(bot.edits), len(bot.sent), list(bot.pins))
+
+        bot.edits.clear()
+        bot.sent.clear()
+        store.add(*_records(1, first=TASKS)) # Самый поздний дедлайн - в конец списка
+        await bot_module.update_tasks_message(bot, chat, await store.get_records(bot))
+        return chat, pages, initial
+
+    chat, pages, (edits, sent, pins) = asyncio.run(scenario())
+
+    assert len(pages) > 1
+    assert all(len(page) <= bot_module.TELEGRAM_MESSAGE_LIMIT for page in pages)
+    assert (edits, sent) == (1, len(pages) - 1) # Первая страница - существующее сообщение, остальные новые
+    assert pins == [] # Закрепленным остается первое сообщение
+    assert len(chat.page_message_ids) == len(pages) - 1
+    # Добавление в конец меняет только последнюю страницу
+    assert len(bot.edits) + len(bot.sent) == 1
+    assert bot.edits[0][1] == chat.all_message_ids[-1]
+
+    parsed = [task for page in pages for task in bot_module.parse_tasks_from_text(page)]
+    assert [task["task"] for task in parsed] == [record.name for record in _records(TASKS)]
+    assert [task["deadline"] for task in parsed] == [record.deadline.isoformat() for record in _records(TASKS)]
+
+
+def test_only_pinned_message_is_read():
+    pinned_text = "📋 *Список задач:*\n1. Лаба\n"
+    assert asyncio.run(bot_module.get_tasks_from_message(FakeBot(pinned_text, pinned_message_id=5), 23002, 5)) == [
+        {"task": "Лаба", "deadline": None}]
+    # Закреплено другое сообщение - прочитать сохраненное Bot API не позволяет
+    assert asyncio.run(bot_module.get_tasks_from_message(FakeBot(pinned_text, pinned_message_id=6), 23002, 5)) is None
+    assert asyncio.run(bot_module.get_tasks_from_message(FakeBot(), 23002, 5)) is None
@@ -0,0 +1,58 @@
+"""Рассылка напоминаний под 429 от Telegram: счетчики и соблюдение лимитов."""
+import asyncio
+import time
+
+from telegram import error
+
+import tg_part_laptop as bot_module
+
+GLOBAL_RATE = 10.0
+PER_CHAT_RATE = 5.0
+FLAKY_CHAT, BLOCKED_CHAT, THROTTLED_CHAT = 100, 200, 300
+
+
+class RateLimitedBot:
+    """Отвечает 429 один раз для FLAKY_CHAT и всегда для THROTTLED_CHAT; BLOCKED_CHAT заблокировал бота."""
+
+    def __init__(self):
+        self.attempts: list[tuple[float, int]] = []
+        self.delivered: list[int] = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.attempts.append((time.monotonic(), chat_id))
+        await asyncio.sleep(0.001)
+        if chat_id == THROTTLED_CHAT or (chat_id == FLAKY_CHAT and sum(c == FLAKY_CHAT for _, c in self.attempts) == 1):
+            raise error.RetryAfter(0.1)
+        if chat_id == BLOCKED_CHAT:
+            raise error.Forbidden("Forbidden: bot was blocked by the user")
+        self.delivered.append(chat_id)
+
+
+def test_dispatch_under_429():
+    dispatcher = bot_module.ReminderDispatcher(GLOBAL_RATE, PER_CHAT_RATE, max_retries=1)
+    reminders = [bot_module.Reminder(chat_id, f"r{n}") for chat_id in range(1, 11) for n in range(3)]
+    reminders += [bot_module.Reminder(chat_id, "r") for chat_id in (FLAKY_CHAT, BLOCKED_CHAT, THROTTLED_CHAT)]
+    bot = RateLimitedBot()
+
+    stats = asyncio.run(dispatcher.dispatch(bot, reminders))
+
+    # 30 обычных + FLAKY_CHAT со второй попытки; 429: 1 (FLAKY) + 2 (THROTTLED, обе попытки)
+    assert stats == {"sent": 31, "throttled": 3, "failed": 2}
+    assert dispatcher.totals == stats
+    assert sorted(set(bot.delivered)) == list(range(1, 11)) + [FLAKY_CHAT]
+
+    by_chat: dict[int, list[float]] = {}
+    for at, chat_id in bot.attempts:
+        by_chat.setdefault(chat_id, []).append(at)
+    # По-чатовый лимит: попытки в один чат не чаще 1 / PER_CHAT_RATE
+    for times in by_chat.values():
+        assert all(later - earlier >= 1 / PER_CHAT_RATE * 0.9 for earlier, later in zip(times, times[1:]))
+    # После 429 чат ждет хотя бы секунду (retry_after, но не меньше 2 ** попытка)
+    assert by_chat[FLAKY_CHAT][1] - by_chat[FLAKY_CHAT][0] >= 0.95
+    # Общий лимит: в любом окне T секунд не больше емкости + GLOBAL_RATE * T попыток
+    times = sorted(at for at, _ in bot.attempts)
+    window = 0.5
+    for n, start in enumerate(times):
+        in_window = sum(1 for at in times[n:] if at - start <= window)
+        assert in_window <= GLOBAL_RATE + GLOBAL_RATE * window + 1
+    assert times[-1] - times[0] >= (len(times) - GLOBAL_RATE) / GLOBAL_RATE * 0.9
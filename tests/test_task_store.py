@@ -0,0 +1,40 @@
+"""Запись списка на диск: в фоне, по одной за раз, без блокировки event loop."""
+import asyncio
+import json
+import threading
+import time
+
+import tg_part_laptop as bot_module
+
+
+def test_saves_run_off_the_event_loop_and_coalesce(tmp_path, monkeypatch):
+    write_threads, written_revisions = [], []
+    real_write = bot_module._atomic_write_json
+
+    def slow_write(path, data, indent=2):
+        write_threads.append(threading.current_thread())
+        time.sleep(0.2) # Медленный диск
+        real_write(path, data, indent)
+        written_revisions.append(data["revision"])
+
+    monkeypatch.setattr(bot_module, "_atomic_write_json", slow_write)
+    store = bot_module.TaskStore(5001, 1, str(tmp_path / "5001.json"))
+
+    async def scenario():
+        store.start_empty()
+        started = time.perf_counter()
+        for n in range(20):
+            store.add(bot_module.TaskRecord(f"Задача {n}"))
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - started
+        await store.flush()
+        return elapsed
+
+    elapsed = asyncio.run(scenario())
+
+    assert elapsed < 0.1 # 20 изменений не ждут диск
+    assert threading.main_thread() not in write_threads
+    assert len(written_revisions) <= 3 # Первая запись + одна на все изменения во время нее
+    assert written_revisions[-1] == store.revision
+    saved = json.loads((tmp_path / "5001.json").read_text(encoding="utf-8"))
+    assert len(saved["tasks"]) == 20 and saved["revision"] == store.revision
@@ -0,0 +1,49 @@
+"""Параллельные изменения списка: задачи не теряются, сообщение правится склеенно."""
+import asyncio
+import logging
+
+from telegram import error
+
+import tg_part_laptop as bot_module
+from fakes import FakeBot, make_context, make_update
+
+
+def test_concurrent_adds_are_not_lost():
+    chat_id = 6001
+    bot = FakeBot(delay=0.01)
+
+    async def scenario():
+        bot_module.chat_registry.register(chat_id, 1).start_empty()
+        await asyncio.gather(*(bot_module.add_task(make_update(bot, chat_id, f"- task {n}", message_id=n), make_context(bot))
+                               for n in range(50)))
+        await bot_module.message_updates.flush_all()
+        return await bot_module.chat_registry.store(chat_id).get_records(bot)
+
+    records = asyncio.run(scenario())
+    assert sorted(record.name for record in records) == sorted(f"task {n}" for n in range(50))
+    final_text = bot.messages[(chat_id, 1)]
+    assert all(f"task {n}\n" in final_text for n in range(50))
+    # 50 изменений склеены debounce в несколько правок, а не 50
+    assert len(bot.edits) < 5
+
+
+class NotModifiedBot(FakeBot):
+    """Telegram отвечает на правку тем же текстом ошибкой BadRequest."""
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits.append((chat_id, message_id, text))
+        raise error.BadRequest("Message is not modified: specified new message content and reply markup are exactly the same")
+
+
+def test_not_modified_edit_is_remembered(caplog):
+    bot = NotModifiedBot()
+
+    async def scenario():
+        first = await bot_module._edit_page(bot, 6002, 1, "📋 тот же текст")
+        second = await bot_module._edit_page(bot, 6002, 1, "📋 тот же текст")
+        return first, second
+
+    with caplog.at_level(logging.ERROR, logger=bot_module.logger.name):
+        assert asyncio.run(scenario()) == (True, False)
+    assert len(bot.edits) == 1 # Повторная правка того же текста в Telegram не уходит
+    assert not caplog.records
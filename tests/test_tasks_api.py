@@ -0,0 +1,72 @@
+"""HTTP API задач: пакетный upsert без дублей и защита задач KSE."""
+import asyncio
+from datetime import date
+
+import httpx
+import pytest
+
+import tg_part_laptop as bot_module
+
+TOKEN = "s3cret"
+HEADERS = {"Authorization": f"Bearer {TOKEN}"}
+
+
+def _post(chat_id: int, tasks: list, monkeypatch) -> tuple[httpx.Response, list, list]:
+    monkeypatch.setattr(bot_module, "TASKS_API_TOKEN", TOKEN)
+    renders = []
+
+    async def fake_update_tasks_message(bot, chat, records):
+        renders.append(len(records))
+
+    monkeypatch.setattr(bot_module, "update_tasks_message", fake_update_tasks_message)
+
+    async def scenario():
+        bot_module.chat_registry.register(chat_id, 1).start_empty()
+        transport = httpx.ASGITransport(app=bot_module.api)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post(f"/api/chats/{chat_id}/tasks", headers=HEADERS, json={"tasks": tasks})
+        await bot_module.message_updates.flush_all()
+        return response, await bot_module.chat_registry.store(chat_id).get_records(None)
+
+    response, records = asyncio.run(scenario())
+    return response, records, renders
+
+
+def test_repeated_id_in_batch_adds_one_task(monkeypatch):
+    response, records, renders = _post(24001, [{"id": "x", "task": "A"}, {"id": "x", "task": "B", "deadline": "2027-01-02"}], monkeypatch)
+
+    assert response.status_code == 200
+    assert response.json()["added"] == 1
+    assert [(record.name, record.deadline, record.task_id) for record in records] == [("B", date(2027, 1, 2), "x")]
+    assert renders == [1] # Одна перерисовка на пакет
+
+
+def test_kse_ids_are_rejected(monkeypatch):
+    response, records, renders = _post(24002, [{"task": "ok"}, {"id": "kse:1:2", "task": "Квиз"}], monkeypatch)
+
+    assert response.status_code == 422
+    assert "kse:" in response.json()["details"][0]
+    assert records == [] and renders == [] # Пакет целиком отклонен
+
+
+def test_diff_upsert_merges_new_rows_by_id_or_name():
+    diff = bot_module.diff_upsert([], [
+        bot_module.TaskRecord("A", None, "x"),
+        bot_module.TaskRecord("A", date(2027, 1, 1)), # Без id - та же новая задача по имени
+        bot_module.TaskRecord("C", None, "y"),
+    ])
+    assert [(record.name, record.deadline, record.task_id) for record in diff.added] == [
+        ("A", date(2027, 1, 1), "x"), ("C", None, "y")]
+
+
+def test_diff_upsert_rejects_name_clash_inside_batch():
+    with pytest.raises(bot_module.TaskBatchError, match="'A'"):
+        bot_module.diff_upsert([], [bot_module.TaskRecord("A", None, "x"), bot_module.TaskRecord("A", None, "y")])
+
+
+def test_snapshot_covers_malformed_ids():
+    snapshot = bot_module.HomeworkSnapshot(tasks=[], seen_ids=set(), fetched_courses={"1"})
+    assert snapshot.covers("kse:1:2")
+    assert not snapshot.covers("kse:3:4")
+    assert not snapshot.covers("kse:1")
+    assert not snapshot.covers("manual")
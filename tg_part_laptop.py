@@ -1,19 +1,36 @@
 import os
 import re
 import json
-from datetime import datetime, date # Добавили date
+from datetime import datetime, date, timedelta # Добавили date
 from contextlib import asynccontextmanager
 import logging
 import time # Добавили time для замера времени
+import asyncio
+import hashlib
+import hmac
+import bisect
+import sqlite3
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
 
 # --- Импорты для парсера ---
-import requests
-from bs4 import BeautifulSoup
+import httpx
 
 from telegram import Update, error, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 from fastapi import FastAPI, Request, Response, BackgroundTasks # Добавили BackgroundTasks
-import google.generativeai as genai
+
+try:
+    # Быстрый JSON для вебхука (fastapi 0.111 ставит его сам); без него - stdlib
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
 
 # --- Настройка ---
 # Устанавливаем более подробный уровень логирования
@@ -23,169 +40,593 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__) # Используем именованный логгер
 
+
+# --- Метрики (формат Prometheus, /metrics) ---
+# Свои простые типы вместо prometheus_client: наблюдение - bisect по границам и пара сложений,
+# текст собирается только при запросе /metrics.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {} # метки -> [счетчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.labelnames, label_values, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labelnames, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, label_values)} {value}"
+                     for label_values, value in self._values.items())
+        return lines
+
+
+class CallbackMetric:
+    """Значения читаются функцией в момент /metrics - для уже существующих счетчиков-словарей и гейджей."""
+
+    def __init__(self, name: str, help_text: str, metric_type: str, label: str, read: Callable[[], dict]):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label = label
+        self.read = read
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(f'{self.name}{{{self.label}="{key}"}} {value}' for key, value in self.read().items())
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                logger.error(f"METRICS: Не удалось собрать {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+webhook_ingress_seconds = metrics.register(Histogram("bot_webhook_ingress_seconds", "Прием апдейта вебхуком до ответа Telegram."))
+update_processing_seconds = metrics.register(Histogram("bot_update_processing_seconds", "Обработка апдейта хэндлерами в воркере."))
+telegram_api_seconds = metrics.register(Histogram("bot_telegram_api_seconds", "Запросы к Bot API.", ("method",)))
+gemini_call_seconds = metrics.register(Histogram("bot_gemini_call_seconds", "Запрос к Gemini до конца ответа.", ("outcome",)))
+gemini_first_token_seconds = metrics.register(Histogram("bot_gemini_first_token_seconds", "Время до первого фрагмента ответа Gemini."))
+kse_fetch_seconds = metrics.register(Histogram("bot_kse_fetch_seconds", "Загрузка страницы курса KSE.", ("result",)))
+kse_parse_seconds = metrics.register(Histogram("bot_kse_parse_seconds", "Разбор страницы курса KSE."))
+render_seconds = metrics.register(Histogram("bot_render_seconds", "Отрисовка текста списка задач.",
+                                            buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)))
+log_messages_total = metrics.register(Counter("bot_log_messages_total", "Записи лога по уровням (ERROR - число ошибок).", ("level",)))
+
+
+class _LogLevelCounter(logging.Handler):
+    """Считает WARNING/ERROR/CRITICAL из всех логгеров - ошибки учитываются без правок в каждом except."""
+
+    def emit(self, record: logging.LogRecord):
+        log_messages_total.inc(record.levelname)
+
+
+logging.getLogger().addHandler(_LogLevelCounter(level=logging.WARNING))
+
 TOKEN = os.getenv("TOKEN")
 TARGET_CHAT_ID = os.getenv("TARGET_CHAT_ID")
 MESSAGE_ID_TO_EDIT = os.getenv("MESSAGE_ID_TO_EDIT")
 REMINDER_SECRET = os.getenv("REMINDER_SECRET", "default-secret-key")
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_API_KEY:
+# Настраиваем safety settings, чтобы уменьшить вероятность блокировки
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+# Модель создается при первом вопросе: импорт google.generativeai занимает ~1 сек. холодного старта
+model = None
+_gemini_model_lock = asyncio.Lock()
+if not GEMINI_API_KEY:
+    logger.warning("GEMINI_API_KEY не установлен.")
+
+
+def _build_gemini_model():
     try:
+        import google.generativeai as genai
         genai.configure(api_key=GEMINI_API_KEY)
-        # Настраиваем safety settings, чтобы уменьшить вероятность блокировки
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        ]
-        model = genai.GenerativeModel("gemini-2.5-flash", safety_settings=safety_settings)
+        gemini_model = genai.GenerativeModel("gemini-2.5-flash", safety_settings=GEMINI_SAFETY_SETTINGS)
         logger.info("Gemini модель успешно настроена.")
+        return gemini_model
     except Exception as e:
         logger.error(f"Ошибка конфигурации Gemini: {e}")
-        model = None
-else:
-    logger.warning("GEMINI_API_KEY не установлен.")
-    model = None
+        return None
+
+
+async def get_gemini_model():
+    """Модель Gemini (импорт и настройка в потоке при первом обращении). None - ключ не задан или ошибка."""
+    global model
+    if model is None and GEMINI_API_KEY:
+        async with _gemini_model_lock:
+            if model is None:
+                model = await asyncio.to_thread(_build_gemini_model)
+    return model
 
 # --- Константы для парсера KSE ---
-HOMEWORK_URL = 'https://teaching.kse.org.ua/course/view.php?id=3162'
+KSE_BASE_URL = os.getenv("KSE_BASE_URL", "https://teaching.kse.org.ua").rstrip("/") # Другой адрес - для бенчмарков с заглушкой
+HOMEWORK_URL_TEMPLATE = KSE_BASE_URL + '/course/view.php?id={course_id}'
+# Список курсов через запятую, например "3162,3170"
+KSE_COURSE_IDS = [course_id.strip() for course_id in os.getenv("KSE_COURSE_IDS", "3162").split(",") if course_id.strip()]
+HOMEWORK_URLS = [HOMEWORK_URL_TEMPLATE.format(course_id=course_id) for course_id in KSE_COURSE_IDS]
+KSE_MAX_CONCURRENCY = int(os.getenv("KSE_MAX_CONCURRENCY", "4")) # Одновременных запросов к Moodle
+KSE_COURSE_TIMEOUT = float(os.getenv("KSE_COURSE_TIMEOUT", "20")) # Таймаут на один курс (запрос + разбор), сек.
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
 MOODLE_SESSION_COOKIE = os.getenv("MOODLE_SESSION_COOKIE")
 COOKIES = {'MoodleSession': MOODLE_SESSION_COOKIE} if MOODLE_SESSION_COOKIE else {}
 
+# --- Общий HTTP-клиент для KSE ---
+# Один пул соединений на весь процесс: keep-alive и HTTP/2 между вызовами крона.
+_http_client: httpx.AsyncClient | None = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx-клиент, создавая его при первом обращении."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            headers=HEADERS,
+            cookies=COOKIES,
+            timeout=httpx.Timeout(KSE_COURSE_TIMEOUT, connect=10.0), # Увеличили таймаут
+            # Все курсы на одном хосте: пул не шире лимита параллельных запросов
+            limits=httpx.Limits(max_connections=KSE_MAX_CONCURRENCY, max_keepalive_connections=KSE_MAX_CONCURRENCY, keepalive_expiry=60),
+            follow_redirects=True,
+        )
+        logger.info("HTTP-клиент для KSE создан (HTTP/2, keep-alive).")
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logger.info("HTTP-клиент для KSE закрыт.")
+    _http_client = None
+
+
+# --- Кэш страниц курсов (conditional GET + хэш ul.weeks) ---
+# Для каждого URL: ETag/Last-Modified для If-None-Match/If-Modified-Since и хэш блока недель.
+# В `tasks` лежат ВСЕ квизы с дедлайном, фильтр по дате применяется при выдаче,
+# поэтому закэшированный список не "протухает" при смене дня.
+_homework_cache: dict[str, dict] = {}
+homework_cache_stats = {"hits": 0, "misses": 0}
+
+_WEEKS_UL_START_RE = re.compile(r'<ul\b[^>]*\bclass="[^"]*\bweeks\b[^"]*"[^>]*>', re.IGNORECASE)
+_UL_TAG_RE = re.compile(r'<(/?)ul\b', re.IGNORECASE)
+
+
+def _weeks_fragment(html: str) -> str | None:
+    """
+    Вырезает сырой HTML блока `ul.weeks` без парсинга (подсчет вложенных <ul>).
+    Шапка/футер страницы (sesskey, счетчики) в хэш не попадают.
+    """
+    start_match = _WEEKS_UL_START_RE.search(html)
+    if not start_match:
+        return None
+    depth = 0
+    for tag in _UL_TAG_RE.finditer(html, start_match.start()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return html[start_match.start():tag.end()]
+    return None
+
+
+def _filter_actual_tasks(tasks: list[dict]) -> list[dict]:
+    """Оставляет только задания, дедлайн которых еще не прошел."""
+    today_iso = date.today().isoformat() # ISO-строки сравниваются как даты
+    actual_tasks = []
+    for task in tasks:
+        if task["deadline"] >= today_iso:
+            actual_tasks.append(task)
+        else:
+            logger.debug(f"Парсер KSE: Пропущено просроченное задание '{task['task']}' с дедлайном {task['deadline']}")
+    return actual_tasks
+
+
 # --- Парсер KSE (с проверкой дедлайна) ---
-async def parse_homework() -> list[dict]:
+# Разбор на lxml: дерево строится в C, обход - через iter()/iterdescendants() без BeautifulSoup.
+_KSE_DATE_RE = re.compile(r'(\d{1,2}\s+\w+\s+\d{4})')
+_KSE_DATE_PREFIXES = ("Closed:", "Closes:", "Due:")
+
+
+def _has_class(element, class_name: str) -> bool:
+    return class_name in (element.get('class') or '').split()
+
+
+def _scan_activity(activity) -> tuple[bool, object, object]:
+    """
+    Один проход по потомкам `li.activity`: иконка квиза, `span.instancename`
+    и блок `data-region="activity-dates"`.
+    """
+    is_quiz = False
+    name_element = None
+    dates_div = None
+    for element in activity.iterdescendants('img', 'span', 'div'):
+        if element.tag == 'img':
+            if element.get('alt') == 'quiz icon':
+                is_quiz = True
+        elif element.tag == 'span':
+            if name_element is None and _has_class(element, 'instancename'):
+                name_element = element
+        elif dates_div is None and element.get('data-region') == 'activity-dates':
+            dates_div = element
+    return is_quiz, name_element, dates_div
+
+
+def _instance_name_text(name_element) -> str:
+    """Текст названия без `span.accesshide` (" Quiz" для скринридеров) - без повторного парсинга."""
+    for span in name_element.iterdescendants('span'):
+        if _has_class(span, 'accesshide'):
+            span.drop_tree() # Хвостовой текст после span сохраняется
+            break
+    return name_element.text_content().strip()
+
+
+def _activity_deadline(dates_div) -> str | None:
+    """Ищет первую строку Closed/Closes/Due и возвращает дату в ISO."""
+    description = next((div for div in dates_div.iterdescendants('div') if _has_class(div, 'description-inner')), None)
+    if description is None:
+        return None
+    for line in description.iterdescendants('div'):
+        line_text = line.text_content().strip()
+        # Ищем Closes или Due
+        if not line_text.startswith(_KSE_DATE_PREFIXES):
+            continue
+        date_match = _KSE_DATE_RE.search(line_text)
+        if date_match:
+            date_str = date_match.group(1)
+            try:
+                # Используем английскую локаль для парсинга названий месяцев
+                return datetime.strptime(date_str, '%d %B %Y').strftime('%Y-%m-%d')
+            except ValueError as e: # Ловим конкретно ValueError
+                logger.error(f"Парсер KSE: Не смог спарсить дату '{date_str}' (en): {e}.")
+        return None # Нашли строку с датой, дальше не ищем
+    return None
+
+
+def _extract_homework_tasks(html: str, course_id: str = "") -> list[dict]:
     """
-    Парсит сайт KSE, ищет НЕПРОСРОЧЕННЫЕ активности с "quiz icon" и дедлайном,
-    возвращает СПИСОК СЛОВАРЕЙ с задачами.
+    Синхронная часть парсера: разбирает HTML курса и возвращает все квизы с дедлайном
+    (фильтрация просроченных - в `_filter_actual_tasks`).
+    Стабильный ID задачи - "kse:<курс>:<id модуля>" из `li#module-N`: не меняется при переименовании и переносе.
+    Разбирается только блок `ul.weeks`, каждое дерево обходится один раз.
+    Вызывается через asyncio.to_thread, чтобы не блокировать event loop.
+    """
+    from lxml import html as lxml_html # Импорт при первом запуске парсера, а не при старте процесса
+    weeks_fragment = _weeks_fragment(html)
+    document = lxml_html.document_fromstring(weeks_fragment or html)
+    weeks_container = next((ul for ul in document.iter('ul') if _has_class(ul, 'weeks')), None)
+    if weeks_container is None:
+        logger.warning("Парсер KSE: Не найден 'ul' с классом 'weeks'.")
+        return []
+
+    all_found_tasks = []
+    for section in weeks_container.iterchildren('li'):
+        if not _has_class(section, 'section'):
+            continue
+        # Один проход по секции: заголовок + список активностей
+        section_title = None
+        activities = []
+        for element in section.iterdescendants('li', 'h3'):
+            if element.tag == 'li':
+                if _has_class(element, 'activity'):
+                    activities.append(element)
+            elif section_title is None and _has_class(element, 'sectionname'):
+                section_title = element.text_content().strip()
+        if section_title is None:
+            section_title = "Unknown Section"
+
+        for activity in activities:
+            is_quiz, name_element, dates_div = _scan_activity(activity)
+            if not is_quiz or name_element is None: continue # Пропускаем, если не квиз
+
+            deadline_iso = _activity_deadline(dates_div) if dates_div is not None else None
+            if deadline_iso:
+                full_task_name = f"KSE: {_instance_name_text(name_element)} ({section_title})"
+                task = {"task": full_task_name, "deadline": deadline_iso}
+                module_id = activity.get('id', '')
+                if module_id.startswith('module-'):
+                    task["id"] = f"kse:{course_id}:{module_id[len('module-'):]}"
+                all_found_tasks.append(task)
+
+    return all_found_tasks
+
+
+async def _fetch_course_tasks(url: str, course_id: str = "") -> list[dict] | None:
+    """
+    Скачивает и разбирает одну страницу курса, возвращает все квизы с дедлайном (и просроченные -
+    по ним видно, что задание не исчезло со страницы). Если страница не изменилась
+    (304 или тот же хэш `ul.weeks`), отдает список из кэша. None - курс получить не удалось.
     """
-    logger.info("Запускаю парсер для KSE (фильтр по quiz icon и дате)...")
     start_time = time.time() # Замеряем время начала
-    
-    if not COOKIES:
-        logger.warning("MOODLE_SESSION_COOKIE не установлен. Парсинг будет в гостевом режиме.")
+    cache = _homework_cache.setdefault(url, {"etag": None, "last_modified": None, "weeks_hash": None, "tasks": None})
+    request_headers = {}
+    if cache["tasks"] is not None:
+        if cache["etag"]:
+            request_headers["If-None-Match"] = cache["etag"]
+        if cache["last_modified"]:
+            request_headers["If-Modified-Since"] = cache["last_modified"]
 
     try:
-        response = requests.get(HOMEWORK_URL, headers=HEADERS, cookies=COOKIES, timeout=20) # Увеличили таймаут
+        fetch_started = time.perf_counter()
+        response = await get_http_client().get(url, headers=request_headers)
+        kse_fetch_seconds.observe(time.perf_counter() - fetch_started, response.status_code)
+
+        if response.status_code == 304 and cache["tasks"] is not None:
+            homework_cache_stats["hits"] += 1
+            logger.info(f"Парсер KSE: {url} - 304 Not Modified, беру {len(cache['tasks'])} заданий из кэша за {time.time() - start_time:.2f} сек.")
+            return cache["tasks"]
+
         response.raise_for_status() # Проверяем статус ответа (вызовет исключение для 4xx/5xx)
 
-        if 'login/index.php' in response.url:
+        if 'login/index.php' in str(response.url):
             logger.error("Парсер KSE: Ошибка! Перекинуло на страницу логина. `MOODLE_SESSION_COOKIE` неверный или истек.")
-            return []
+            return None
+
+        html = response.text
+        weeks_fragment = _weeks_fragment(html)
+        weeks_hash = hashlib.sha256(weeks_fragment.encode()).hexdigest() if weeks_fragment else None
+        cache["etag"] = response.headers.get("ETag")
+        cache["last_modified"] = response.headers.get("Last-Modified")
+
+        if weeks_hash and weeks_hash == cache["weeks_hash"] and cache["tasks"] is not None:
+            homework_cache_stats["hits"] += 1
+            logger.info(f"Парсер KSE: {url} - блок недель не изменился, беру {len(cache['tasks'])} заданий из кэша за {time.time() - start_time:.2f} сек.")
+            return cache["tasks"]
+
+        homework_cache_stats["misses"] += 1
+        parse_started = time.perf_counter()
+        dated_tasks = await asyncio.to_thread(_extract_homework_tasks, html, course_id)
+        kse_parse_seconds.observe(time.perf_counter() - parse_started)
+        cache["weeks_hash"] = weeks_hash
+        cache["tasks"] = dated_tasks
 
-        soup = BeautifulSoup(response.text, 'html.parser')
-        weeks_container = soup.find('ul', class_='weeks')
-        if not weeks_container:
-            logger.warning("Парсер KSE: Не найден 'ul' с классом 'weeks'.")
-            return []
+        end_time = time.time() # Замеряем время конца
+        logger.info(f"Парсер KSE: {url} - найдено {len(dated_tasks)} заданий с 'quiz icon' и дедлайном за {end_time - start_time:.2f} сек.")
+        return dated_tasks
+
+    except httpx.TimeoutException:
+        logger.error(f"Парсер KSE: Ошибка! Истек таймаут при запросе к {url}.")
+        return None
+    except httpx.HTTPError as e:
+        logger.error(f"Парсер KSE: Ошибка сети ({url}): {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Парсер KSE: Неожиданная ошибка ({url}): {e}", exc_info=True)
+        return None
 
-        all_found_tasks = []
-        sections = weeks_container.find_all('li', class_='section', recursive=False)
-        today = date.today() # Получаем сегодняшнюю дату ОДИН раз
-
-        for section in sections:
-            section_title_element = section.find('h3', class_='sectionname')
-            section_title = section_title_element.text.strip() if section_title_element else "Unknown Section"
-
-            tasks = section.find_all('li', class_='activity')
-            for task in tasks:
-                quiz_icon = task.find('img', alt='quiz icon')
-                if not quiz_icon: continue # Пропускаем, если не квиз
-
-                task_name_element = task.find('span', class_='instancename')
-                if not task_name_element: continue
-
-                task_name_clone = BeautifulSoup(str(task_name_element), 'html.parser')
-                accesshide = task_name_clone.find('span', class_='accesshide')
-                if accesshide: accesshide.decompose()
-                task_name = task_name_clone.text.strip()
-
-                deadline_iso = None
-                deadline_obj = None # Добавим объект даты для сравнения
-                dates_div = task.find('div', {'data-region': 'activity-dates'})
-                if dates_div:
-                    date_lines = dates_div.find('div', class_='description-inner').find_all('div')
-                    for line in date_lines:
-                        line_text = line.text.strip()
-                        # Ищем Closes или Due
-                        if line_text.startswith(("Closed:", "Closes:", "Due:")):
-                            date_match = re.search(r'(\d{1,2}\s+\w+\s+\d{4})', line_text)
-                            if date_match:
-                                try:
-                                    date_str = date_match.group(1)
-                                    # Используем английскую локаль для парсинга названий месяцев
-                                    deadline_obj_dt = datetime.strptime(date_str, '%d %B %Y')
-                                    deadline_obj = deadline_obj_dt.date() # Берем только дату
-                                    deadline_iso = deadline_obj.strftime('%Y-%m-%d')
-                                except ValueError as e: # Ловим конкретно ValueError
-                                    logger.error(f"Парсер KSE: Не смог спарсить дату '{date_str}' (en): {e}.")
-                                except Exception as e: # Ловим другие ошибки парсинга даты
-                                    logger.error(f"Парсер KSE: Ошибка парсинга даты '{date_str}': {e}")
-                            break # Нашли строку с датой, выходим
-
-                # --- Проверка: Дедлайн еще не прошел? ---
-                if deadline_iso and deadline_obj and deadline_obj >= today:
-                    full_task_name = f"KSE: {task_name} ({section_title})"
-                    all_found_tasks.append({"task": full_task_name, "deadline": deadline_iso})
-                elif deadline_iso:
-                     logger.debug(f"Парсер KSE: Пропущено просроченное задание '{task_name}' с дедлайном {deadline_iso}")
 
+@dataclass(slots=True)
+class HomeworkSnapshot:
+    """Результат одного прохода парсера KSE."""
+    tasks: list[dict] # Актуальные (непросроченные) задания
+    seen_ids: set[str] # ID всех квизов с дедлайном на полученных страницах, включая просроченные
+    fetched_courses: set[str] # Курсы, которые удалось получить
 
-        end_time = time.time() # Замеряем время конца
-        logger.info(f"Парсер KSE: Найдено {len(all_found_tasks)} актуальных заданий с 'quiz icon' за {end_time - start_time:.2f} сек.")
-        return all_found_tasks
+    def covers(self, task_id: str) -> bool:
+        """Можно ли судить об исчезновении задачи: ее курс получен в этом проходе."""
+        parts = task_id.split(":", 2)
+        return len(parts) == 3 and parts[1] in self.fetched_courses
 
-    except requests.exceptions.Timeout:
-        logger.error("Парсер KSE: Ошибка! Истек таймаут при запросе к сайту.")
-        return []
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Парсер KSE: Ошибка сети: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Парсер KSE: Неожиданная ошибка: {e}", exc_info=True)
-        return []
+
+async def parse_homework() -> HomeworkSnapshot:
+    """
+    Парсит сайт KSE по всем курсам из KSE_COURSE_IDS, ищет НЕПРОСРОЧЕННЫЕ активности
+    с "quiz icon" и дедлайном.
+    Курсы качаются параллельно (не больше KSE_MAX_CONCURRENCY одновременно),
+    поэтому общее время ~ времени самого медленного курса.
+    """
+    logger.info(f"Запускаю парсер для KSE ({len(HOMEWORK_URLS)} курсов, фильтр по quiz icon и дате)...")
+    start_time = time.time() # Замеряем время начала
+    
+    if not COOKIES:
+        logger.warning("MOODLE_SESSION_COOKIE не установлен. Парсинг будет в гостевом режиме.")
+
+    semaphore = asyncio.Semaphore(KSE_MAX_CONCURRENCY)
+
+    async def fetch_with_limit(url: str, course_id: str) -> list[dict] | None:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(_fetch_course_tasks(url, course_id), timeout=KSE_COURSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Парсер KSE: Курс {url} не уложился в {KSE_COURSE_TIMEOUT} сек.")
+                return None
+
+    results = await asyncio.gather(*(fetch_with_limit(url, course_id) for url, course_id in zip(HOMEWORK_URLS, KSE_COURSE_IDS)))
+
+    # Сливаем курсы в один список, сохраняя порядок и убирая повторы (по ID, у старых страниц без ID - по имени)
+    snapshot = HomeworkSnapshot(tasks=[], seen_ids=set(), fetched_courses=set())
+    seen_keys = set()
+    for course_id, course_tasks in zip(KSE_COURSE_IDS, results):
+        if course_tasks is None:
+            continue
+        snapshot.fetched_courses.add(course_id)
+        for task in course_tasks:
+            if task.get("id"):
+                snapshot.seen_ids.add(task["id"])
+        for task in _filter_actual_tasks(course_tasks):
+            task_key = task.get("id") or task["task"]
+            if task_key not in seen_keys:
+                seen_keys.add(task_key)
+                snapshot.tasks.append(task)
+
+    end_time = time.time() # Замеряем время конца
+    failed_courses = len(KSE_COURSE_IDS) - len(snapshot.fetched_courses)
+    logger.info(f"Парсер KSE: Найдено {len(snapshot.tasks)} актуальных заданий с 'quiz icon' за {end_time - start_time:.2f} сек. "
+                f"(курсов с ошибкой: {failed_courses}, кэш: {homework_cache_stats})")
+    return snapshot
 
 
 # --- Вспомогательные функции ---
 
-def parse_date_from_text(text: str) -> (str, str):
-    # ... (код без изменений) ...
-    date_obj = None
-    task_text = text
-    match = re.search(r'(\d{1,2}\.\d{1,2}\.\d{4})', text)
-    if match:
-        date_str = match.group(1)
-        try:
-            date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
-            task_text = text.replace(date_str, "").strip()
-        except ValueError: pass
-    if not date_obj:
-        match = re.search(r'(\d{1,2}\.\d{1,2}\.\d{2})', text)
-        if match:
-            date_str = match.group(1)
-            try:
-                date_obj = datetime.strptime(date_str, "%d.%m.%y").date()
-                task_text = text.replace(date_str, "").strip()
-            except ValueError: pass
-    if not date_obj:
-        match = re.search(r'(\d{1,2}\.\d{1,2})', text)
-        if match:
-            date_str = match.group(1)
-            try:
-                current_year = datetime.now().year
-                date_obj = datetime.strptime(f"{date_str}.{current_year}", "%d.%m.%Y").date()
-                if date_obj < datetime.now().date():
-                    date_obj = datetime.strptime(f"{date_str}.{current_year + 1}", "%d.%m.%Y").date()
-                task_text = text.replace(date_str, "").strip()
-            except ValueError: pass
-    if date_obj:
-        return task_text.strip(), date_obj.strftime("%Y-%m-%d")
+# Один проход по тексту вместо трех re.search: сканер находит цепочки из цифр и точек
+# (все три числовых формата лежат внутри них) и относительные фразы.
+# День недели считается датой только с предлогом в своем падеже ("в среду", "к среде", "до среды")
+# или в именительном в самом конце текста ("Квиз пятница"). Иначе "в среде разработки",
+# "о пятнице" и т.п. теряли бы слова.
+_WEEKDAY_STEMS = ("понедельник", "вторник", "сред", "четверг", "пятниц", "суббот", "воскресень")
+_WEEKDAYS_ACC = r'понедельник|вторник|среду|четверг|пятницу|субботу|воскресенье' # в/во/на
+_WEEKDAYS_DAT = r'понедельнику|вторнику|среде|четвергу|пятнице|субботе|воскресенью' # к
+_WEEKDAYS_GEN = r'понедельника|вторника|среды|четверга|пятницы|субботы|воскресенья' # до
+_WEEKDAYS_NOM = r'понедельник|вторник|среда|четверг|пятница|суббота|воскресенье'
+_WEEKDAY_GROUPS = ("weekday_acc", "weekday_dat", "weekday_gen", "weekday_end")
+_DATE_SCAN_PATTERN = re.compile(
+    r'(?P<run>\d[\d.]*)'
+    r'|(?=[дДкКнНсСзЗчЧпПвВ])(?i:(?<!\w)(?:(?:(?:до|к|на)\s+)?(?:(?P<days>послезавтра|завтра|сегодня)'
+    r'|через\s+(?:(?P<count>\d{1,3})\s+)?(?P<unit>дн[еяи]й|дня|день|недел[юиь]))'
+    r'|(?:на|во|в)\s+(?P<weekday_acc>' + _WEEKDAYS_ACC + r')'
+    r'|к\s+(?P<weekday_dat>' + _WEEKDAYS_DAT + r')'
+    r'|до\s+(?P<weekday_gen>' + _WEEKDAYS_GEN + r')'
+    r'|(?P<weekday_end>' + _WEEKDAYS_NOM + r')(?=\W*$))(?!\w))'
+)
+# Обычная цепочка: Д.М, Д.М.ГГ или Д.М.ГГГГ целиком
+_SIMPLE_DATE_RUN = re.compile(r'(\d{1,2})\.(\d{1,2})(?:\.(\d{2})(\d{2})?)?')
+# Необычная ("1.123.2025", "29.0225.11"): в каждой позиции те же три шаблона, что и раньше, через lookahead
+_DATE_RUN_FORMATS = re.compile(
+    r'(?=\d)(?:(?=(\d{1,2})\.(\d{1,2})\.(\d{4})))?(?:(?=(\d{1,2})\.(\d{1,2})\.(\d{2})))?(?:(?=(\d{1,2})\.(\d{1,2})))?'
+)
+_RELATIVE_DAYS = {"сегодня": 0, "завтра": 1, "послезавтра": 2}
+
+
+def _numeric_date(day: str, month: str, year: int) -> date | None:
+    try:
+        return date(year, int(month), int(day))
+    except ValueError:
+        return None
+
+
+def _relative_date(match: re.Match, today: date) -> date:
+    if match.group("days"):
+        return today + timedelta(days=_RELATIVE_DAYS[match.group("days").lower()])
+    if match.group("unit"):
+        count = int(match.group("count") or 1)
+        return today + timedelta(days=count * 7 if match.group("unit").lower().startswith("недел") else count)
+    word = next(word for word in match.group(*_WEEKDAY_GROUPS) if word).lower()
+    weekday = next(n for n, stem in enumerate(_WEEKDAY_STEMS) if word.startswith(stem))
+    return today + timedelta(days=(weekday - today.weekday()) % 7 or 7) # Ближайший такой день после сегодня
+
+
+def parse_date_from_text(text: str, today: date | None = None) -> (str, str):
+    """
+    Выделяет дедлайн из текста задачи. Приоритет как раньше: первое вхождение ДД.ММ.ГГГГ,
+    если оно невалидно - первое ДД.ММ.ГГ, затем первое ДД.ММ (ближайшее будущее).
+    Если числовой даты нет - относительные фразы: "завтра", "через 3 дня", "в пятницу".
+    """
+    if today is None:
+        today = date.today()
+    full = short = day_month = relative = None # Первые вхождения каждого формата: (день, месяц[, год])
+    for match in _DATE_SCAN_PATTERN.finditer(text):
+        run = match.group("run")
+        if run is None:
+            relative = relative or match
+            continue
+        if "." not in run:
+            continue
+        simple = _SIMPLE_DATE_RUN.fullmatch(run)
+        if simple:
+            day, month, year_head, year_tail = simple.groups()
+            found = [(day, month, year_head + year_tail) if year_tail else None,
+                     (day, month, year_head) if year_head else None,
+                     (day, month)]
+        else:
+            found = [None, None, None]
+            for run_match in _DATE_RUN_FORMATS.finditer(run):
+                for n in range(3):
+                    if found[n] is None and run_match.group(n * 3 + 1) is not None:
+                        found[n] = run_match.group(n * 3 + 1, n * 3 + 2, n * 3 + 3) if n < 2 else run_match.group(7, 8)
+        short = short or found[1]
+        day_month = day_month or found[2]
+        if found[0] and full is None:
+            full = found[0]
+            if _numeric_date(full[0], full[1], int(full[2])):
+                break # Высший приоритет найден - дальше можно не смотреть
+
+    if full is not None:
+        date_obj = _numeric_date(full[0], full[1], int(full[2]))
+        if date_obj:
+            return text.replace(".".join(full), "").strip(), date_obj.strftime("%Y-%m-%d")
+    if short is not None:
+        year = int(short[2])
+        date_obj = _numeric_date(short[0], short[1], year + (2000 if year < 69 else 1900)) # как %y
+        if date_obj:
+            return text.replace(".".join(short), "").strip(), date_obj.strftime("%Y-%m-%d")
+    if day_month is not None:
+        date_obj = _numeric_date(day_month[0], day_month[1], today.year)
+        if date_obj:
+            if date_obj < today:
+                next_year = _numeric_date(day_month[0], day_month[1], today.year + 1)
+                if next_year is None:
+                    # 29.02 без високосного следующего года: как и раньше, остается дата этого года, текст не трогаем
+                    return text.strip(), date_obj.strftime("%Y-%m-%d")
+                date_obj = next_year
+            return text.replace(".".join(day_month), "").strip(), date_obj.strftime("%Y-%m-%d")
+    if relative is not None:
+        task_text = f"{text[:relative.start()].rstrip()} {text[relative.end():].lstrip()}"
+        return task_text.strip(), _relative_date(relative, today).isoformat()
     return text.strip(), None
 
 
+_NUMBERED_LINE = re.compile(r'[1-9]\d*\.') # "N." без ограничения на N
+
+
 # --- ❗️❗️❗️ ПОЛНОСТЬЮ ПЕРЕПИСАННАЯ ФУНКЦИЯ ❗️❗️❗️ ---
 def parse_tasks_from_text(text: str) -> list:
     """
@@ -207,7 +648,7 @@ def parse_tasks_from_text(text: str) -> list:
         # Убираем Markdown-мусор
         cleaned_line = line.strip().replace('❌ ~', '').replace('~', '').replace('⚠️ *', '').replace('*', '')
         
-        if not cleaned_line.startswith(tuple(f"{i}." for i in range(1, 200))):
+        if not _NUMBERED_LINE.match(cleaned_line):
              # Пропускаем строки, не начинающиеся с "N." (например, заголовок)
              continue
         
@@ -254,186 +695,716 @@ def parse_tasks_from_text(text: str) -> list:
     return tasks
 
 
-async def get_tasks_from_message(bot: Bot) -> list:
-    if not TARGET_CHAT_ID: return []
+async def get_tasks_from_message(bot: Bot, chat_id: int, message_id: int) -> list | None:
+    """
+    Читает задачи из текста сообщения. None - сообщение прочитать не удалось.
+    Bot API отдает чужое сообщение только как закрепленное, поэтому читается только оно.
+    """
     try:
-        if not MESSAGE_ID_TO_EDIT:
-             logger.error("MESSAGE_ID_TO_EDIT не установлен!")
-             return []
-        
-        message = await bot.get_chat(chat_id=TARGET_CHAT_ID) 
-        target_message_text = None
-        
-        # Проверяем ID сообщения в int
-        message_id_int = 0
-        try:
-             message_id_int = int(MESSAGE_ID_TO_EDIT)
-        except ValueError:
-             logger.error(f"MESSAGE_ID_TO_EDIT ('{MESSAGE_ID_TO_EDIT}') не является корректным числом.")
-             return []
-
-        if message.pinned_message and message.pinned_message.message_id == message_id_int:
-             target_message_text = message.pinned_message.text
-             logger.info(f"Читаю задачи из закрепленного сообщения {message_id_int}.")
-        else:
-             try:
-                 msg_obj = await bot.get_message(chat_id=TARGET_CHAT_ID, message_id=message_id_int)
-                 target_message_text = msg_obj.text
-                 logger.info(f"Читаю задачи из сообщения {message_id_int} (не закреплено).")
-             except error.BadRequest as e:
-                 logger.error(f"Не удалось получить сообщение по ID {message_id_int}: {e}. Возможно, оно удалено или ID неверен.")
-                 if message.pinned_message:
-                     logger.warning(f"Закрепленное сообщение ({message.pinned_message.message_id}) не совпадает с MESSAGE_ID_TO_EDIT ({message_id_int}).")
-                 return [] 
-                 
+        message = await bot.get_chat(chat_id=chat_id) 
+        if not message.pinned_message or message.pinned_message.message_id != message_id:
+             pinned_id = message.pinned_message.message_id if message.pinned_message else None
+             logger.error(f"Сообщение {message_id} (чат {chat_id}) не закреплено (закреплено: {pinned_id}), прочитать его нельзя.")
+             return None
+        target_message_text = message.pinned_message.text
+        logger.info(f"Читаю задачи из закрепленного сообщения {message_id} (чат {chat_id}).")
+
         if target_message_text:
             return parse_tasks_from_text(target_message_text)
         
-        logger.warning(f"Текст сообщения {message_id_int} пуст.")
+        logger.warning(f"Текст сообщения {message_id} пуст.")
         return []
     except Exception as e:
         logger.error(f"Не удалось прочитать сообщение: {e}", exc_info=True)
-        return []
+        return None
+
+
+@dataclass(slots=True, eq=False)
+class TaskRecord:
+    """Задача с уже разобранным дедлайном + кэш отрисованной строки."""
+    name: str
+    deadline: date | None = None
+    task_id: str | None = None # Стабильный ID из источника (KSE: "kse:<курс>:<модуль>"); у ручных задач нет
+    _line: str | None = field(default=None, repr=False)
+    _line_status: int | None = field(default=None, repr=False)
+
+    def sort_key(self) -> tuple:
+        return (self.deadline or date.max, self.name)
+
+    def to_dict(self) -> dict:
+        task = {"task": self.name, "deadline": self.deadline.isoformat() if self.deadline else None}
+        if self.task_id:
+            task["id"] = self.task_id
+        return task
+
+    @classmethod
+    def from_dict(cls, task: dict) -> "TaskRecord":
+        deadline = None
+        if task.get("deadline"):
+            try:
+                deadline = date.fromisoformat(task["deadline"])
+            except ValueError:
+                logger.warning(f"Некорректная дата '{task['deadline']}' в задаче: {task.get('task')}")
+        return cls(task.get("task") or "Без названия", deadline, task.get("id"))
 
 
-async def update_tasks_message(bot: Bot, tasks: list):
-    if not (TARGET_CHAT_ID and MESSAGE_ID_TO_EDIT):
-        logger.error("Переменные ID не установлены. Обновление невозможно.")
-        return
-        
-    # --- ❗️❗️❗️ НОВАЯ ЛОГИКА: Очистка от дубликатов перед обновлением ❗️❗️❗️ ---
-    unique_tasks = []
-    seen_task_names = set()
-    for task in tasks:
-        task_name = task.get('task')
-        if task_name not in seen_task_names:
-            unique_tasks.append(task)
-            seen_task_names.add(task_name)
-        else:
-            logger.info(f"Обнаружен и удален дубликат задачи: '{task_name}'")
-    
-    # Обновляем `tasks` на отфильтрованный список
-    tasks = unique_tasks 
-    # --- Конец блока очистки ---
+# --- Локальное хранилище задач ---
+# Источник правды - список в памяти процесса + файл чата в TASKS_DIR на диске.
+# Закрепленное сообщение только ОТРИСОВЫВАЕТ этот список и читается один раз,
+# если на диске нет данных для этого чата и сообщения.
+DATA_DIR = os.getenv("DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+STATE_FILE = os.getenv("STATE_FILE", os.path.join(DATA_DIR, "state.json"))
+TASKS_DIR = os.getenv("TASKS_DIR", os.path.join(DATA_DIR, "tasks"))
 
-    text = "📋 *Список задач:*\n"
-    if not tasks:
-        text += "_Задач нет_"
-    else:
-        now = datetime.now()
+
+def _read_json_file(path: str, default):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось прочитать {path}: {e}")
+        return default
+
+
+def _atomic_write_json(path: str, data, indent: int | None = 2):
+    """Пишет во временный файл рядом и атомарно подменяет (os.replace), чтобы не оставить битый JSON."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class TaskStore:
+    """
+    Список задач одного чата в памяти (отсортирован как в сообщении) с сохранением на диск.
+    Методы изменения вызываются под `chat_locks` и после `load()`.
+    Запись на диск идет в фоне (asyncio.to_thread), по одной за раз: изменения, пришедшие
+    во время записи, ложатся на диск следующей записью, а не каждое своей.
+    """
+
+    def __init__(self, chat_id: int, message_id: int, tasks_path: str):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.tasks_path = tasks_path
+        self._records: list[TaskRecord] | None = None
+        self._names: set[str] = set()
+        self._ids: set[str] = set() # Задачи с ID различаются по ID: одинаковые названия из разных курсов - разные задачи
+        self._revision = 0
+        self._saved_revision = 0 # Последняя ревизия, записанная на диск
+        self._save_task: asyncio.Task | None = None
+        self._load_lock = asyncio.Lock() # Одна начальная загрузка на все конкурентные обращения
+
+    def _load_from_disk(self) -> list | None:
+        data = _read_json_file(self.tasks_path, None)
+        # Доверяем файлу, только если он записан хранилищем для этого же сообщения
+        if not isinstance(data, dict) or not isinstance(data.get("tasks"), list):
+            return None
+        if data.get("message_id") != self.message_id:
+            logger.info(f"TaskStore: {self.tasks_path} относится к другому сообщению, игнорирую.")
+            return None
+        self._revision = data.get("revision", 0)
+        return data["tasks"]
+
+    @property
+    def loaded(self) -> bool:
+        return self._records is not None
+
+    @property
+    def revision(self) -> int:
+        """Растет при каждом сохранении - по нему инвалидируются производные кэши."""
+        return self._revision
+
+    def load_snapshot(self) -> bool:
+        """Загрузка только с диска, без сети (для старта процесса). False - снимка для этого сообщения нет."""
+        if self._records is None:
+            tasks = self._load_from_disk()
+            if tasks is None:
+                return False
+            logger.info(f"TaskStore: Загружено {len(tasks)} задач из {self.tasks_path}.")
+            self._replace(tasks)
+        return True
+
+    async def load(self, bot: Bot) -> bool:
+        """При первом обращении грузит задачи с диска или из сообщения. False - загрузить не удалось."""
+        if self._records is None:
+            async with self._load_lock:
+                if self._records is None and not self.load_snapshot():
+                    tasks = await get_tasks_from_message(bot, self.chat_id, self.message_id)
+                    chat = chat_registry.get(self.chat_id)
+                    if tasks is not None and chat is not None and chat.page_message_ids:
+                        logger.warning(f"TaskStore: У чата {self.chat_id} {len(chat.page_message_ids)} доп. страниц, "
+                                       f"без снимка восстанавливается только первая.")
+                    if tasks is None:
+                        # Не кэшируем пустой список при сбое - иначе следующая запись затрет сообщение
+                        logger.warning(f"TaskStore: Сообщение чата {self.chat_id} не прочитано, повторю при следующем обращении.")
+                        return False
+                    logger.info(f"TaskStore: Начальная загрузка {len(tasks)} задач из сообщения чата {self.chat_id}.")
+                    self._replace(tasks)
+                    self._save()
+        return True
+
+    def start_empty(self):
+        """Новый чат (/setup): пустой список, сообщение читать не нужно."""
+        if self._records is None:
+            self._replace([])
+        self._save()
+
+    async def get_records(self, bot: Bot) -> list[TaskRecord]:
+        """Снимок списка в порядке отображения (номер в сообщении = индекс + 1)."""
+        if not await self.load(bot):
+            return []
+        return list(self._records)
+
+    def _replace(self, tasks: list[dict]):
+        self._records = []
+        self._reindex()
+        self._insert([TaskRecord.from_dict(task) for task in tasks])
+
+    def _reindex(self):
+        self._names = {record.name for record in self._records}
+        self._ids = {record.task_id for record in self._records if record.task_id}
+
+    def _is_duplicate(self, record: TaskRecord) -> bool:
+        if record.task_id:
+            return record.task_id in self._ids
+        return record.name in self._names # Ручные задачи без ID - по имени
+
+    def _insert(self, records: list[TaskRecord]) -> int:
+        added = 0
+        for record in records:
+            if self._is_duplicate(record):
+                logger.info(f"Обнаружен и удален дубликат задачи: '{record.name}'")
+                continue
+            bisect.insort(self._records, record, key=TaskRecord.sort_key)
+            self._names.add(record.name)
+            if record.task_id:
+                self._ids.add(record.task_id)
+            added += 1
+        return added
+
+    def add(self, *records: TaskRecord) -> int:
+        """Вставляет задачи на их место в сортировке (дубликаты по ID, у задач без ID - по имени, пропускаются)."""
+        added = self._insert(list(records))
+        if added:
+            self._save()
+            deadline_scheduler.on_deadlines_added(record.deadline for record in records)
+        return added
+
+    def apply_diff(self, diff: "TaskDiff") -> bool:
+        """Применяет изменения из парсера одной записью на диск. False - менять было нечего."""
+        if not diff:
+            return False
+        for record, name, deadline, task_id in diff.changed:
+            record.name, record.deadline, record.task_id = name, deadline, task_id
+            record._line = None # Перерисовать строку
+        if diff.removed:
+            to_remove = {id(record) for record in diff.removed}
+            self._records = [record for record in self._records if id(record) not in to_remove]
+        if diff.changed:
+            self._records.sort(key=TaskRecord.sort_key) # Почти отсортированный список - timsort за ~O(n)
+        self._reindex()
+        self._insert(diff.added)
+        self._save()
+        deadline_scheduler.on_deadlines_added([record.deadline for record in diff.added] +
+                                              [deadline for _, _, deadline, _ in diff.changed])
+        return True
+
+    def remove(self, records: list[TaskRecord]):
+        to_remove = {id(record) for record in records}
+        self._records = [record for record in self._records if id(record) not in to_remove]
+        self._reindex()
+        self._save()
+
+    def _snapshot(self) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "message_id": self.message_id,
+            "revision": self._revision,
+            "tasks": [record.to_dict() for record in self._records],
+        }
+
+    def _save(self):
+        self._revision += 1
         try:
-            sorted_tasks = sorted(
-                tasks,
-                key=lambda x: (
-                    datetime.strptime(x['deadline'], '%Y-%m-%d').date() if x.get('deadline') else date.max,
-                    x.get('task', '') # Добавим .get для надежности
-                )
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при сортировке задач: {e}", exc_info=True)
-            sorted_tasks = tasks
-            text += "\n⚠️ *Ошибка сортировки!* \n"
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты, тесты) - пишем сразу
+            try:
+                _atomic_write_json(self.tasks_path, self._snapshot(), indent=None)
+                self._saved_revision = self._revision
+            except OSError as e:
+                logger.error(f"TaskStore: Не удалось сохранить задачи на диск: {e}")
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # Снимок собирается в event loop (записи меняются только в нем), JSON + fsync - в потоке
+        while self._saved_revision < self._revision:
+            revision, snapshot = self._revision, self._snapshot()
+            try:
+                await asyncio.to_thread(_atomic_write_json, self.tasks_path, snapshot, None)
+            except OSError as e:
+                logger.error(f"TaskStore: Не удалось сохранить задачи на диск: {e}")
+                return # Повторит следующее изменение
+            self._saved_revision = revision
 
-        for i, t in enumerate(sorted_tasks, start=1):
-            line = t.get("task", "Без названия") 
-            deadline_str_formatted = ""
+    async def flush(self):
+        """Дожидается записи на диск всех изменений (при остановке сервера)."""
+        if self._save_task is not None and not self._save_task.done():
+            await self._save_task
+
+
+# --- Реестр чатов (мультипользовательский режим) ---
+@dataclass(slots=True)
+class ChatConfig:
+    chat_id: int
+    message_id: int # Закрепленное сообщение со списком (первая страница)
+    page_message_ids: list[int] = field(default_factory=list) # Сообщения для следующих страниц длинного списка
+
+    @property
+    def all_message_ids(self) -> list[int]:
+        return [self.message_id, *self.page_message_ids]
 
-            if t.get("deadline"):
-                try:
-                    deadline_dt = datetime.strptime(t["deadline"], "%Y-%m-%d")
-                    deadline_d = deadline_dt.date()
-                    days_left = (deadline_d - now.date()).days
-
-                    if days_left < 0:
-                        deadline_str_formatted = "(просрочено)"
-                    elif days_left == 0:
-                        deadline_str_formatted = f"(⚠️ СЕГОДНЯ)"
-                    elif days_left <= 2:
-                        deadline_str_formatted = f"(⚠️ осталось {days_left} дн.)"
-                    else:
-                        deadline_str_formatted = f"({t['deadline']})"
-
-                    # Базовое имя - это УЖЕ `line`. KSE задачи уже имеют `(Section)` в имени.
-                    # Нам не нужно ничего отрезать.
-                    line = f"{line} {deadline_str_formatted}"
-
-                    if days_left < 0:
-                        line = f"❌ ~{line}~"
-                    elif days_left <= 2:
-                        line = f"⚠️ *{line}*"
-                except ValueError:
-                    logger.warning(f"Некорректная дата '{t['deadline']}' в задаче: {line}")
-                    line = t.get("task", "Без названия") # Используем .get
-
-            text += f"{i}. {line}\n"
 
+def _parse_int(value) -> int | None:
     try:
-        message_id_int = int(MESSAGE_ID_TO_EDIT) 
-        await bot.edit_message_text(text, chat_id=TARGET_CHAT_ID, message_id=message_id_int,
-                                         parse_mode="Markdown")
-        logger.info(f"Сообщение {message_id_int} успешно обновлено. Новое кол-во задач: {len(tasks)}")
-    except ValueError:
-         logger.error(f"MESSAGE_ID_TO_EDIT ('{MESSAGE_ID_TO_EDIT}') не является корректным числом. Не могу обновить сообщение.")
-    except error.BadRequest as e:
-        if "message is not modified" not in str(e):
-            logger.error(f"Не удалось обновить сообщение {MESSAGE_ID_TO_EDIT}: {e}")
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Чат владельца из переменных окружения (как раньше). Сюда же сливаются задачи парсера KSE,
+# потому что MOODLE_SESSION_COOKIE - его.
+OWNER_CHAT_ID = _parse_int(TARGET_CHAT_ID)
+
+
+class ChatRegistry:
+    """
+    Чаты, зарегистрированные через /setup: chat_id -> ChatConfig и TaskStore.
+    state.json читается при первом обращении; поиск чата - словарь, O(1).
+    """
+
+    def __init__(self, state_path: str, tasks_dir: str):
+        self.state_path = state_path
+        self.tasks_dir = tasks_dir
+        self._chats: dict[int, ChatConfig] | None = None
+        self._stores: dict[int, TaskStore] = {}
+
+    def _ensure_loaded(self) -> dict[int, ChatConfig]:
+        if self._chats is None:
+            state = _read_json_file(self.state_path, {})
+            chats = {}
+            registered = set() # Чаты, записанные самим реестром (/setup)
+            if isinstance(state, dict):
+                for chat_key, chat_state in (state.get("chats") or {}).items():
+                    chat_id, message_id = _parse_int(chat_key), _parse_int(chat_state.get("message_id"))
+                    if chat_id is not None and message_id is not None:
+                        pages = [page_id for page_id in map(_parse_int, chat_state.get("pages") or []) if page_id is not None]
+                        chats[chat_id] = ChatConfig(chat_id, message_id, pages)
+                        registered.add(chat_id)
+                # Старый формат state.json: {"chat_id": ..., "message_id": ...}
+                if "chats" not in state:
+                    chat_id, message_id = _parse_int(state.get("chat_id")), _parse_int(state.get("message_id"))
+                    if chat_id is not None and message_id is not None:
+                        chats[chat_id] = ChatConfig(chat_id, message_id)
+            # Владелец из TARGET_CHAT_ID/MESSAGE_ID_TO_EDIT - пока он сам не сделал /setup:
+            # после /setup запись реестра новее переменных окружения и побеждает
+            owner_message_id = _parse_int(MESSAGE_ID_TO_EDIT)
+            if OWNER_CHAT_ID is not None and owner_message_id is not None:
+                if OWNER_CHAT_ID not in registered:
+                    chats[OWNER_CHAT_ID] = ChatConfig(OWNER_CHAT_ID, owner_message_id)
+            elif TARGET_CHAT_ID or MESSAGE_ID_TO_EDIT:
+                logger.error(f"TARGET_CHAT_ID ('{TARGET_CHAT_ID}') / MESSAGE_ID_TO_EDIT ('{MESSAGE_ID_TO_EDIT}') заданы неверно.")
+            self._chats = chats
+            logger.info(f"ChatRegistry: Загружено {len(chats)} чатов.")
+        return self._chats
+
+    def get(self, chat_id: int) -> ChatConfig | None:
+        return self._ensure_loaded().get(chat_id)
+
+    def chats(self) -> list[ChatConfig]:
+        return list(self._ensure_loaded().values())
+
+    def store(self, chat_id: int) -> TaskStore | None:
+        """Хранилище задач чата (создается при первом обращении). None - чат не зарегистрирован."""
+        task_store = self._stores.get(chat_id)
+        if task_store is None:
+            chat = self.get(chat_id)
+            if chat is None:
+                return None
+            task_store = TaskStore(chat.chat_id, chat.message_id, os.path.join(self.tasks_dir, f"{chat.chat_id}.json"))
+            self._stores[chat_id] = task_store
+        return task_store
+
+    def load_snapshots(self) -> int:
+        """Поднимает с диска списки всех чатов, у которых есть снимок. Возвращает число загруженных."""
+        return sum(1 for chat in self.chats() if self.store(chat.chat_id).load_snapshot())
+
+    def register(self, chat_id: int, message_id: int) -> TaskStore:
+        """
+        Регистрирует (или перепривязывает) сообщение со списком для чата. Список уже
+        зарегистрированного чата должен быть загружен до вызова (TaskStore.load) - иначе
+        его задачи (например, владельца из TARGET_CHAT_ID) были бы заменены пустым списком.
+        """
+        chats = self._ensure_loaded()
+        previous = chats.get(chat_id)
+        if previous is not None:
+            task_store = self.store(chat_id)
+            if not task_store.load_snapshot():
+                raise RuntimeError(f"список задач чата {chat_id} не загружен, перепривязка потеряла бы задачи")
+        # Страницы продолжения остаются за чатом - новые сообщения под них не нужны
+        chats[chat_id] = ChatConfig(chat_id, message_id, previous.page_message_ids if previous else [])
+        task_store = self.store(chat_id)
+        task_store.message_id = message_id
+        task_store.start_empty() # Существующие задачи сохраняются, меняется только сообщение
+        self._save()
+        logger.info(f"ChatRegistry: Чат {chat_id} зарегистрирован (сообщение {message_id}). Всего чатов: {len(chats)}.")
+        return task_store
+
+    async def flush_all(self):
+        """Дожидается фоновой записи списков задач всех чатов."""
+        await asyncio.gather(*(task_store.flush() for task_store in self._stores.values()))
+
+    def add_page(self, chat_id: int, message_id: int):
+        """Запоминает сообщение для очередной страницы списка."""
+        chat = self.get(chat_id)
+        if chat is not None:
+            chat.page_message_ids.append(message_id)
+            self._save()
+
+    def _save(self):
+        chats_state = {}
+        for chat in self._chats.values():
+            chats_state[str(chat.chat_id)] = {"message_id": chat.message_id}
+            if chat.page_message_ids:
+                chats_state[str(chat.chat_id)]["pages"] = chat.page_message_ids
+        try:
+            _atomic_write_json(self.state_path, {"chats": chats_state})
+        except OSError as e:
+            logger.error(f"ChatRegistry: Не удалось сохранить {self.state_path}: {e}")
+
+
+chat_registry = ChatRegistry(STATE_FILE, TASKS_DIR)
+
+
+# Статус строки относительно сегодняшнего дня: -1 просрочено, 0/1/2 - дней осталось, 3 - обычная дата.
+# Строка перерисовывается, только когда статус меняется (или на новой задаче).
+_STATUS_NORMAL = 3
+
+
+def _deadline_status(deadline: date | None, today: date) -> int | None:
+    if deadline is None:
+        return None
+    days_left = (deadline - today).days
+    return -1 if days_left < 0 else min(days_left, _STATUS_NORMAL)
+
+
+def _render_task_line(record: TaskRecord, today: date) -> str:
+    status = _deadline_status(record.deadline, today)
+    if record._line is not None and record._line_status == status:
+        return record._line
+
+    line = record.name
+    if status is not None:
+        if status < 0:
+            deadline_str_formatted = "(просрочено)"
+        elif status == 0:
+            deadline_str_formatted = "(⚠️ СЕГОДНЯ)"
+        elif status < _STATUS_NORMAL:
+            deadline_str_formatted = f"(⚠️ осталось {status} дн.)"
         else:
-            logger.info("Текст сообщения не изменился, пропуск обновления.")
+            deadline_str_formatted = f"({record.deadline.isoformat()})"
+
+        # Базовое имя - это УЖЕ `line`. KSE задачи уже имеют `(Section)` в имени.
+        line = f"{line} {deadline_str_formatted}"
+
+        if status < 0:
+            line = f"❌ ~{line}~"
+        elif status < _STATUS_NORMAL:
+            line = f"⚠️ *{line}*"
+
+    record._line = line
+    record._line_status = status
+    return line
+
+
+TASKS_HEADER = "📋 *Список задач:*\n"
+EMPTY_TASKS_TEXT = "📋 *Список задач:*\n_Задач нет_"
+EMPTY_PAGE_TEXT = "📋 _Продолжение списка - пусто_"
+# Лимит Telegram - 4096 символов; запас на случай, если разметка считается иначе
+TASKS_PAGE_LIMIT = int(os.getenv("TASKS_PAGE_LIMIT", "3900"))
+
+
+def render_task_pages(records: list[TaskRecord], limit: int = TASKS_PAGE_LIMIT) -> list[str]:
+    """
+    Делит список на страницы по целым строкам (Markdown каждой строки замкнут в ней).
+    Заголовок - только на первой странице, чтобы новая страница не меняла остальные.
+    """
+    if not records:
+        return [EMPTY_TASKS_TEXT]
+    today = date.today()
+    pages = []
+    parts = [TASKS_HEADER]
+    size = len(TASKS_HEADER)
+    for i, record in enumerate(records, start=1):
+        line = f"{i}. {_render_task_line(record, today)}\n"
+        if len(line) > limit:
+            line = line[:limit - 2] + "…\n" # Одна задача длиннее страницы
+        if size + len(line) > limit:
+            pages.append("".join(parts))
+            parts, size = [], 0
+        parts.append(line)
+        size += len(line)
+    pages.append("".join(parts))
+    return pages
+
+
+def render_tasks_text(records: list[TaskRecord]) -> str:
+    """Собирает Markdown-текст списка задач (записи уже отсортированы хранилищем)."""
+    return "".join(render_task_pages(records, limit=float("inf")))
+
+
+# Последний успешно отправленный текст по сообщениям - чтобы не слать edit без изменений
+_last_sent_texts: dict[str, str] = {}
+
+
+async def _edit_page(bot: Bot, chat_id: int, message_id: int, text: str) -> bool:
+    """Правит одну страницу, если ее текст изменился. True - был запрос к Telegram."""
+    chat_key = f"{chat_id}:{message_id}"
+    if _last_sent_texts.get(chat_key) == text:
+        return False
+    for _ in range(REMINDER_MAX_RETRIES + 1):
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode="Markdown")
+            _last_sent_texts[chat_key] = text
+            return True
+        except error.RetryAfter as e:
+            # Много страниц подряд упираются в лимит правок чата - ждем, сколько просит Telegram
+            logger.warning(f"Лимит правок в чате {chat_id}, жду {_retry_after_seconds(e):.0f} сек.")
+            await asyncio.sleep(_retry_after_seconds(e))
+        except error.BadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                logger.error(f"Не удалось обновить сообщение {message_id} (чат {chat_id}): {e}")
+            else:
+                _last_sent_texts[chat_key] = text
+            return True
+    return True
+
+
+async def _send_page(bot: Bot, chat: ChatConfig, text: str):
+    """
+    Новая страница: отдельное сообщение, запоминается в реестре. Не закрепляется - закрепленным
+    должно оставаться первое сообщение, по нему TaskStore восстанавливает список без снимка.
+    """
+    page_message = await bot.send_message(chat_id=chat.chat_id, text=text, parse_mode="Markdown")
+    _last_sent_texts[f"{chat.chat_id}:{page_message.message_id}"] = text
+    chat_registry.add_page(chat.chat_id, page_message.message_id)
+
+
+async def update_tasks_message(bot: Bot, chat: ChatConfig, records: list[TaskRecord]):
+    """
+    Отрисовывает список задач в сообщениях чата (только запись). Длинный список занимает
+    несколько сообщений; правятся только страницы, текст которых изменился.
+    """
+    render_started = time.perf_counter()
+    pages = render_task_pages(records)
+    render_seconds.observe(time.perf_counter() - render_started)
+    message_ids = chat.all_message_ids
+    # Лишние страницы (список стал короче) не удаляем - они пригодятся, когда список снова вырастет
+    pages_to_show = pages + [EMPTY_PAGE_TEXT] * max(0, len(message_ids) - len(pages))
+
+    edited = 0
+    try:
+        for n, text in enumerate(pages_to_show):
+            if n < len(message_ids):
+                edited += await _edit_page(bot, chat.chat_id, message_ids[n], text)
+            else:
+                await _send_page(bot, chat, text)
+                edited += 1
     except Exception as e:
-        logger.error(f"Неожиданная ошибка при обновлении сообщения {MESSAGE_ID_TO_EDIT}: {e}", exc_info=True)
+        logger.error(f"Неожиданная ошибка при обновлении списка (чат {chat.chat_id}): {e}", exc_info=True)
+    if edited:
+        logger.info(f"Список чата {chat.chat_id} обновлен: {edited} из {len(pages_to_show)} страниц. Задач: {len(records)}")
+    else:
+        logger.info("Текст сообщения не изменился, пропуск обновления.")
+
+
+# --- Отложенное (debounce) обновление сообщения ---
+# Несколько изменений подряд ("- задача" несколько раз) дают ОДИН edit_message_text:
+# изменения сразу пишутся в TaskStore чата, а отрисовка ждет окно тишины.
+MESSAGE_EDIT_DEBOUNCE = float(os.getenv("MESSAGE_EDIT_DEBOUNCE", "1.0")) # сек.
+
+
+class MessageUpdateCoalescer:
+    """Склеивает запросы на перерисовку сообщения по чатам."""
+
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        self._pending: dict[str, asyncio.Task] = {}
+        self._last_request: dict[str, float] = {}
+
+    def schedule(self, bot: Bot, chat_id) -> asyncio.Task:
+        """Просит перерисовать сообщение; окно debounce сдвигается с каждым запросом."""
+        chat_key = str(chat_id)
+        self._last_request[chat_key] = time.monotonic()
+        pending = self._pending.get(chat_key)
+        if pending is None or pending.done():
+            pending = asyncio.create_task(self._flush_after_quiet(bot, chat_key))
+            self._pending[chat_key] = pending
+        return pending
+
+    async def _flush_after_quiet(self, bot: Bot, chat_key: str):
+        try:
+            while True:
+                # Ждем, пока с последнего запроса не пройдет `debounce` секунд
+                while True:
+                    delay = self._last_request[chat_key] + self.debounce - time.monotonic()
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                render_started = time.monotonic()
+                try:
+                    chat_id = int(chat_key)
+                    chat, task_store = chat_registry.get(chat_id), chat_registry.store(chat_id)
+                    if chat and task_store:
+                        await update_tasks_message(bot, chat, await task_store.get_records(bot))
+                except Exception as e:
+                    logger.error(f"Ошибка отложенного обновления сообщения для чата {chat_key}: {e}", exc_info=True)
+                # Изменения, пришедшие во время отрисовки (страниц может быть много), - еще один круг
+                if self._last_request[chat_key] <= render_started:
+                    break
+        finally:
+            if self._pending.get(chat_key) is asyncio.current_task():
+                del self._pending[chat_key]
+
+    async def flush_all(self):
+        """Дожидается всех запланированных перерисовок (при остановке сервера)."""
+        pending = [task for task in self._pending.values() if not task.done()]
+        if pending:
+            logger.info(f"Дожидаюсь {len(pending)} отложенных обновлений сообщения...")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+message_updates = MessageUpdateCoalescer(MESSAGE_EDIT_DEBOUNCE)
+
+
+def schedule_tasks_message_update(bot: Bot, chat_id: int):
+    return message_updates.schedule(bot, chat_id)
+
+
+# --- Последовательные изменения списка по чатам ---
+# Каждое изменение (чтение -> правка -> запись) идет под asyncio.Lock своего чата,
+# поэтому параллельные апдейты не затирают друг друга, а разные чаты не ждут друг друга.
+SLOW_LOCK_WAIT_WARNING = 1.0 # сек., после которого ожидание лока пишется в WARNING
+
+
+class ChatMutationLocks:
+    """Локи изменений по чатам + метрики очереди (глубина, время ожидания)."""
+
+    def __init__(self):
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._queue_depth: dict[str, int] = {}
+        self.stats = {"acquired": 0, "max_queue_depth": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    def queue_depth(self, chat_id) -> int:
+        """Сколько изменений сейчас ждут или держат лок чата."""
+        return self._queue_depth.get(str(chat_id), 0)
+
+    @asynccontextmanager
+    async def hold(self, chat_id):
+        chat_key = str(chat_id)
+        lock = self._locks.setdefault(chat_key, asyncio.Lock())
+        depth = self._queue_depth.get(chat_key, 0) + 1
+        self._queue_depth[chat_key] = depth
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], depth)
+        wait_start = time.monotonic()
+        try:
+            async with lock:
+                wait_time = time.monotonic() - wait_start
+                self.stats["acquired"] += 1
+                self.stats["total_wait"] += wait_time
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait_time)
+                if wait_time > SLOW_LOCK_WAIT_WARNING:
+                    logger.warning(f"Изменение списка чата {chat_key} ждало лок {wait_time:.2f} сек. (в очереди: {depth})")
+                yield
+        finally:
+            self._queue_depth[chat_key] -= 1
+            if not self._queue_depth[chat_key]:
+                del self._queue_depth[chat_key]
+
+
+chat_locks = ChatMutationLocks()
 
 
 # --- Команды ---
 
 async def setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (код без изменений) ...
-    user_id = update.message.from_user.id
-    setup_msg = await update.message.reply_text("Создаю хранилище задач...")
-    message_id_to_edit = setup_msg.message_id
-    try:
-        await context.bot.pin_chat_message(
-            chat_id=user_id, message_id=message_id_to_edit, disable_notification=True
-        )
-    except Exception as e:
-        await update.message.reply_text(f"Не удалось закрепить сообщение: {e}")
-        return
-    await setup_msg.edit_text(
-        "**Это твое хранилище задач.**\n\n"
-        "**Инструкция по настройке:**\n"
-         "1. Зайди в переменные окружения на Render.\n"
-         "2. `TARGET_CHAT_ID`:\n"
-         f"`{user_id}`\n"
-         "3. `MESSAGE_ID_TO_EDIT`:\n"
-         f"`{message_id_to_edit}`\n"
-         "4. (Для напоминаний) `REMINDER_SECRET`: придумай и впиши любой секретный ключ.\n"
-         "5. (Для парсера ДЗ) `MOODLE_SESSION_COOKIE`: вставь свою куки-сессию из KSE.\n"
-         "6. Сохрани. Render перезапустит бота.\n\n"
-         "Бот готов к работе."
+    """Создает и закрепляет сообщение со списком и регистрирует чат - без перезапуска бота."""
+    chat_id = update.effective_chat.id
+    async with chat_locks.hold(chat_id):
+        # Текущий список (в т.ч. владельца из TARGET_CHAT_ID) читаем до закрепления нового сообщения:
+        # без снимка он читается только из закрепленного, а после /setup закреплено уже новое
+        current_store = chat_registry.store(chat_id)
+        if current_store is not None and not await current_store.load(context.bot):
+            await update.message.reply_text("Не удалось прочитать текущий список задач, он не тронут. Попробуй /setup еще раз.")
+            return
+        setup_msg = await update.message.reply_text("Создаю хранилище задач...")
+        message_id_to_edit = setup_msg.message_id
+        try:
+            await context.bot.pin_chat_message(
+                chat_id=chat_id, message_id=message_id_to_edit, disable_notification=True
+            )
+        except Exception as e:
+            await update.message.reply_text(f"Не удалось закрепить сообщение: {e}")
+            return
+
+        task_store = chat_registry.register(chat_id, message_id_to_edit)
+        records = await task_store.get_records(context.bot)
+    await update_tasks_message(context.bot, chat_registry.get(chat_id), records)
+
+    await update.message.reply_text(
+        "*Закрепленное сообщение - твое хранилище задач.*\n\n"
+        "• `- задача 12.10` - добавить задачу (дата необязательна)\n"
+        "• `удали 2` или `удали 1 3 5` - удалить по номерам\n"
+        "• `/ask вопрос` или просто текст - спросить AI\n\n"
+        "Бот готов к работе.",
+        parse_mode="Markdown"
     )
 
 
+async def _get_chat_store(update: Update) -> TaskStore | None:
+    """TaskStore чата из апдейта; если чат не зарегистрирован - подсказывает /setup."""
+    task_store = chat_registry.store(update.effective_chat.id)
+    if task_store is None:
+        await update.message.reply_text("Сначала создай хранилище задач командой /setup.", quote=False)
+    return task_store
+
+
 async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (код без изменений) ...
-    tasks = await get_tasks_from_message(context.bot)
     text = update.message.text.strip().lstrip('-').strip()
     task_text, deadline_iso = parse_date_from_text(text)
     if not task_text: 
          logger.warning("Попытка добавить пустую задачу.")
          await update.message.delete()
          return
-    tasks.append({"task": task_text, "deadline": deadline_iso})
-    await update_tasks_message(context.bot, tasks)
+    task_store = await _get_chat_store(update)
+    if task_store is None:
+        return
+    async with chat_locks.hold(task_store.chat_id):
+        if await task_store.load(context.bot):
+            task_store.add(TaskRecord.from_dict({"task": task_text, "deadline": deadline_iso}))
+    schedule_tasks_message_update(context.bot, task_store.chat_id)
     await update.message.delete()
 
 
 # --- Команда удаления (Bulk Delete) ---
 async def remove_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (код без изменений) ...
-    tasks = await get_tasks_from_message(context.bot)
-    if not tasks:
-        await update.message.reply_text("❌ Список задач и так пуст.", quote=False)
-        return
-
     text = update.message.text.strip()
     indices_to_remove_str = re.findall(r'\d+', text)
 
@@ -449,48 +1420,39 @@ async def remove_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.delete()
         return
 
-    sorted_tasks_with_indices = sorted(
-        enumerate(tasks), 
-        key=lambda x: (
-            datetime.strptime(x[1]['deadline'], '%Y-%m-%d').date() if x[1].get('deadline') else date.max,
-            x[1].get('task', '') 
-        )
-    )
+    task_store = await _get_chat_store(update)
+    if task_store is None:
+        return
 
-    actual_indices_to_delete = set()
-    removed_tasks_names = []
-    invalid_indices = []
+    # Чтение, выбор и удаление - атомарно относительно других изменений этого чата
+    async with chat_locks.hold(task_store.chat_id):
+        # Хранилище отсортировано так же, как сообщение: номер = индекс + 1
+        tasks = await task_store.get_records(context.bot)
+        records_to_delete = []
+        invalid_indices = []
 
-    for display_index in indices_to_remove:
-        if 0 <= display_index < len(sorted_tasks_with_indices):
-            original_index = sorted_tasks_with_indices[display_index][0]
-            actual_indices_to_delete.add(original_index)
-            removed_tasks_names.append(sorted_tasks_with_indices[display_index][1].get('task', '')) 
-        else:
-            invalid_indices.append(display_index + 1) 
+        for display_index in sorted(indices_to_remove):
+            if 0 <= display_index < len(tasks):
+                records_to_delete.append(tasks[display_index])
+            else:
+                invalid_indices.append(display_index + 1) 
+
+        if records_to_delete:
+            task_store.remove(records_to_delete)
+        removed_tasks_names = [record.name for record in records_to_delete]
+
+    if not tasks:
+        await update.message.reply_text("❌ Список задач и так пуст.", quote=False)
+        return
 
     if invalid_indices:
         await update.message.reply_text(f"❌ Неверные номера: {', '.join(map(str, invalid_indices))}. Всего задач: {len(tasks)}.", quote=False)
 
-    if not actual_indices_to_delete:
+    if not records_to_delete:
         await update.message.delete()
         return 
 
-    # Создаем новый список задач, сохраняя порядок
-    new_tasks = []
-    original_indices_to_delete_sorted = sorted(list(actual_indices_to_delete), reverse=True) 
-    
-    temp_tasks = list(tasks) 
-    
-    for index_to_del in original_indices_to_delete_sorted:
-         if 0 <= index_to_del < len(temp_tasks):
-              del temp_tasks[index_to_del]
-         else:
-              logger.warning(f"Попытка удалить несуществующий индекс {index_to_del} при bulk delete.")
-              
-    new_tasks = temp_tasks
-
-    await update_tasks_message(context.bot, new_tasks)
+    schedule_tasks_message_update(context.bot, task_store.chat_id)
     
     if len(removed_tasks_names) == 1:
          confirmation_text = f"✅ Задача '{removed_tasks_names[0]}' удалена!"
@@ -504,9 +1466,458 @@ async def remove_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- Команда Ask Gemini ---
+# --- Потоковый ответ Gemini ---
+TELEGRAM_MESSAGE_LIMIT = 4096
+GEMINI_STREAM_EDIT_INTERVAL = float(os.getenv("GEMINI_STREAM_EDIT_INTERVAL", "1.0")) # сек. между правками одного сообщения
+STREAM_CURSOR = " ▌"
+GEMINI_FINAL_EDIT_RETRIES = 3 # Повторов финальной правки после RetryAfter
+
+
+def _split_message_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Режет текст на части <= limit, по возможности по переносу строки или пробелу."""
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut < limit // 2:
+            cut = limit # Длинное слово/ссылка - режем как есть
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    pages.append(text)
+    return pages
+
+
+class StreamingReply:
+    """
+    Показывает ответ по мере генерации: правит сообщение не чаще GEMINI_STREAM_EDIT_INTERVAL,
+    при переполнении 4096 символов дописывает ответ в новые сообщения.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, first_message):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.messages = [first_message]
+        self._shown: list[str] = [first_message.text or ""]
+        self._next_edit_at = 0.0 # Первый фрагмент показываем сразу
+
+    async def _show(self, index: int, text: str):
+        if index < len(self.messages):
+            if self._shown[index] == text:
+                return
+            try:
+                await self.messages[index].edit_text(text)
+            except error.BadRequest as e:
+                if "Message is not modified" not in str(e):
+                    raise
+            self._shown[index] = text
+        else:
+            self.messages.append(await self.bot.send_message(chat_id=self.chat_id, text=text))
+            self._shown.append(text)
+
+    async def _render(self, text: str, final: bool):
+        pages = _split_message_text(text)
+        # Заполненные страницы больше не меняются - дописываем их один раз
+        for index, page in enumerate(pages[:-1]):
+            await self._show(index, page)
+        last_page = pages[-1]
+        if not final and len(last_page) + len(STREAM_CURSOR) <= TELEGRAM_MESSAGE_LIMIT:
+            last_page += STREAM_CURSOR
+        await self._show(len(pages) - 1, last_page)
+
+    async def update(self, text: str, final: bool = False):
+        if final:
+            await self._finish(text)
+            return
+        now = time.monotonic()
+        if now < self._next_edit_at:
+            return
+        try:
+            await self._render(text, final=False)
+        except error.RetryAfter as e:
+            self._next_edit_at = now + _retry_after_seconds(e)
+            logger.warning(f"GEMINI: Лимит правок, пауза {_retry_after_seconds(e):.1f} сек.")
+            return
+        self._next_edit_at = now + GEMINI_STREAM_EDIT_INTERVAL
+
+    async def _finish(self, text: str):
+        """Финальная правка должна дойти (иначе на экране останется обрывок с курсором): ждем окно правок и повторяем после 429."""
+        for attempt in range(GEMINI_FINAL_EDIT_RETRIES + 1):
+            delay = self._next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self._render(text, final=True)
+                return
+            except error.RetryAfter as e:
+                if attempt == GEMINI_FINAL_EDIT_RETRIES:
+                    raise
+                self._next_edit_at = time.monotonic() + _retry_after_seconds(e)
+                logger.warning(f"GEMINI: Лимит правок перед финальной правкой, жду {_retry_after_seconds(e):.1f} сек.")
+
+
+# --- Кэш ответов Gemini ---
+GEMINI_CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", "3600")) # сек.
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "256"))
+GEMINI_CACHE_MAX_BYTES = int(os.getenv("GEMINI_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+
+
+def _normalize_prompt(prompt: str) -> str:
+    """Ключ кэша: регистр и лишние пробелы не делают вопрос новым."""
+    return " ".join(prompt.casefold().split())
+
+
+class GeminiResponseCache:
+    """LRU с TTL и ограничением по числу записей и суммарному размеру ответов (в байтах UTF-8)."""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[str, float, int]] = OrderedDict() # key -> (ответ, истекает, размер)
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expired": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    @property
+    def hit_rate(self) -> float:
+        """Доля вопросов, обошедшихся без нового запроса к модели (кэш или общий запрос в полете)."""
+        saved = self.stats["hits"] + self.stats["coalesced"]
+        lookups = saved + self.stats["misses"]
+        return saved / lookups if lookups else 0.0
+
+    def _drop(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        answer, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._drop(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return answer
+
+    def put(self, key: str, answer: str):
+        size = len(answer.encode("utf-8"))
+        if size > self.max_bytes:
+            return # Одна запись больше всего кэша - не храним
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (answer, time.monotonic() + self.ttl, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+
+class GeminiCall:
+    """Один запрос к модели, на который могут подписаться несколько одинаковых вопросов."""
+
+    def __init__(self):
+        self.answer = ""
+        self.finished = False
+        self.error: Exception | None = None
+        self.block_reason = ""
+        self.prompt_tokens: int | None = None # Из usage_metadata ответа
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def updates(self):
+        """Отдает текущий текст ответа при каждом изменении (промежуточные версии могут пропускаться)."""
+        seen = None
+        while True:
+            if self.answer != seen:
+                seen = self.answer
+                yield seen
+            if self.finished:
+                return
+            await self._changed.wait()
+
+
+# --- Шлюз к Gemini: ограничение параллельности и предохранитель ---
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "16")) # Сколько запросов может ждать свободного слота
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "60")) # сек. на весь ответ целиком
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")) # Ошибок подряд до размыкания
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30")) # сек. до пробного запроса
+
+
+class GeminiRejected(Exception):
+    """Запрос к Gemini отклонен шлюзом, не дойдя до модели."""
+
+
+class GeminiOverloaded(GeminiRejected):
+    pass
+
+
+class GeminiUnavailable(GeminiRejected):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class GeminiAdmission:
+    """Пропуск запроса через шлюз: пробный ли он и в каком "поколении" предохранителя принят."""
+    probe: bool
+    generation: int
+
+
+class GeminiGateway:
+    """
+    Не больше max_concurrency запросов к модели одновременно и не больше max_queue в ожидании;
+    сверх этого - мгновенный отказ. После threshold ошибок/таймаутов подряд предохранитель
+    размыкается на cooldown сек., затем пропускает один пробный запрос (half-open).
+    Замыкает предохранитель только успех пробного запроса; результаты запросов,
+    принятых до размыкания, на его состояние не влияют.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, threshold: int, cooldown: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending = 0 # Принятые запросы: выполняются + ждут слота
+        self._failures = 0
+        self.state = "closed" # closed | open | half_open
+        self._opened_until = 0.0
+        self._probe_in_flight = False
+        self._generation = 0 # Растет при каждом размыкании
+        self.stats = {"admitted": 0, "rejected_overload": 0, "rejected_open": 0, "failures": 0, "timeouts": 0, "trips": 0}
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def admit(self) -> GeminiAdmission:
+        """
+        Синхронно резервирует место в очереди (отказ должен быть мгновенным).
+        Вызывающий обязан вызвать release() и record_success()/record_failure() с полученным пропуском.
+        """
+        probe = False
+        if self.state == "open":
+            if time.monotonic() < self._opened_until:
+                self.stats["rejected_open"] += 1
+                raise GeminiUnavailable("предохранитель разомкнут")
+            self.state = "half_open"
+            logger.info("GEMINI: Предохранитель в режиме half-open, пропускаю пробный запрос.")
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                self.stats["rejected_open"] += 1
+                raise GeminiUnavailable("идет пробный запрос")
+            probe = True
+        if self._pending >= self.max_concurrency + self.max_queue:
+            self.stats["rejected_overload"] += 1
+            raise GeminiOverloaded(f"{self._pending} запросов в работе")
+        if probe:
+            self._probe_in_flight = True
+        self._pending += 1
+        self.stats["admitted"] += 1
+        return GeminiAdmission(probe, self._generation)
+
+    def release(self, admission: GeminiAdmission):
+        self._pending -= 1
+        if admission.probe:
+            self._probe_in_flight = False
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._semaphore:
+            yield
+
+    def record_success(self, admission: GeminiAdmission):
+        if admission.generation != self._generation:
+            return # Принят до размыкания - о восстановлении модели ничего не говорит
+        if admission.probe:
+            logger.info("GEMINI: Пробный запрос успешен, предохранитель замкнут.")
+            self.state = "closed"
+        if self.state == "closed":
+            self._failures = 0
+
+    def record_failure(self, admission: GeminiAdmission, timed_out: bool = False):
+        self.stats["failures"] += 1
+        if timed_out:
+            self.stats["timeouts"] += 1
+        if admission.generation != self._generation:
+            return # Уже учтено размыканием
+        self._failures += 1
+        if admission.probe or self._failures >= self.threshold:
+            self._trip()
+
+    def _trip(self):
+        self.stats["trips"] += 1
+        self._generation += 1
+        logger.warning(f"GEMINI: Предохранитель разомкнут на {self.cooldown:.0f} сек. ({self._failures} ошибок подряд).")
+        self.state = "open"
+        self._opened_until = time.monotonic() + self.cooldown
+
+
+gemini_gateway = GeminiGateway(GEMINI_MAX_CONCURRENCY, GEMINI_MAX_QUEUE, GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+gemini_cache = GeminiResponseCache(GEMINI_CACHE_TTL, GEMINI_CACHE_MAX_ENTRIES, GEMINI_CACHE_MAX_BYTES)
+_gemini_in_flight: dict[str, GeminiCall] = {}
+_gemini_call_tasks: set[asyncio.Task] = set()
+
+
+async def _stream_gemini_answer(call: GeminiCall, prompt: str):
+    started = time.perf_counter()
+    response = await model.generate_content_async(
+         prompt,
+         stream=True,
+         request_options={'timeout': GEMINI_CALL_TIMEOUT}
+    )
+    async for chunk in response:
+        usage = getattr(chunk, "usage_metadata", None)
+        if usage and usage.prompt_token_count:
+            call.prompt_tokens = usage.prompt_token_count
+        if not chunk.parts:
+            continue
+        if not call.answer:
+            gemini_first_token_seconds.observe(time.perf_counter() - started)
+        call.answer += "".join(part.text for part in chunk.parts)
+        call._notify()
+    if not call.answer and response.prompt_feedback and response.prompt_feedback.block_reason:
+        call.block_reason = f" Причина: {response.prompt_feedback.block_reason.name}"
+
+
+async def _run_gemini_call(call: GeminiCall, key: str, prompt: str, admission: GeminiAdmission):
+    started = None
+    outcome = "ok"
+    try:
+        async with gemini_gateway.slot():
+            started = time.perf_counter() # Без ожидания слота - его видно по очереди шлюза
+            await asyncio.wait_for(_stream_gemini_answer(call, prompt), timeout=GEMINI_CALL_TIMEOUT)
+        gemini_gateway.record_success(admission)
+        if call.prompt_tokens:
+            _record_prompt_tokens(call.prompt_tokens, prompt)
+        if call.answer:
+            gemini_cache.put(key, call.answer)
+    except asyncio.TimeoutError as e:
+        outcome = "timeout"
+        gemini_gateway.record_failure(admission, timed_out=True)
+        call.error = e
+    except Exception as e:
+        outcome = "error"
+        gemini_gateway.record_failure(admission)
+        call.error = e
+    finally:
+        if started is not None:
+            gemini_call_seconds.observe(time.perf_counter() - started, outcome)
+        gemini_gateway.release(admission)
+        call.finished = True
+        _gemini_in_flight.pop(key, None)
+        call._notify()
+
+
+def get_gemini_call(prompt: str) -> tuple[GeminiCall | None, str | None]:
+    """
+    Возвращает (запрос, None) - новый или уже идущий такой же,
+    либо (None, ответ) из кэша. Новый запрос может быть отклонен шлюзом (GeminiRejected).
+    """
+    key = _normalize_prompt(prompt)
+    call = _gemini_in_flight.get(key)
+    if call is not None:
+        gemini_cache.stats["coalesced"] += 1
+        return call, None
+    cached = gemini_cache.get(key)
+    if cached is not None:
+        return None, cached
+    admission = gemini_gateway.admit()
+    call = GeminiCall()
+    _gemini_in_flight[key] = call
+    # Отдельная задача: отмена одного обработчика не обрывает ответ остальным
+    call_task = asyncio.create_task(_run_gemini_call(call, key, prompt, admission))
+    _gemini_call_tasks.add(call_task)
+    call_task.add_done_callback(_gemini_call_tasks.discard)
+    return call, None
+
+
+# --- Контекст задач для Gemini ---
+GEMINI_TASK_CONTEXT = os.getenv("GEMINI_TASK_CONTEXT", "0") == "1" # По умолчанию выкл.: лишние токены в каждом вопросе
+GEMINI_TASK_CONTEXT_TOKENS = int(os.getenv("GEMINI_TASK_CONTEXT_TOKENS", "600")) # Бюджет на список задач
+_WEEKDAYS_RU = ("пн", "вт", "ср", "чт", "пт", "сб", "вс")
+
+# chat_id -> ((message_id, revision, today), текст). Пересобирается, только когда список изменился (или наступил новый день).
+_task_context_cache: dict[int, tuple[tuple, str]] = {}
+task_context_stats = {"builds": 0, "hits": 0, "build_seconds": 0.0}
+prompt_token_stats = {"requests": 0, "total": 0, "max": 0, "estimated_total": 0}
+
+
+def _estimate_tokens(text: str) -> int:
+    """Грубая оценка без токенизатора: ~3 символа на токен для смеси кириллицы и латиницы."""
+    return len(text) // 3 + 1
+
+
+def _record_prompt_tokens(prompt_tokens: int, prompt: str):
+    prompt_token_stats["requests"] += 1
+    prompt_token_stats["total"] += prompt_tokens
+    prompt_token_stats["max"] = max(prompt_token_stats["max"], prompt_tokens)
+    prompt_token_stats["estimated_total"] += _estimate_tokens(prompt)
+    logger.info(f"GEMINI: Промпт {prompt_tokens} токенов (оценка {_estimate_tokens(prompt)}).")
+
+
+def _build_task_context(records: list[TaskRecord], today: date, token_budget: int) -> str:
+    header = f"Список задач пользователя (сегодня {today:%d.%m.%Y}, {_WEEKDAYS_RU[today.weekday()]}):"
+    lines = [header]
+    budget = token_budget - _estimate_tokens(header)
+    for index, record in enumerate(records):
+        if record.deadline is None:
+            line = f"- {record.name} (без дедлайна)"
+        else:
+            days_left = (record.deadline - today).days
+            when = "просрочено" if days_left < 0 else "сегодня" if days_left == 0 else f"через {days_left} дн."
+            line = f"- {record.deadline:%d.%m} ({_WEEKDAYS_RU[record.deadline.weekday()]}, {when}): {record.name}"
+        cost = _estimate_tokens(line)
+        if cost > budget:
+            # Записи отсортированы по дедлайну - отбрасываем самые дальние
+            lines.append(f"...и еще {len(records) - index} задач с более поздними дедлайнами.")
+            break
+        lines.append(line)
+        budget -= cost
+    return "\n".join(lines)
+
+
+async def get_task_context(bot: Bot, chat_id: int) -> str | None:
+    """Краткая сводка задач чата для промпта или None (режим выключен / чат не зарегистрирован / задач нет)."""
+    if not GEMINI_TASK_CONTEXT:
+        return None
+    task_store = chat_registry.store(chat_id)
+    if task_store is None:
+        return None
+    records = await task_store.get_records(bot)
+    if not records:
+        return None
+    today = date.today()
+    cache_key = (task_store.message_id, task_store.revision, today)
+    cached = _task_context_cache.get(chat_id)
+    if cached is not None and cached[0] == cache_key:
+        task_context_stats["hits"] += 1
+        return cached[1]
+    started = time.perf_counter()
+    summary = _build_task_context(records, today, GEMINI_TASK_CONTEXT_TOKENS)
+    task_context_stats["builds"] += 1
+    task_context_stats["build_seconds"] += time.perf_counter() - started
+    _task_context_cache[chat_id] = (cache_key, summary)
+    return summary
+
+
 async def ask_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (код без изменений) ...
-    if not model:
+    if not await get_gemini_model():
         await update.message.reply_text("Ключ Gemini API не настроен.")
         return
     question = update.message.text
@@ -516,35 +1927,99 @@ async def ask_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"Получен вопрос для Gemini: '{question}'")
     prompt = f"Ответь на вопрос: {question}\n\nВАЖНО: Ответ до 2000 символов."
+    task_context = await get_task_context(context.bot, update.effective_chat.id)
+    if task_context:
+        prompt = f"{task_context}\n\nЕсли вопрос касается задач или дедлайнов - опирайся на этот список.\n{prompt}"
+    try:
+        call, cached_answer = get_gemini_call(prompt)
+    except GeminiOverloaded as e:
+        logger.warning(f"GEMINI: Отказ, очередь заполнена ({e}).")
+        await update.message.reply_text("Слишком много вопросов сразу, попробуй через минуту.")
+        return
+    except GeminiUnavailable as e:
+        logger.warning(f"GEMINI: Отказ, {e}.")
+        await update.message.reply_text("AI временно недоступен, попробуй позже.")
+        return
+    if cached_answer is not None:
+        logger.info(f"GEMINI: Ответ из кэша (hit rate {gemini_cache.hit_rate:.0%}, {len(gemini_cache)} записей).")
+        for page in _split_message_text(cached_answer):
+            await update.message.reply_text(page)
+        return
+
     waiting_msg = await update.message.reply_text("🤔 Думаю...")
+    reply = StreamingReply(context.bot, update.effective_chat.id, waiting_msg)
+    answer = ""
 
     try:
-        response = await model.generate_content_async(
-             prompt,
-             request_options={'timeout': 60} 
-        )
-        if response.parts:
-             answer = "".join(part.text for part in response.parts)
-             logger.info(f"Gemini ответил: '{answer[:50]}...'")
-             await waiting_msg.edit_text(answer)
+        async for answer in call.updates():
+            if answer:
+                await reply.update(answer)
+
+        if call.error is not None:
+            raise call.error
+        if answer:
+             logger.info(f"Gemini ответил: '{answer[:50]}...' ({len(answer)} симв., {len(reply.messages)} сообщ.)")
+             await reply.update(answer, final=True)
         else:
-             logger.warning("Gemini вернул пустой ответ (возможно, сработали safety settings).")
-             block_reason = ""
-             if response.prompt_feedback and response.prompt_feedback.block_reason:
-                 block_reason = f" Причина: {response.prompt_feedback.block_reason.name}"
+             logger.warning(f"Gemini вернул пустой ответ (возможно, сработали safety settings).{call.block_reason}")
              await waiting_msg.edit_text("Извините, не могу сгенерировать ответ на этот запрос.")
 
-
     except Exception as e:
         logger.error(f"Ошибка Gemini: {e}", exc_info=True)
-        await waiting_msg.edit_text("Произошла ошибка при обращении к AI.")
+        try:
+            if answer:
+                # Часть ответа уже на экране - не затираем ее
+                await reply.update(answer + "\n\n⚠️ Ответ прерван из-за ошибки.", final=True)
+            else:
+                await waiting_msg.edit_text("Произошла ошибка при обращении к AI.")
+        except error.TelegramError as send_error:
+            logger.error(f"Не удалось сообщить об ошибке Gemini: {send_error}")
+
+
+# --- Снимок состояния вебхука (быстрый холодный старт) ---
+# Если вебхук уже ставили на этот URL этим токеном, на старте не тратим два запроса к Bot API:
+# проверка уходит в фон, после того как сервер начал отвечать.
+WEBHOOK_STATE_FILE = os.getenv("WEBHOOK_STATE_FILE", os.path.join(DATA_DIR, "webhook.json"))
+WEBHOOK_ALLOWED_UPDATES = ["message"] # Устанавливаем вебхук, чтобы он принимал ТОЛЬКО 'message'
+_webhook_check_task: asyncio.Task | None = None
+
+
+def _webhook_fingerprint(full_webhook_url: str) -> dict:
+    return {
+        "url": full_webhook_url,
+        "allowed_updates": WEBHOOK_ALLOWED_UPDATES,
+        "bot": hashlib.sha256(TOKEN.encode()).hexdigest()[:16], # Сам токен на диск не пишем
+    }
+
+
+async def ensure_webhook(bot: Bot, full_webhook_url: str):
+    current_webhook = await bot.get_webhook_info()
+    if current_webhook.url != full_webhook_url:
+        logger.info(f"Устанавливаю вебхук: {full_webhook_url}")
+        await bot.set_webhook(full_webhook_url, allowed_updates=WEBHOOK_ALLOWED_UPDATES)
+    else:
+        logger.info(f"Вебхук уже установлен: {current_webhook.url}")
+    try:
+        _atomic_write_json(WEBHOOK_STATE_FILE, _webhook_fingerprint(full_webhook_url))
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить {WEBHOOK_STATE_FILE}: {e}")
+
+
+async def _verify_webhook_in_background(bot: Bot, full_webhook_url: str):
+    try:
+        await ensure_webhook(bot, full_webhook_url)
+    except Exception as e:
+        logger.error(f"Фоновая проверка вебхука не удалась: {e}")
 
 
 # --- Настройка сервера FastAPI ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # ... (код с исправлением _initialized) ...
+    global _webhook_check_task
     logger.info("FastAPI приложение запускается (lifespan start)...")
+    # Списки задач - с диска, без чтения закрепленных сообщений
+    logger.info(f"Снимки задач загружены для {chat_registry.load_snapshots()} чатов.")
     if TOKEN and application:
         try:
             if not application._initialized: # Use the private attribute
@@ -552,20 +2027,22 @@ async def lifespan(app: FastAPI):
                 logger.info("Telegram Application инициализировано.")
             else:
                 logger.info("Telegram Application уже было инициализировано.")
+            update_ingress.start(application)
             
             webhook_url = os.getenv("RENDER_EXTERNAL_URL") 
             if webhook_url:
                  full_webhook_url = f"{webhook_url}/{URL_PATH}"
-                 current_webhook = await application.bot.get_webhook_info()
-                 if current_webhook.url != full_webhook_url:
-                      logger.info(f"Устанавливаю вебхук: {full_webhook_url}")
-                      # Устанавливаем вебхук, чтобы он принимал ТОЛЬКО 'message'
-                      await application.bot.set_webhook(full_webhook_url, allowed_updates=["message"]) 
+                 if _read_json_file(WEBHOOK_STATE_FILE, None) == _webhook_fingerprint(full_webhook_url):
+                      logger.info("Вебхук совпадает со снимком, проверяю в фоне.")
+                      _webhook_check_task = asyncio.create_task(_verify_webhook_in_background(application.bot, full_webhook_url))
                  else:
-                      logger.info(f"Вебхук уже установлен: {current_webhook.url}")
+                      await ensure_webhook(application.bot, full_webhook_url)
             else:
                  logger.warning("RENDER_EXTERNAL_URL не найден, не могу установить вебхук автоматически.")
 
+            if SCHEDULER_ENABLED:
+                deadline_scheduler.start(application.bot)
+
         except Exception as e:
             logger.error(f"Ошибка инициализации Telegram Application или установки вебхука: {e}", exc_info=True)
     elif not TOKEN:
@@ -575,19 +2052,42 @@ async def lifespan(app: FastAPI):
     yield 
     
     logger.info("FastAPI приложение останавливается (lifespan shutdown)...")
+    if _webhook_check_task is not None and not _webhook_check_task.done():
+        _webhook_check_task.cancel()
+    await update_ingress.stop()
+    await deadline_scheduler.stop()
+    await message_updates.flush_all()
+    await chat_registry.flush_all()
     if application and application._initialized: # Используем _initialized
         try:
             await application.shutdown()
             logger.info("Telegram Application остановлено.")
         except Exception as e:
             logger.error(f"Ошибка остановки Telegram Application: {e}", exc_info=True)
+    await close_http_client()
+    reminder_ledger.close()
     logger.info("FastAPI приложение остановлено.")
 
 
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest бота с замером каждого вызова Bot API (метка - метод: sendMessage, editMessageText...)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            telegram_api_seconds.observe(time.perf_counter() - started, url.rsplit("/", 1)[-1])
+
+
 api = FastAPI(lifespan=lifespan)
 if TOKEN:
     try:
-        application = Application.builder().token(TOKEN).build()
+        # Размер пула как у ApplicationBuilder по умолчанию
+        builder = Application.builder().token(TOKEN).request(InstrumentedHTTPXRequest(connection_pool_size=256))
+        if os.getenv("TELEGRAM_BASE_URL"): # Локальный Bot API сервер (или заглушка в бенчмарке)
+            builder = builder.base_url(os.getenv("TELEGRAM_BASE_URL"))
+        application = builder.build()
         logger.info("Telegram Application создано.")
     except Exception as e:
         logger.critical(f"Критическая ошибка при создании Telegram Application: {e}. Бот не будет работать.", exc_info=True)
@@ -622,19 +2122,147 @@ else:
 URL_PATH = os.getenv("WEBHOOK_SECRET", "webhook")
 @api.post(f"/{URL_PATH}")
 async def process_telegram_update(request: Request):
-    # ... (код без изменений) ...
+    # Только проверка и постановка в очередь: Telegram получает 200 сразу,
+    # а Gemini/Moodle работают уже в воркерах и не держат соединение вебхука.
+    started = time.perf_counter()
     if not application:
         logger.error("Получен Telegram update, но Application не инициализировано.")
         return Response(status_code=500, content="Bot not initialized")
     try:
-        data = await request.json()
-        logger.debug(f"Получен Telegram update: {data}") 
-        update = Update.de_json(data, application.bot)
-        await application.process_update(update)
+        data = _json_loads(await request.body())
+    except ValueError as e:
+        logger.warning(f"Telegram update: невалидный JSON ({e}).")
+        return Response(status_code=400)
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        logger.warning("Telegram update без update_id, пропускаю.")
+        return Response(status_code=400)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Получен Telegram update: {data}")
+    if not _has_update_handler(data):
+        # Стикеры, фото, правки и т.п. - ни один хэндлер их не возьмет, Update не строим
+        update_ingress.stats["filtered"] += 1
         return Response(status_code=200)
-    except Exception as e:
-        logger.error(f"Ошибка обработки Telegram update: {e}", exc_info=True)
-        return Response(status_code=500)
+
+    if not update_ingress.running:
+        # Воркеры не запущены (ошибка старта) - обрабатываем по-старому, прямо в запросе
+        try:
+            await application.process_update(Update.de_json(data, application.bot))
+            return Response(status_code=200)
+        except Exception as e:
+            logger.error(f"Ошибка обработки Telegram update: {e}", exc_info=True)
+            return Response(status_code=500)
+
+    status_code = update_ingress.submit(data)
+    update_ingress.record_latency(time.perf_counter() - started)
+    return Response(status_code=status_code)
+
+
+def _has_update_handler(data: dict) -> bool:
+    """Все хэндлеры бота - текстовые (команды и MessageHandler с filters.TEXT) на обычных сообщениях."""
+    message = data.get("message")
+    return isinstance(message, dict) and isinstance(message.get("text"), str)
+
+
+# --- Очередь входящих апдейтов ---
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "256"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_DEDUP_WINDOW = 1024 # Сколько последних update_id помнить для отсева повторов Telegram
+INGRESS_LATENCY_WINDOW = 2048 # Последние замеры для перцентилей
+
+
+class UpdateIngress:
+    """
+    Ограниченная очередь апдейтов и пул воркеров, которые передают их в Application.
+    Повторная доставка того же update_id (Telegram ретраит, если не дождался ответа) отбрасывается.
+    """
+
+    def __init__(self, maxsize: int, workers: int, dedup_window: int):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._queue: asyncio.Queue | None = None
+        self._worker_tasks: list[asyncio.Task] = []
+        self._recent_ids: set[int] = set()
+        self._recent_order: deque[int] = deque(maxlen=dedup_window)
+        self._latencies: deque[float] = deque(maxlen=INGRESS_LATENCY_WINDOW)
+        self.stats = {"accepted": 0, "filtered": 0, "duplicates": 0, "rejected_full": 0, "processed": 0, "failed": 0}
+
+    @property
+    def running(self) -> bool:
+        return bool(self._worker_tasks)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self, app: Application):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._worker_tasks = [asyncio.create_task(self._worker(app, n)) for n in range(self.workers)]
+        logger.info(f"INGRESS: Запущено {self.workers} воркеров, очередь до {self.maxsize} апдейтов.")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"INGRESS: Не дождался обработки {self.queue_depth()} апдейтов при остановке.")
+        for worker_task in self._worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        logger.info(f"INGRESS: Остановлено. {self.stats}, p99 приема {self.latency_percentile(0.99) * 1000:.2f} мс.")
+
+    def _remember(self, update_id: int):
+        if len(self._recent_order) == self._recent_order.maxlen:
+            self._recent_ids.discard(self._recent_order[0])
+        self._recent_order.append(update_id)
+        self._recent_ids.add(update_id)
+
+    def submit(self, data: dict) -> int:
+        """Ставит апдейт в очередь без ожидания. Возвращает HTTP-статус для Telegram."""
+        update_id = data["update_id"]
+        if update_id in self._recent_ids:
+            self.stats["duplicates"] += 1
+            logger.info(f"INGRESS: Повтор update_id {update_id}, пропускаю.")
+            return 200
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Не 200: Telegram доставит апдейт повторно позже, и он не потеряется
+            self.stats["rejected_full"] += 1
+            logger.warning(f"INGRESS: Очередь заполнена ({self.maxsize}), update_id {update_id} отклонен.")
+            return 503
+        self._remember(update_id)
+        self.stats["accepted"] += 1
+        return 200
+
+    def record_latency(self, seconds: float):
+        self._latencies.append(seconds)
+        webhook_ingress_seconds.observe(seconds)
+
+    def latency_percentile(self, q: float) -> float:
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def _worker(self, app: Application, n: int):
+        while True:
+            data = await self._queue.get()
+            started = time.perf_counter()
+            try:
+                await app.process_update(Update.de_json(data, app.bot))
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"INGRESS[{n}]: Ошибка обработки update {data.get('update_id')}: {e}", exc_info=True)
+            finally:
+                update_processing_seconds.observe(time.perf_counter() - started)
+                self._queue.task_done()
+
+
+update_ingress = UpdateIngress(UPDATE_QUEUE_SIZE, UPDATE_WORKERS, UPDATE_DEDUP_WINDOW)
 
 
 # --- Эндпоинт-"будильник" /health ---
@@ -649,101 +2277,520 @@ async def health_check():
         return Response(status_code=503, content='{"status": "initializing_or_failed"}')
 
 
+# --- Эндпоинт /metrics ---
+# Счетчики, которые модули уже ведут в своих словарях, читаются в момент запроса - без двойного учета.
+metrics.register(CallbackMetric("bot_kse_cache_total", "Кэш страниц курсов KSE.", "counter", "result",
+                                lambda: homework_cache_stats))
+metrics.register(CallbackMetric("bot_gemini_cache_total", "Кэш ответов Gemini.", "counter", "result",
+                                lambda: gemini_cache.stats))
+metrics.register(CallbackMetric("bot_task_context_total", "Сводка задач для Gemini: пересборки и попадания в кэш.", "counter", "result",
+                                lambda: {"builds": task_context_stats["builds"], "hits": task_context_stats["hits"]}))
+metrics.register(CallbackMetric("bot_gemini_prompt_tokens_total", "Токены промптов Gemini (по usage_metadata).", "counter", "kind",
+                                lambda: {"measured": prompt_token_stats["total"], "estimated": prompt_token_stats["estimated_total"]}))
+metrics.register(CallbackMetric("bot_gemini_gateway_total", "Шлюз Gemini: принятые, отклоненные, ошибки.", "counter", "event",
+                                lambda: gemini_gateway.stats))
+metrics.register(CallbackMetric("bot_updates_total", "Апдейты вебхука по исходу.", "counter", "result",
+                                lambda: update_ingress.stats))
+metrics.register(CallbackMetric("bot_reminders_total", "Напоминания по исходу отправки.", "counter", "result",
+                                lambda: reminder_dispatcher.totals))
+metrics.register(CallbackMetric("bot_chat_lock_total", "Блокировки изменений списка: захваты и суммарное ожидание (сек.).", "counter", "stat",
+                                lambda: {"acquired": chat_locks.stats["acquired"], "wait_seconds": chat_locks.stats["total_wait"]}))
+metrics.register(CallbackMetric("bot_in_flight", "Работа в полете прямо сейчас.", "gauge", "kind", lambda: {
+    "update_queue": update_ingress.queue_depth(),
+    "gemini_requests": gemini_gateway.pending,
+    "gemini_streams": len(_gemini_in_flight),
+    "scheduler_jobs": len(deadline_scheduler._running_jobs),
+    "message_edits": sum(1 for pending in message_updates._pending.values() if not pending.done()),
+    "asyncio_tasks": len(asyncio.all_tasks()),
+}))
+metrics.register(CallbackMetric("bot_gemini_cache_size", "Размер кэша ответов Gemini.", "gauge", "unit",
+                                lambda: {"entries": len(gemini_cache), "bytes": gemini_cache.size_bytes}))
+
+
+@api.get("/metrics")
+async def metrics_endpoint():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# --- Рассылка напоминаний с учетом лимитов Telegram ---
+# Лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25")) # сообщений/сек, с запасом
+TELEGRAM_PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1")) # сообщений/сек в один чат
+REMINDER_MAX_RETRIES = int(os.getenv("REMINDER_MAX_RETRIES", "3"))
+
+
+class TokenBucket:
+    """Token bucket: `rate` токенов в секунду, не больше `capacity` накопленных."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def block_for(self, seconds: float):
+        """Никому не выдавать токены `seconds` секунд (после 429 от Telegram)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def restart_refill(self):
+        """Токен ушел в дело только сейчас (ждали другой лимит): пополнение считается с этого момента."""
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_after_seconds(e: error.RetryAfter) -> float:
+    retry_after = e.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class ReminderDispatcher:
+    """
+    Отправляет пачку сообщений параллельно в пределах общего и по-чатового лимита,
+    повторяет при RetryAfter (429) и сетевых ошибках с экспоненциальной задержкой.
+    """
+
+    def __init__(self, global_rate: float, per_chat_rate: float, max_retries: int):
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._chat_turns: dict[int, asyncio.Lock] = {}
+        self.totals = {"sent": 0, "throttled": 0, "failed": 0}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+        return bucket
+
+    def _chat_turn(self, chat_id: int) -> asyncio.Lock:
+        return self._chat_turns.setdefault(chat_id, asyncio.Lock())
+
+    async def _send_one(self, bot: Bot, reminder: "Reminder", stats: dict) -> bool:
+        chat_id = reminder.chat_id
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            # Очередь на чат: следующее сообщение в этот чат берет токен только после того, как ушло текущее
+            async with self._chat_turn(chat_id):
+                await chat_bucket.acquire()
+                await self._global_bucket.acquire()
+                # Пока ждали общий лимит, по-чатовый не должен копить токен - иначе два сообщения в чат уйдут подряд
+                chat_bucket.restart_refill()
+            try:
+                await bot.send_message(chat_id=chat_id, text=reminder.text, parse_mode="Markdown")
+                stats["sent"] += 1
+                return True
+            except error.RetryAfter as e:
+                stats["throttled"] += 1
+                delay = max(_retry_after_seconds(e), 2 ** attempt)
+                chat_bucket.block_for(delay)
+                logger.warning(f"REMINDERS: 429 для чата {chat_id}, жду {delay:.1f} сек. (попытка {attempt + 1})")
+            except (error.BadRequest, error.Forbidden) as e:
+                # Повтор не поможет: чат удален, бот заблокирован, битый Markdown и т.п.
+                logger.error(f"REMINDERS: Не удалось отправить напоминание в чат {chat_id}: {e}")
+                break
+            except error.NetworkError as e:
+                delay = 0.5 * 2 ** attempt
+                logger.warning(f"REMINDERS: Сетевая ошибка для чата {chat_id}: {e}. Повтор через {delay:.1f} сек.")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.error(f"REMINDERS: Ошибка отправки напоминания в чат {chat_id}: {e}", exc_info=True)
+                break
+        stats["failed"] += 1
+        return False
+
+    async def _send_and_record(self, bot: Bot, reminder: "Reminder", stats: dict):
+        sent = False
+        try:
+            sent = await self._send_one(bot, reminder, stats)
+        finally:
+            if reminder.ledger_key:
+                reminder_ledger.finish(reminder.ledger_key, sent)
+
+    async def dispatch(self, bot: Bot, reminders: list["Reminder"]) -> dict:
+        """Отправляет напоминания; возвращает счетчики sent/throttled/failed."""
+        stats = {"sent": 0, "throttled": 0, "failed": 0}
+        if reminders:
+            await asyncio.gather(*(self._send_and_record(bot, reminder, stats) for reminder in reminders))
+        for key, value in stats.items():
+            self.totals[key] += value
+        return stats
+
+
+reminder_dispatcher = ReminderDispatcher(TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE, REMINDER_MAX_RETRIES)
+
+
+# --- Журнал отправленных напоминаний ---
+# Повторные вызовы /check_reminders в тот же день не шлют то же напоминание еще раз.
+# Ключ: (чат, задача, дедлайн, вид напоминания); запись живет до конца дня дедлайна.
+REMINDER_LEDGER_FILE = os.getenv("REMINDER_LEDGER_FILE", os.path.join(DATA_DIR, "reminders.sqlite3"))
+
+
+class ReminderLedger:
+    """Множество отправленных напоминаний в памяти + SQLite-файл, чтобы пережить перезапуск."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._sent: dict[tuple, date] | None = None # ключ -> дата истечения
+        self._in_flight: set[tuple] = set() # уже отданы в рассылку, ответа еще нет
+        self._pruned_on: date | None = None
+        self._db: sqlite3.Connection | None = None
+
+    def _ensure_loaded(self) -> dict[tuple, date]:
+        if self._sent is None:
+            self._sent = {}
+            try:
+                self._db = sqlite3.connect(self.path)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS sent_reminders ("
+                    "chat_id INTEGER, task TEXT, deadline TEXT, kind TEXT, expires TEXT, "
+                    "PRIMARY KEY (chat_id, task, deadline, kind)) WITHOUT ROWID"
+                )
+                for chat_id, task, deadline, kind, expires in self._db.execute("SELECT * FROM sent_reminders"):
+                    self._sent[(chat_id, task, deadline, kind)] = date.fromisoformat(expires)
+                logger.info(f"ReminderLedger: Загружено {len(self._sent)} записей из {self.path}.")
+            except sqlite3.Error as e:
+                # Без файла журнал работает только в памяти
+                logger.error(f"ReminderLedger: Не удалось открыть {self.path}: {e}")
+                self._db = None
+        self._prune()
+        return self._sent
+
+    def _prune(self):
+        """Удаляет записи, чей дедлайн уже прошел (раз в день)."""
+        today = date.today()
+        if self._pruned_on == today:
+            return
+        self._pruned_on = today
+        expired = [key for key, expires in self._sent.items() if expires < today]
+        for key in expired:
+            del self._sent[key]
+        if expired and self._db is not None:
+            try:
+                with self._db:
+                    self._db.execute("DELETE FROM sent_reminders WHERE expires < ?", (today.isoformat(),))
+            except sqlite3.Error as e:
+                logger.error(f"ReminderLedger: Не удалось удалить устаревшие записи: {e}")
+
+    def reserve(self, chat_id: int, task: TaskRecord, kind: str) -> tuple | None:
+        """Ключ для отправки или None, если напоминание уже отправлено/отправляется."""
+        key = (chat_id, task.name, task.deadline.isoformat(), kind)
+        if key in self._ensure_loaded() or key in self._in_flight:
+            return None
+        self._in_flight.add(key)
+        return key
+
+    def finish(self, key: tuple, sent: bool):
+        """Фиксирует результат отправки; неудачное напоминание можно будет отправить снова."""
+        self._in_flight.discard(key)
+        if not sent:
+            return
+        expires = date.fromisoformat(key[2])
+        self._ensure_loaded()[key] = expires
+        if self._db is not None:
+            try:
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO sent_reminders VALUES (?, ?, ?, ?, ?)", (*key, expires.isoformat()))
+            except sqlite3.Error as e:
+                logger.error(f"ReminderLedger: Не удалось записать напоминание: {e}")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+reminder_ledger = ReminderLedger(REMINDER_LEDGER_FILE)
+
+
+@dataclass(slots=True)
+class Reminder:
+    chat_id: int
+    text: str
+    ledger_key: tuple | None = None
+
+
+async def collect_due_reminders(bot: Bot) -> list[Reminder]:
+    """Еще не отправленные напоминания "сегодня"/"завтра" по всем зарегистрированным чатам."""
+    reminders = []
+    today = date.today()
+    for chat in chat_registry.chats():
+        for task in await chat_registry.store(chat.chat_id).get_records(bot):
+            if not task.deadline:
+                continue
+            days_left = (task.deadline - today).days
+            if days_left == 0:
+                kind, text = "today", f"❗️ **НАПОМИНАНИЕ (дедлайн сегодня):**\n{task.name}"
+            elif days_left == 1:
+                kind, text = "tomorrow", f"🔔 **НАПОМИНАНИЕ (дедлайн завтра):**\n{task.name}"
+            else:
+                continue
+            ledger_key = reminder_ledger.reserve(chat.chat_id, task, kind)
+            if ledger_key is not None:
+                reminders.append(Reminder(chat.chat_id, text, ledger_key))
+    return reminders
+
+
+async def send_reminders(bot: Bot, reminders: list[Reminder]):
+    """Фоновая рассылка напоминаний (эндпоинт не ждет ее окончания)."""
+    start_time = time.time()
+    stats = await reminder_dispatcher.dispatch(bot, reminders)
+    logger.info(f"REMINDERS: Рассылка завершена за {time.time() - start_time:.2f} сек.: {stats} (всего: {reminder_dispatcher.totals})")
+
+
+# --- Встроенный планировщик (вместо внешнего крона) ---
+# Min-heap событий; цикл спит ровно до ближайшего события или до добавления нового.
+# /check_reminders остается как ручной запуск.
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+REMINDER_HOUR = int(os.getenv("REMINDER_HOUR", "9")) # Час (время сервера), в который шлются напоминания
+KSE_PARSE_INTERVAL = float(os.getenv("KSE_PARSE_INTERVAL", str(6 * 3600))) # сек.
+SCHEDULER_STARTUP_DELAY = 30.0 # сек., первый прогон после старта - догоняем пропущенное, пока инстанс спал
+ADHOC_REMINDER_DELAY = 60.0 # сек., задержка напоминания о только что добавленной срочной задаче
+
+
+def _next_daily_run(hour: int, after: float) -> float:
+    """Ближайшее `hour`:00 по времени сервера строго после `after` (epoch)."""
+    after_dt = datetime.fromtimestamp(after)
+    run_dt = after_dt.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if run_dt <= after_dt:
+        run_dt += timedelta(days=1)
+    return run_dt.timestamp()
+
+
+@dataclass(order=True, slots=True)
+class ScheduledJob:
+    when: float # epoch
+    seq: int # порядок для одинакового `when`
+    name: str = field(compare=False)
+    job: Callable[[], Awaitable] = field(compare=False)
+    next_run: Callable[[float], float] | None = field(compare=False, default=None) # для повторяющихся
+
+
+class DeadlineScheduler:
+    """Планировщик на asyncio: heapq с событиями, без опроса по таймеру."""
+
+    def __init__(self):
+        self._heap: list[ScheduledJob] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._loop_task: asyncio.Task | None = None
+        self._running_jobs: set[asyncio.Task] = set()
+        self._adhoc_reminder_at: float | None = None
+        self._bot: Bot | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._loop_task is not None and not self._loop_task.done()
+
+    def schedule(self, when: float, name: str, job: Callable[[], Awaitable], next_run: Callable[[float], float] | None = None):
+        heapq.heappush(self._heap, ScheduledJob(when, next(self._seq), name, job, next_run))
+        if self._heap[0].when == when:
+            self._wakeup.set() # Новое событие раньше текущего сна - пересчитываем
+        logger.info(f"SCHEDULER: '{name}' запланирован на {datetime.fromtimestamp(when):%Y-%m-%d %H:%M:%S}.")
+
+    def start(self, bot: Bot):
+        if self.running:
+            return
+        now = time.time()
+        self.schedule(now + SCHEDULER_STARTUP_DELAY, "reminders", lambda: self._run_reminders(bot),
+                      next_run=lambda last: _next_daily_run(REMINDER_HOUR, last))
+        if OWNER_CHAT_ID is not None:
+            self.schedule(now + SCHEDULER_STARTUP_DELAY, "kse_parse", lambda: run_parser_and_update(bot),
+                          next_run=lambda last: max(last + KSE_PARSE_INTERVAL, time.time()))
+        self._bot = bot
+        self._loop_task = asyncio.create_task(self._run_loop())
+        logger.info("SCHEDULER: Запущен.")
+
+    async def stop(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+        for job_task in list(self._running_jobs):
+            job_task.cancel()
+        logger.info("SCHEDULER: Остановлен.")
+
+    def on_deadlines_added(self, deadlines):
+        """
+        Срочная задача (дедлайн сегодня/завтра), добавленная после ежедневной рассылки,
+        получает напоминание сразу, а не на следующий день. Журнал не даст отправить дважды.
+        """
+        if not self.running:
+            return
+        today = date.today()
+        if not any(deadline and 0 <= (deadline - today).days <= 1 for deadline in deadlines):
+            return
+        if datetime.now().hour < REMINDER_HOUR:
+            return # Сегодняшняя рассылка еще впереди
+        now = time.time()
+        if self._adhoc_reminder_at is not None and self._adhoc_reminder_at > now:
+            return # Уже запланирована, она и подхватит
+        self._adhoc_reminder_at = now + ADHOC_REMINDER_DELAY
+        self.schedule(self._adhoc_reminder_at, "reminders_adhoc", lambda: self._run_reminders(self._bot))
+
+    async def _run_reminders(self, bot: Bot):
+        await send_reminders(bot, await collect_due_reminders(bot))
+
+    async def _run_loop(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._heap[0].when - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            scheduled = heapq.heappop(self._heap)
+            if scheduled.next_run is not None:
+                self.schedule(scheduled.next_run(scheduled.when), scheduled.name, scheduled.job, scheduled.next_run)
+            # Каждое событие - отдельная задача: долгий парсинг не задерживает напоминания
+            job_task = asyncio.create_task(self._run_job(scheduled))
+            self._running_jobs.add(job_task)
+            job_task.add_done_callback(self._running_jobs.discard)
+
+    async def _run_job(self, scheduled: ScheduledJob):
+        logger.info(f"SCHEDULER: Запуск '{scheduled.name}'.")
+        try:
+            await scheduled.job()
+        except Exception as e:
+            logger.error(f"SCHEDULER: Ошибка в '{scheduled.name}': {e}", exc_info=True)
+
+
+deadline_scheduler = DeadlineScheduler()
+
+
 # --- Эндпоинт для Напоминаний и Парсинга ---
 @api.post(f"/check_reminders/{REMINDER_SECRET}")
 async def check_reminders_and_schedule_parse(background_tasks: BackgroundTasks):
     # ... (код без изменений) ...
     endpoint_start_time = time.time()
     logger.info(f"CRON: Запуск /check_reminders...")
-    if not (TARGET_CHAT_ID and application and application.bot):
+    if not (application and application.bot):
         logger.error("CRON: /check_reminders - Необходимые компоненты не готовы.")
         return Response(status_code=503, content="Bot not ready or not configured")
 
     bot = application.bot
-    reminders_sent_count = 0
 
     try:
-        if not MESSAGE_ID_TO_EDIT or not MESSAGE_ID_TO_EDIT.isdigit():
-             logger.error(f"CRON: /check_reminders - MESSAGE_ID_TO_EDIT ('{MESSAGE_ID_TO_EDIT}') неверен.")
-             return Response(status_code=500, content="MESSAGE_ID_TO_EDIT not configured correctly")
-             
-        current_tasks = await get_tasks_from_message(bot) 
-        
-        # --- 1. Логика напоминаний ---
-        today = date.today()
-        for task in current_tasks:
-            if task.get("deadline"):
-                try:
-                    deadline_date = datetime.strptime(task["deadline"], "%Y-%m-%d").date()
-                    days_left = (deadline_date - today).days
-                    reminder_text = None
-                    if days_left == 0:
-                        reminder_text = f"❗️ **НАПОМИНАНИЕ (дедлайн сегодня):**\n{task.get('task', 'Название отсутствует')}"
-                    elif days_left == 1:
-                        reminder_text = f"🔔 **НАПОМИНАНИЕ (дедлайн завтра):**\n{task.get('task', 'Название отсутствует')}"
-                    
-                    if reminder_text:
-                        await bot.send_message(chat_id=TARGET_CHAT_ID, text=reminder_text, parse_mode="Markdown")
-                        reminders_sent_count += 1
-                except ValueError: continue
-                except Exception as e: logger.error(f"CRON: Ошибка отправки напоминания для '{task.get('task', '?')}': {e}")
-
-        logger.info(f"CRON: /check_reminders - Напоминания проверены ({reminders_sent_count} отправлено).")
+        # --- 1. Логика напоминаний: собираем и отдаем в фоновую рассылку ---
+        reminders = await collect_due_reminders(bot)
+        background_tasks.add_task(send_reminders, bot, reminders)
+        logger.info(f"CRON: /check_reminders - Напоминаний к отправке: {len(reminders)}. Локи изменений: {chat_locks.stats}")
 
         # --- 2. Добавляем ПАРСИНГ в фон ---
-        background_tasks.add_task(run_parser_and_update, bot, current_tasks)
+        background_tasks.add_task(run_parser_and_update, bot)
         logger.info("CRON: /check_reminders - Задача парсинга добавлена в фон.")
 
         endpoint_duration = time.time() - endpoint_start_time
         logger.info(f"CRON: /check_reminders - Эндпоинт завершил работу за {endpoint_duration:.2f} сек.")
         
-        return Response(status_code=200, content=f"Reminders checked ({reminders_sent_count} sent). Parser scheduled.")
+        return Response(status_code=200, content=f"Reminders checked ({len(reminders)} queued). Parser scheduled.")
 
     except Exception as e:
         logger.error(f"CRON: /check_reminders - Критическая ошибка: {e}", exc_info=True)
         return Response(status_code=500, content=f"Error in reminder check: {e}")
 
 # --- Функция фоновой задачи парсинга ---
-async def run_parser_and_update(bot: Bot, current_tasks: list):
+@dataclass(slots=True)
+class TaskDiff:
+    added: list[TaskRecord] = field(default_factory=list)
+    changed: list[tuple[TaskRecord, str, date | None, str | None]] = field(default_factory=list) # (запись, имя, дедлайн, id)
+    removed: list[TaskRecord] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    @property
+    def visible(self) -> bool:
+        """Меняет ли diff текст сообщения (простое присвоение ID старой задаче - нет)."""
+        return bool(self.added or self.removed or any(
+            (record.name, record.deadline) != (name, deadline) for record, name, deadline, _ in self.changed))
+
+
+def diff_kse_tasks(current: list[TaskRecord], snapshot: HomeworkSnapshot) -> TaskDiff:
+    """
+    Трехсторонний diff списка чата и прохода парсера, O(n) на словарях:
+    - новое задание (ID не встречался) - added;
+    - то же задание с другим названием/дедлайном - changed (а не дубликат);
+    - задача KSE, которой больше нет на странице своего курса - removed.
+      Если курс не скачался, его задачи не трогаем.
+    Задачи без ID (добавленные до появления ID) сопоставляются по имени и получают ID.
+    """
+    diff = TaskDiff()
+    by_id = {record.task_id: record for record in current if record.task_id}
+    legacy_by_name = {record.name: record for record in current if not record.task_id}
+    for task in snapshot.tasks:
+        task_id = task.get("id")
+        record = by_id.get(task_id) if task_id else None
+        if record is None:
+            record = legacy_by_name.pop(task["task"], None)
+        new_task = TaskRecord.from_dict(task)
+        if record is None:
+            diff.added.append(new_task)
+        elif (record.name, record.deadline, record.task_id) != (new_task.name, new_task.deadline, new_task.task_id or record.task_id):
+            diff.changed.append((record, new_task.name, new_task.deadline, new_task.task_id or record.task_id))
+
+    diff.removed = [record for task_id, record in by_id.items()
+                    if task_id.startswith("kse:") and task_id not in snapshot.seen_ids and snapshot.covers(task_id)]
+    return diff
+
+
+async def run_parser_and_update(bot: Bot):
     """
     Эта функция выполняется в ФОНЕ.
-    Она парсит KSE, сравнивает задачи и обновляет сообщение.
+    Она парсит KSE, сравнивает задачи и обновляет сообщение владельца (OWNER_CHAT_ID).
     """
+    task_store = chat_registry.store(OWNER_CHAT_ID) if OWNER_CHAT_ID is not None else None
+    if task_store is None:
+        logger.warning("BG_TASK: Чат владельца (TARGET_CHAT_ID) не настроен, парсинг KSE пропущен.")
+        return
+
     logger.info("BG_TASK: Запуск фонового парсинга KSE...")
     task_start_time = time.time()
     parser_message = ""
     try:
-        new_hw_tasks = await parse_homework() # Использует обновленный парсер
+        snapshot = await parse_homework() # Использует обновленный парсер
 
-        # --- Логика слияния ---
+        # --- Логика слияния (под локом чата, на свежем списке) ---
         tasks_updated = False
-        # --- ❗️❗️❗️ ИСПОЛЬЗУЕМ СЕТ ИЗ ФИКСИРОВАННОЙ ФУНКЦИИ ---
-        current_task_strings = {t.get('task') for t in current_tasks if t.get('task')} 
-        new_tasks_added_count = 0
-
-        for new_task in new_hw_tasks:
-            new_task_name = new_task.get('task')
-            if new_task_name and new_task_name not in current_task_strings:
-                current_tasks.append(new_task) # Добавляем в список, который будет передан в update
-                tasks_updated = True
-                new_tasks_added_count += 1
-            elif not new_task_name:
-                 logger.warning("BG_TASK: Парсер вернул задачу без имени.")
-            elif new_task_name in current_task_strings:
-                 logger.info(f"BG_TASK: Задача '{new_task_name}' уже есть в списке, пропуск.")
-
+        async with chat_locks.hold(task_store.chat_id):
+            current_tasks = await task_store.get_records(bot)
+            diff = diff_kse_tasks(current_tasks, snapshot)
+            message_changes = diff.visible # До применения: потом записи уже обновлены
+            if task_store.loaded:
+                tasks_updated = task_store.apply_diff(diff) and message_changes # Одна запись на диск на весь diff
 
         if tasks_updated:
-            logger.info(f"BG_TASK: Парсер KSE нашел {new_tasks_added_count} новых заданий. Обновляю список...")
-            if not MESSAGE_ID_TO_EDIT or not MESSAGE_ID_TO_EDIT.isdigit():
-                 logger.error(f"BG_TASK: MESSAGE_ID_TO_EDIT ('{MESSAGE_ID_TO_EDIT}') неверен. Не могу обновить сообщение.")
-            else:
-                 # Передаем обновленный current_tasks (включая старые и новые)
-                 await update_tasks_message(bot, current_tasks) 
-            parser_message = f"Parser added {new_tasks_added_count} new tasks."
+            parser_message = (f"Parser diff: {len(diff.added)} added, {len(diff.changed)} changed, "
+                              f"{len(diff.removed)} removed.")
+            logger.info(f"BG_TASK: Парсер KSE: +{len(diff.added)} новых, ~{len(diff.changed)} изменено, "
+                        f"-{len(diff.removed)} удалено. Обновляю список...")
+            await schedule_tasks_message_update(bot, task_store.chat_id)
         else:
-            logger.info("BG_TASK: Парсер KSE не нашел новых актуальных заданий.")
-            parser_message = "Parser found no new tasks."
+            logger.info("BG_TASK: Парсер KSE: изменений нет, сообщение не трогаю.")
+            parser_message = "Parser found no changes."
 
     except Exception as e:
         logger.error(f"BG_TASK: Ошибка во время фонового парсинга KSE: {e}", exc_info=True)
@@ -753,6 +2800,220 @@ async def run_parser_and_update(bot: Bot, current_tasks: list):
     logger.info(f"BG_TASK: Фоновый парсинг завершен за {task_duration:.2f} сек. {parser_message}")
 
 
+# --- HTTP API задач: массовые upsert / delete / export ---
+# Пакет применяется целиком или не применяется вовсе: сначала проверка всех строк, потом
+# одна правка списка под локом чата, одна запись на диск и одна перерисовка сообщения.
+TASKS_API_TOKEN = os.getenv("TASKS_API_TOKEN") # Без токена API выключен
+TASKS_API_MAX_BATCH = int(os.getenv("TASKS_API_MAX_BATCH", "5000"))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class TaskBatchError(ValueError):
+    """Пакет не прошел проверку - ничего не применено."""
+
+    def __init__(self, errors: list[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def _json_response(data, status_code: int = 200) -> Response:
+    return Response(status_code=status_code, content=json.dumps(data, ensure_ascii=False),
+                    media_type="application/json")
+
+
+def _check_api_token(request: Request) -> Response | None:
+    """None - запрос авторизован, иначе готовый ответ с ошибкой."""
+    if not TASKS_API_TOKEN:
+        return Response(status_code=404)
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), TASKS_API_TOKEN.encode()):
+        logger.warning(f"TASKS_API: Отклонен запрос без верного токена ({request.url.path}).")
+        return Response(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    return None
+
+
+async def _read_batch(request: Request, key: str) -> list:
+    """Тело пакета: JSON {key: [...]} / JSON-массив или NDJSON (одна запись на строку)."""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+            items = [_json_loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            data = _json_loads(body)
+            items = data.get(key) if isinstance(data, dict) else data
+    except ValueError as e:
+        raise TaskBatchError([f"невалидный JSON: {e}"])
+    if not isinstance(items, list):
+        raise TaskBatchError([f"ожидался список '{key}'"])
+    if len(items) > TASKS_API_MAX_BATCH:
+        raise TaskBatchError([f"в пакете {len(items)} записей, максимум {TASKS_API_MAX_BATCH}"])
+    return items
+
+
+def _validate_upserts(items: list) -> list[TaskRecord]:
+    records, errors = [], []
+    for n, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            errors.append(f"#{n}: ожидался объект")
+            continue
+        name, deadline, task_id = item.get("task"), item.get("deadline"), item.get("id")
+        if not isinstance(name, str) or not name.strip():
+            errors.append(f"#{n}: пустое поле 'task'")
+            continue
+        if task_id is not None and (not isinstance(task_id, str) or not task_id):
+            errors.append(f"#{n}: 'id' должен быть непустой строкой")
+            continue
+        if task_id and task_id.startswith("kse:"):
+            # Такие задачи ведет синхронизация KSE и сама удаляет исчезнувшие с сайта
+            errors.append(f"#{n}: префикс 'kse:' в 'id' зарезервирован за KSE")
+            continue
+        try:
+            deadline = date.fromisoformat(deadline) if deadline else None
+        except (TypeError, ValueError):
+            errors.append(f"#{n}: дата '{deadline}' не в формате ГГГГ-ММ-ДД")
+            continue
+        records.append(TaskRecord(" ".join(name.split()), deadline, task_id))
+    if errors:
+        raise TaskBatchError(errors)
+    return records
+
+
+def diff_upsert(current: list[TaskRecord], upserts: list[TaskRecord]) -> TaskDiff:
+    """
+    Diff для upsert: запись ищется по ID, без ID (или если ID еще не встречался) - по имени.
+    Повтор одной задачи в пакете (в том числе новой) - побеждает последняя строка.
+    """
+    by_id = {record.task_id: record for record in current if record.task_id}
+    by_name = {record.name: record for record in current}
+    targets: dict[int, tuple] = {} # id(записи) -> (запись, имя, дедлайн, id)
+    added: list[TaskRecord] = []
+    added_by_id: dict[str, int] = {} # Индексы в added - новые задачи ищутся так же, как существующие
+    added_by_name: dict[str, int] = {}
+    errors = []
+    for n, new in enumerate(upserts, start=1):
+        record = by_id.get(new.task_id) if new.task_id else None
+        if record is None:
+            record = by_name.get(new.name)
+            if record is not None and new.task_id and record.task_id and record.task_id != new.task_id:
+                errors.append(f"#{n}: задача '{new.name}' уже есть с другим id ({record.task_id})")
+                continue
+        if record is None:
+            slot = added_by_id.get(new.task_id) if new.task_id else None
+            if slot is None:
+                slot = added_by_name.get(new.name)
+                if slot is not None and new.task_id and added[slot].task_id:
+                    errors.append(f"#{n}: задача '{new.name}' уже есть в пакете с другим id ({added[slot].task_id})")
+                    continue
+            if slot is None:
+                slot = len(added)
+                added.append(new)
+            else:
+                owner = added_by_name.get(new.name)
+                if owner is not None and owner != slot:
+                    errors.append(f"#{n}: имя '{new.name}' уже занято другой задачей пакета")
+                    continue
+                previous = added[slot]
+                del added_by_name[previous.name]
+                added[slot] = TaskRecord(new.name, new.deadline, new.task_id or previous.task_id)
+            added_by_name[new.name] = slot
+            if added[slot].task_id:
+                added_by_id[added[slot].task_id] = slot
+            continue
+        owner = by_name.get(new.name)
+        if owner is not None and owner is not record:
+            errors.append(f"#{n}: имя '{new.name}' уже занято другой задачей")
+            continue
+        targets[id(record)] = (record, new.name, new.deadline, new.task_id or record.task_id)
+    if errors:
+        raise TaskBatchError(errors)
+
+    diff = TaskDiff(added=added)
+    diff.changed = [change for change in targets.values()
+                    if (change[0].name, change[0].deadline, change[0].task_id) != change[1:]]
+    return diff
+
+
+def diff_delete(current: list[TaskRecord], items: list) -> tuple[TaskDiff, list]:
+    """Удаление по ID ("kse:...") или точному имени. Второй элемент - ключи, которых нет в списке."""
+    by_key = {record.name: record for record in current}
+    by_key.update((record.task_id, record) for record in current if record.task_id)
+    errors = [f"#{n}: ожидалась строка (id или имя задачи)" for n, item in enumerate(items, start=1)
+              if not isinstance(item, str)]
+    if errors:
+        raise TaskBatchError(errors)
+    removed, missing = {}, []
+    for key in items:
+        record = by_key.get(key)
+        if record is None:
+            missing.append(key)
+        else:
+            removed[id(record)] = record
+    return TaskDiff(removed=list(removed.values())), missing
+
+
+async def _apply_task_batch(chat_id: int, make_diff) -> tuple[TaskDiff, object]:
+    """Одна транзакция: diff строится и применяется под локом чата на свежем списке."""
+    bot = application.bot
+    task_store = chat_registry.store(chat_id)
+    async with chat_locks.hold(chat_id):
+        if not await task_store.load(bot):
+            raise RuntimeError("список задач чата не загружен")
+        diff, extra = make_diff(await task_store.get_records(bot))
+        message_changes = diff.visible # До применения: потом записи уже обновлены
+        task_store.apply_diff(diff) # Одна запись на диск на весь пакет
+    if message_changes:
+        schedule_tasks_message_update(bot, chat_id) # Одна перерисовка на пакет
+    return diff, extra
+
+
+async def _handle_task_batch(request: Request, chat_id: int, key: str, make_diff) -> Response:
+    if (denied := _check_api_token(request)) is not None:
+        return denied
+    if not (application and application.bot) or chat_registry.get(chat_id) is None:
+        return _json_response({"error": f"чат {chat_id} не зарегистрирован (/setup)"}, 404)
+    try:
+        items = await _read_batch(request, key)
+        diff, extra = await _apply_task_batch(chat_id, lambda current: make_diff(current, items))
+    except TaskBatchError as e:
+        return _json_response({"error": "пакет отклонен, ничего не изменено", "details": e.errors}, 422)
+    except RuntimeError as e:
+        logger.error(f"TASKS_API: Пакет для чата {chat_id} не применен: {e}")
+        return _json_response({"error": str(e)}, 503)
+    logger.info(f"TASKS_API: Чат {chat_id}: +{len(diff.added)} добавлено, ~{len(diff.changed)} изменено, "
+                f"-{len(diff.removed)} удалено (пакет из {len(items)}).")
+    result = {"added": len(diff.added), "changed": len(diff.changed), "removed": len(diff.removed),
+              "revision": chat_registry.store(chat_id).revision}
+    if extra:
+        result["not_found"] = extra
+    return _json_response(result)
+
+
+@api.post("/api/chats/{chat_id}/tasks")
+async def upsert_tasks(chat_id: int, request: Request):
+    return await _handle_task_batch(request, chat_id, "tasks",
+                                    lambda current, items: (diff_upsert(current, _validate_upserts(items)), None))
+
+
+@api.post("/api/chats/{chat_id}/tasks/delete")
+async def delete_tasks(chat_id: int, request: Request):
+    return await _handle_task_batch(request, chat_id, "ids", diff_delete)
+
+
+@api.get("/api/chats/{chat_id}/tasks")
+async def export_tasks(chat_id: int, request: Request, format: str = "json"):
+    if (denied := _check_api_token(request)) is not None:
+        return denied
+    task_store = chat_registry.store(chat_id)
+    if not (application and application.bot) or task_store is None:
+        return _json_response({"error": f"чат {chat_id} не зарегистрирован (/setup)"}, 404)
+    records = await task_store.get_records(application.bot) # Снимок - экспорт не держит лок чата
+    if format == "ndjson":
+        content = "".join(json.dumps(record.to_dict(), ensure_ascii=False) + "\n" for record in records)
+        return Response(content=content, media_type=NDJSON_MEDIA_TYPE)
+    return _json_response({"chat_id": chat_id, "revision": task_store.revision,
+                           "tasks": [record.to_dict() for record in records]})
+
+
 # --- Точка входа ---
 if __name__ == "__main__":
     import uvicorn
@@ -762,7 +3023,6 @@ if __name__ == "__main__":
     config = uvicorn.Config(app="main:api", host="0.0.0.0", port=port, lifespan="on", reload=True) 
     server = uvicorn.Server(config)
     
-    import asyncio
     try:
         asyncio.run(server.serve())
     except KeyboardInterrupt: